@@ -2,165 +2,175 @@
 
 """
 Author: Lori Garzio on 1/11/2022
-Last modified: 11/8/2023
+Last modified: 10/16/2026
 Modified from code from Sam Coakley following theory from Carvalho et al 2016 https://doi.org/10.1002/2016GL071205
 Calculate Mixed Layer Depth for glider profiles using density and pressure, then add the MLD variable to the .nc file.
 The dataset provided must have 'time' or 'profile_time' as the only coordinate in order to convert the dataset to a
 dataframe properly
+For real-time files that grow each time the glider surfaces, incremental mode uses the MLD values from the existing
+_mld.nc file and only calculates MLD for profiles that are new or changed (different number of observations or last
+observation time) since the last run. When only the profiles at the end of the file changed, only those observations
+are read from the source file and written over the end of the _mld.nc file (its time dimension is unlimited), so
+an update costs about the same however long the deployment is. Otherwise the whole file is rewritten.
+If the file doesn't have the MLD variable (e.g. density, or potential_density), it's calculated lazily with gsw from
+salinity (or conductivity), temperature and pressure (see functions/derived.py).
+With profile_output=True, the results are written to a compact _mld_profiles.nc file instead: MLD, max N**2, QI and a
+reason code for profiles without MLD on a 'profile' dimension, plus the binned N**2 profiles in a contiguous ragged
+array, without repeating the profile values for every observation (see mixed_layer_depth.mld_profiles). Incremental
+mode isn't available for the profile output, MLD is calculated for all profiles and the file is rewritten.
+MLD from other criteria (density/temperature threshold, gradient or max N**2 of another variable, see
+mixed_layer_depth.MLD_CRITERIA) can be added to the profile output, calculated on the same binned profiles.
+The number of profiles without MLD for each reason (see mixed_layer_depth.MLD_REASONS) and the time spent reading,
+binning, calculating N**2 and calculating QI are printed and returned as a summary table.
+Profile plots are drawn after MLD is calculated, by a pool of worker processes (see functions/profile_plots.py).
 """
 
 import os
-import datetime as dt
-import xarray as xr
+import netCDF4
 import numpy as np
+import xarray as xr
 import pandas as pd
-import gsw
-import matplotlib.pyplot as plt
 import functions.common as cf
+import functions.derived as derived
 import functions.mixed_layer_depth as mldfunc
-plt.rcParams.update({'font.size': 14})
+import functions.profile_plots as pplots
 pd.set_option('display.width', 320, "display.max_columns", 20)  # for display in pycharm console
 
 
-def main(fname, timevar, plots, mldvar, zvar):
-    mld = np.array([], dtype='float32')
-    max_n2 = np.array([], dtype='float32')
-
-    savefile = f'{fname.split(".nc")[0]}_mld.nc'
-
-    ds = xr.open_dataset(fname)
+def previous_results(savefile, timevar):
+    """
+    Read the MLD values that were calculated for each profile in a previous run
+    :param savefile: existing MLD output file
+    :param timevar: time variable on which profiles are grouped
+    :return: dataframe indexed by profile with columns mld, max_n2, nobs (number of observations in the profile) and
+    end_time (time of the last observation in the profile), and the profile and time of each observation in the file
+    """
+    with xr.open_dataset(savefile) as ds:
+        df = pd.DataFrame({timevar: ds[timevar].values, 'time': ds.time.values, 'mld': ds.mld_dbar.values,
+                           'max_n2': ds.max_n2.values})
+    grouped = df.groupby(timevar)
+    prev = grouped[['mld', 'max_n2']].first()
+    prev['nobs'] = grouped.size()
+    prev['end_time'] = grouped.time.max()
+
+    return prev, df[timevar].values, df.time.values
+
+
+def incremental_start(ds, previous, saved_ids, saved_times, timevar):
+    """
+    Find the first observation of the profiles that are new or changed since the previous run. Only the profile and
+    time variables of the source file are read.
+    :param ds: source dataset sorted by time
+    :param previous: dataframe of previous results from previous_results
+    :param saved_ids: profile of each observation in the existing output file
+    :param saved_times: time of each observation in the existing output file
+    :param timevar: time variable on which profiles are grouped
+    :return: index of the first observation to recalculate and write, or None if the profiles before it aren't the
+    same as in the output file (the whole file has to be rewritten)
+    """
+    ids = ds[timevar].values
+    times = ds.time.values
+    profiles, profile_idx, nobs = np.unique(ids, return_inverse=True, return_counts=True)
+    profile_idx = profile_idx.ravel()
+    end_time = pd.Series(times).groupby(profile_idx).max().values
+    previous = previous.reindex(profiles)
+    changed = ~((previous.nobs.values == nobs) & (previous.end_time.values == end_time))[profile_idx]
+    start = int(np.argmax(changed)) if np.any(changed) else len(ids)
+
+    # the observations before start have to be the same as in the output file, and no profile can continue after start
+    same = (len(saved_ids) >= start and np.array_equal(saved_ids[:start], ids[:start]) and
+            np.array_equal(saved_times[:start], times[:start]) and not np.any(np.isin(ids[start:], ids[:start])))
+
+    return start if same else None
+
+
+def update_ranges(savefile, ds, variables):
+    """
+    Widen the actual_range attribute of variables in the output file to include the values that were appended
+    """
+    with netCDF4.Dataset(savefile, 'a') as nc:
+        for v in variables:
+            values = ds[v].values
+            if v not in nc.variables or 'actual_range' not in nc[v].ncattrs() or np.all(np.isnan(values)):
+                continue
+            old = nc[v].actual_range
+            nc[v].actual_range = np.array([np.nanmin(np.append(values, old[0])), np.nanmax(np.append(values, old[1]))])
+
+
+def main(fname, timevar, plots, mldvar, zvar, incremental=False, chunk_profiles=500, plot_workers=1, plot_dpi=300,
+         plot_every=1, skip_existing=False, profile_output=False, criteria=None):
+    savefile = cf.output_file(fname, '_mld_profiles.nc' if profile_output else '_mld.nc')
+
+    # open the file lazily, data are only read for the variables needed and one chunk of profiles at a time
+    ds = cf.open_deployment(fname)
     ds = ds.sortby(ds.time)
     deploy = ds.title
 
-    df = ds.to_dataframe()
-
-    # remove data (pressure plus the variable you're using to calculate MLD) that's collected at the surface (< 1 dbar)
-    df.loc[df.pressure < 1, ['pressure', mldvar]] = np.nan
-    grouped = df.groupby(timevar, dropna=False)
-
+    criteria = mldfunc.select_criteria(criteria)
+    if criteria and not profile_output:
+        print('MLD criteria are only written to the _mld_profiles.nc output, calculating max N2 MLD only')
+        criteria = []
+
+    # calculate density variables that aren't in the file, they're only computed for each chunk of profiles as it's read
+    derived_vars = ['absolute_salinity', 'conservative_temperature', 'potential_density']
+    if mldvar not in ds or any(c['variable'] in derived_vars and c['variable'] not in ds for c in criteria):
+        ds = derived.add_derived(ds, zvar=zvar, timevar=timevar, n2=False)
+
+    # profiles that already have MLD calculated from the previous run (and haven't changed) aren't recalculated
+    previous = None
+    start = None
+    if incremental and profile_output:
+        print('incremental mode is only available for the _mld.nc output, calculating MLD for all profiles')
+    elif incremental and os.path.isfile(savefile):
+        previous, saved_ids, saved_times = previous_results(savefile, timevar)
+        start = incremental_start(ds, previous, saved_ids, saved_times, timevar)
+
+    appended = False
+    results = []  # MLD results for each profile, for the plots
+    if start == ds.sizes[ds.time.dims[0]]:
+        print(f'{deploy}: no new or changed profiles since the last run')
+        return savefile, mldfunc.mld_summary(np.full(len(previous), -1), name=deploy)
+    if start is not None:
+        # only the new and changed profiles at the end of the file are read, calculated and written
+        dim = ds.time.dims[0]
+        tail = ds.isel({dim: slice(start, None)})
+        print(f'{deploy}: appending from observation {start} of {ds.sizes[dim]}')
+        tail, summary = mldfunc.add_mld(tail, timevar, mldvar, zvar, previous=previous,
+                                        chunk_profiles=chunk_profiles, summary=True, profile_results=results)
+        appended = cf.append_netcdf(tail, savefile, start)
+        if appended:
+            update_ranges(savefile, tail, ['mld_dbar', 'mld', 'max_n2'])
+            ds = tail  # only the appended profiles are plotted
+        else:
+            print(f'{deploy}: the output file can\'t be appended to, rewriting it')
+            results = []
+
+    if profile_output:
+        profiles, summary = mldfunc.mld_profiles(ds, timevar, mldvar, zvar, chunk_profiles=chunk_profiles,
+                                                 summary=True, criteria=criteria)
+        profiles.to_netcdf(savefile)
+        results = [profiles[['mld_dbar', 'max_n2', 'qi']].to_dataframe().set_index(profiles[timevar].values)
+                   .rename(columns={'mld_dbar': 'mld'})]
+    elif not appended:
+        ds, summary = mldfunc.add_mld(ds, timevar, mldvar, zvar, previous=previous, chunk_profiles=chunk_profiles,
+                                      summary=True, profile_results=results)
+        # the time dimension is unlimited so incremental runs can append to the file
+        ds.to_netcdf(savefile, unlimited_dims=[ds.time.dims[0]])
+
+    # why profiles don't have MLD and where the time went
+    print(summary.T)
+
+    # plot the binned temperature and density profiles with the MLD after the calculation is finished
     if plots:
         plots = os.path.join(plots, 'mld_analysis', deploy)
         os.makedirs(plots, exist_ok=True)
+        results = pd.concat(results) if results else pd.DataFrame(columns=['mld', 'max_n2', 'qi'])
+        tasks = pplots.plot_tasks(ds, results, plots, timevar, mldvar, zvar, every=plot_every,
+                                  skip_existing=skip_existing, chunk_profiles=chunk_profiles)
+        print(f'{deploy}: plotting {len(tasks)} profiles')
+        pplots.render_plots(tasks, plots, workers=plot_workers, dpi=plot_dpi)
 
-    for group in grouped:
-        # Create temporary dataframe to interpolate to dz m depths
-        ll = len(group[1])
-        kwargs = {'depth_var': zvar}
-        temp_df1 = group[1][[mldvar, zvar, 'temperature']].dropna(how='all')
-        if len(temp_df1) == 0:
-            mldx = np.repeat(np.nan, ll)
-            max_n2x = np.repeat(np.nan, ll)
-        else:
-            temp_df = cf.depth_bin(temp_df1, **kwargs)
-            temp_df.dropna(subset=[mldvar], inplace=True)
-            temp_df.index.name = f'{zvar}_bins'
-            temp_df.reset_index(inplace=True)
-            if len(temp_df) == 0:
-                mldx = np.repeat(np.nan, ll)
-                max_n2x = np.repeat(np.nan, ll)
-                qi = 'MLD not calculated'
-            else:
-                # calculate profile's pressure range
-                pressure_range = (np.nanmax(temp_df[zvar]) - np.nanmin(temp_df[zvar]))
-
-                if pressure_range < 5:
-                    # if the profile spans <5 dbar, don't calculate MLD
-                    mldx = np.repeat(np.nan, ll)
-                    max_n2x = np.repeat(np.nan, ll)
-                    qi = 'MLD not calculated'
-
-                else:
-                    kwargs = {'zvar': zvar}
-                    mldx, N2, qi = mldfunc.profile_mld(temp_df, **kwargs)
-                    mldx = np.repeat(mldx, ll)
-                    max_n2x = np.repeat(N2, ll)
-
-            if plots:
-                try:
-                    tstr = group[0].strftime("%Y-%m-%dT%H%M%SZ")
-                except AttributeError:
-                    tstr = pd.to_datetime(np.nanmin(group[1].time)).strftime("%Y-%m-%dT%H%M%SZ")
-                # plot temperature
-                fig, ax = plt.subplots(figsize=(8, 10))
-                ax.scatter(temp_df['temperature'], temp_df[zvar])
-
-                ax.invert_yaxis()
-                ax.set_ylabel('Pressure (dbar)')
-                ax.set_xlabel('temperature')
-
-                ax.axhline(y=np.unique(mldx), ls='--', c='k')
-
-                sfile = os.path.join(plots, f'temperature_{tstr}.png')
-                plt.savefig(sfile, dpi=300)
-                plt.close()
-
-                # plot density
-                fig, ax = plt.subplots(figsize=(8, 10))
-                ax.scatter(temp_df['density'], temp_df[zvar])
-
-                ax.invert_yaxis()
-                ax.set_ylabel('Pressure (dbar)')
-                ax.set_xlabel('density')
-                ax.set_title(f'QI = {qi}\nN2 = {np.unique(max_n2x)[0]}')
-
-                ax.axhline(y=np.unique(mldx), ls='--', c='k')
-
-                sfile = os.path.join(plots, f'density{tstr}.png')
-                plt.savefig(sfile, dpi=300)
-                plt.close()
-
-        mld = np.append(mld, mldx)
-        max_n2 = np.append(max_n2, max_n2x)
-
-    # add mld to the dataset
-    mld_min = np.nanmin(mld)
-    mld_max = np.nanmax(mld)
-    attrs = {
-        'actual_range': np.array([mld_min, mld_max]),
-        'ancillary_variables': [mldvar, zvar],
-        'observation_type': 'calculated',
-        'units': ds[zvar].units,
-        'comment': 'Mixed Layer Depth calculated as the depth of max Brunt‐Vaisala frequency squared (N**2) '
-                   'from Carvalho et al 2016 (https://doi.org/10.1002/2016GL071205)',
-        'long_name': 'Mixed Layer Depth'
-        }
-    da = xr.DataArray(mld, coords=ds[mldvar].coords, dims=ds[mldvar].dims,
-                      name='mld_dbar', attrs=attrs)
-    ds['mld_dbar'] = da
-
-    # calculate MLD in meters
-    mld_meters = gsw.z_from_p(-ds.mld_dbar.values, ds.latitude.values)
-
-    attrs = {
-        'actual_range': np.array([np.nanmin(mld_meters), np.nanmax(mld_meters)]),
-        'observation_type': 'calculated',
-        'units': 'm',
-        'comment': 'Mixed Layer Depth calculated as the depth of max Brunt‐Vaisala frequency squared (N**2) from '
-                   'Carvalho et al 2016 (https://doi.org/10.1002/2016GL071205). Calculated from MLD in dbar and latitude using gsw.z_from_p',
-        'long_name': 'Mixed Layer Depth'
-    }
-    da = xr.DataArray(mld_meters, coords=ds.mld_dbar.coords, dims=ds.mld_dbar.dims,
-                      name='mld', attrs=attrs)
-    ds['mld'] = da
-
-    # add maximum buoyancy frequency N2 (measure of stratification strength) to the dataset
-    n2_min = np.nanmin(max_n2)
-    n2_max = np.nanmax(max_n2)
-    attrs = {
-        'actual_range': np.array([n2_min, n2_max]),
-        'ancillary_variables': [mldvar, zvar],
-        'observation_type': 'calculated',
-        'units': 's-2',
-        'comment': 'Maximum Brunt‐Vaisala frequency squared (N**2) for each profile used to calculate Mixed Layer Depth '
-                   'from Carvalho et al 2016 (https://doi.org/10.1002/2016GL071205). This can be used as a measurement '
-                   'for stratification strength',
-        'long_name': 'Maximum Buoyancy Frequency'
-    }
-    da = xr.DataArray(max_n2, coords=ds[mldvar].coords, dims=ds[mldvar].dims,
-                      name='max_n2', attrs=attrs)
-    ds['max_n2'] = da
-
-    ds.to_netcdf(savefile)
+    return savefile, summary
 
 
 if __name__ == '__main__':
@@ -169,4 +179,12 @@ if __name__ == '__main__':
     generate_plots = False # '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/ru39-20230817T1520/delayed/ncei'  # False or save_directory e.g. '/Users/garzio/Documents/rucool/Saba/gliderdata/plots'
     mldvar = 'density'  # variable used to calculate MLD
     zvar = 'pressure'  # pressure variable
-    main(ncfile, time_variable, generate_plots, mldvar, zvar)
+    incremental = False  # True to only calculate MLD for new profiles if the _mld.nc file exists (e.g. for rt-slice files)
+    plot_workers = 4  # number of processes used to draw the profile plots
+    plot_dpi = 300  # resolution of the profile plots
+    plot_every = 1  # plot every Nth profile
+    skip_existing = True  # True to skip profiles that have already been plotted
+    profile_output = False  # True to write profile-level results and binned N2 profiles to _mld_profiles.nc (incremental is ignored)
+    criteria = None  # None or list of other MLD criteria for the profile output, e.g. ['density_threshold', 'temperature_threshold', 'density_gradient', 'potential_density_max_n2']
+    main(ncfile, time_variable, generate_plots, mldvar, zvar, incremental, plot_workers=plot_workers, plot_dpi=plot_dpi,
+         plot_every=plot_every, skip_existing=skip_existing, profile_output=profile_output, criteria=criteria)
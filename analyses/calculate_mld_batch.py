@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Calculate Mixed Layer Depth for multiple glider deployments in parallel using calculate_mld.main. Each deployment file
+is processed by a worker in a process pool and the _mld.nc output is written next to the input file. A file that fails
+is reported at the end and does not stop the rest of the batch. The report has one row per deployment with the number
+of profiles without MLD for each reason code and the time spent in each stage of the calculation.
+Example:
+python calculate_mld_batch.py '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/*/delayed/*-delayed.nc' -w 4
+"""
+
+import os
+import glob
+import time
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # workers render profile plots without a display
+import calculate_mld
+import functions.mixed_layer_depth as mldfunc
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def find_files(patterns):
+    """
+    :param patterns: list of file names or glob patterns
+    :return: sorted list of unique deployment files, excluding files that are already MLD output
+    """
+    flist = []
+    for pattern in patterns:
+        matches = glob.glob(os.path.expanduser(pattern))
+        if not matches:
+            print(f'No files found: {pattern}')
+        flist.extend(matches)
+
+    return sorted(set(f for f in flist if not f.endswith(('_mld.nc', '_mld_profiles.nc'))))
+
+
+def run_file(fname, timevar, plots, mldvar, zvar, incremental=False, options=None):
+    """
+    Calculate MLD for one deployment file and time it. Errors are returned instead of raised so one bad file doesn't
+    stop the batch.
+    :return: dictionary with the file name, output file, processing time in seconds, error message (if any) and the
+    reason code and timings summary from calculate_mld.main
+    """
+    start = time.time()
+    summary = dict()
+    try:
+        savefile, mld_summary = calculate_mld.main(fname, timevar, plots, mldvar, zvar, incremental, **(options or {}))
+        summary = mld_summary.iloc[0].to_dict()
+        error = None
+    except Exception as e:
+        savefile = None
+        error = f'{type(e).__name__}: {e}'
+
+    return dict(file=fname, savefile=savefile, seconds=round(time.time() - start, 2), error=error, **summary)
+
+
+def main(flist, workers, timevar, plots, mldvar, zvar, report=None, incremental=False, options=None):
+    flist = find_files(flist)
+    start = time.time()
+    print(f'{dt.datetime.now():%Y-%m-%dT%H:%M:%S} Calculating MLD for {len(flist)} files with {workers} workers')
+
+    results = []
+    if workers == 1:
+        # run serially in this process, useful for debugging
+        for fname in flist:
+            results.append(run_file(fname, timevar, plots, mldvar, zvar, incremental, options))
+            print_progress(results[-1], len(results), len(flist))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_file, f, timevar, plots, mldvar, zvar, incremental, options)
+                       for f in flist]
+            for future in as_completed(futures):
+                results.append(future.result())
+                print_progress(results[-1], len(results), len(flist))
+
+    summary = pd.DataFrame(results)
+    summary = summary.reindex(columns=list(dict.fromkeys(['file', 'savefile', 'seconds', 'error'] +
+                                                         list(summary.columns))))
+    failed = summary[summary.error.notna()]
+    print(f'\nFinished {len(summary) - len(failed)} of {len(summary)} files in {time.time() - start:.1f} seconds '
+          f'({summary.seconds.sum():.1f} processing seconds)')
+    if len(failed) > 0:
+        print('Failed files:')
+        for row in failed.itertuples():
+            print(f'  {row.file}: {row.error}')
+
+    if report:
+        summary.to_csv(report, index=False)
+
+    return summary
+
+
+def print_progress(result, count, total):
+    status = 'FAILED' if result['error'] else 'done'
+    print(f'[{count}/{total}] {status} ({result["seconds"]} s): {os.path.basename(result["file"])}')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Calculate Mixed Layer Depth for multiple glider deployments',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('files', nargs='+', help='Deployment NetCDF files or glob patterns (quote the pattern)')
+    arg_parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    arg_parser.add_argument('-t', '--timevar', default='profile_time',
+                            help='Time variable on which profiles are grouped')
+    arg_parser.add_argument('-m', '--mldvar', default='density', help='Variable used to calculate MLD')
+    arg_parser.add_argument('-z', '--zvar', default='pressure', help='Pressure variable')
+    arg_parser.add_argument('-p', '--plots', default=False, help='Directory to save profile plots (default: no plots)')
+    arg_parser.add_argument('--plot-dpi', type=int, default=300, help='Resolution of the profile plots')
+    arg_parser.add_argument('--plot-every', type=int, default=1, help='Plot every Nth profile')
+    arg_parser.add_argument('--skip-existing', action='store_true', help='Skip profiles that have already been plotted')
+    arg_parser.add_argument('-i', '--incremental', action='store_true',
+                            help='Only calculate MLD for new profiles when the _mld.nc file already exists '
+                                 '(not available with --profile-output)')
+    arg_parser.add_argument('--profile-output', action='store_true',
+                            help='Write profile-level results and binned N2 profiles to _mld_profiles.nc. MLD is '
+                                 'calculated for all profiles, --incremental is ignored')
+    arg_parser.add_argument('-c', '--criteria', default=None,
+                            help='Optional comma-separated list of other MLD criteria for the profile output '
+                                 '(see mixed_layer_depth.MLD_CRITERIA), e.g. density_threshold,temperature_threshold')
+    arg_parser.add_argument('-r', '--report', default=None,
+                            help='Optional csv file for the per-file timing and reason code report')
+
+    args = arg_parser.parse_args()
+    # options passed to calculate_mld.main. Each file is already processed by a separate worker, so the plots for a
+    # file are drawn in that worker
+    options = dict(plot_dpi=args.plot_dpi, plot_every=args.plot_every, skip_existing=args.skip_existing,
+                   profile_output=args.profile_output,
+                   criteria=args.criteria.split(',') if args.criteria else None)
+    mldfunc.select_criteria(options['criteria'])  # unknown criteria names stop the batch before any file is run
+    main(args.files, args.workers, args.timevar, args.plots, args.mldvar, args.zvar, args.report, args.incremental,
+         options)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""
+Scan directories of glider deployment files into a SQLite catalog (see functions/catalog.py) and list the deployments
+in a map extent and time window. Only files that are new or changed since the last scan are opened.
+Example:
+python catalog_deployments.py /Users/garzio/Documents/rucool/Saba/gliderdata -d /Users/garzio/Documents/rucool/Saba/gliderdata/catalog.db -e -75,-72.25,38.5,40.75 -s 2023-08-17 -t 2023-09-30
+"""
+
+import argparse
+import pandas as pd
+import functions.catalog as catalog
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def main(paths, dbfile, extent=None, start=None, end=None, variables=None, scan=True):
+    if scan:
+        catalog.scan(paths, dbfile)
+    files = catalog.query(dbfile, start=start, end=end, extent=extent, variables=variables)
+    print(files[['deployment', 'start_time', 'end_time', 'lon_min', 'lon_max', 'lat_min', 'lat_max', 'n_profiles',
+                 'path']].to_string(index=False))
+
+    return files
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Catalog glider deployment files and find deployments',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('paths', nargs='*', help='Directories (searched recursively) or deployment files to scan')
+    arg_parser.add_argument('-d', '--database', required=True, help='Catalog SQLite file')
+    arg_parser.add_argument('-e', '--extent', default=None,
+                            help='Optional map limits: lon min,lon max,lat min,lat max')
+    arg_parser.add_argument('-s', '--start', default=None, help='Optional start of the time window')
+    arg_parser.add_argument('-t', '--end', default=None, help='Optional end of the time window')
+    arg_parser.add_argument('-v', '--variables', default=None,
+                            help='Optional comma-separated list of variables the deployments must have')
+
+    args = arg_parser.parse_args()
+    map_extent = [float(x) for x in args.extent.split(',')] if args.extent else None
+    variables = args.variables.split(',') if args.variables else None
+    main(args.paths, args.database, map_extent, args.start, args.end, variables, scan=len(args.paths) > 0)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Convert glider deployment NetCDF files to a partitioned Parquet dataset (one directory per deployment and day, see
+functions/columnar.py). The deployment directories (<output>/deployment=<name>) can be used in place of the NetCDF file
+names in the analysis, map and cross-section scripts, which then only read the variables and days they need.
+Example:
+python convert_parquet.py '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/*/delayed/*-delayed.nc' -o /Users/garzio/Documents/rucool/Saba/gliderdata/parquet
+"""
+
+import os
+import glob
+import argparse
+import pandas as pd
+import functions.columnar as columnar
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def main(patterns, root, variables=None, chunk_size=1000000):
+    flist = sorted(set(f for p in patterns for f in glob.glob(os.path.expanduser(p))))
+    print(f'Converting {len(flist)} files to {root}')
+
+    paths = []
+    for fname in flist:
+        try:
+            paths.append(columnar.convert(fname, root, variables, chunk_size))
+            print(f'done: {os.path.basename(fname)} -> {paths[-1]}')
+        except Exception as e:
+            print(f'FAILED: {os.path.basename(fname)}: {type(e).__name__}: {e}')
+
+    return paths
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Convert glider deployments to partitioned Parquet',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('files', nargs='+', help='Deployment NetCDF files or glob patterns (quote the pattern)')
+    arg_parser.add_argument('-o', '--output', required=True, help='Root directory of the Parquet dataset')
+    arg_parser.add_argument('-v', '--variables', default=None,
+                            help='Optional comma-separated list of variables to store (default: all)')
+    arg_parser.add_argument('-c', '--chunk-size', type=int, default=1000000,
+                            help='Number of observations converted at a time')
+
+    args = arg_parser.parse_args()
+    variables = args.variables.split(',') if args.variables else None
+    main(args.files, args.output, variables, args.chunk_size)
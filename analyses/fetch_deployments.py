@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Download glider deployments from ERDDAP into the local Parquet cache (see functions/erddap.py), requesting only the
+variables needed for an analysis. Running the same command again resumes an interrupted download. The cache directory
+printed for each deployment can be used in place of the NetCDF file name in calculate_mld.py, glider_apply_qc.py,
+glider_qc_mld.py and the map scripts.
+Example:
+python fetch_deployments.py ru40-20230817T1522-profile-sci-delayed -v qc_mld -w 4
+"""
+
+import argparse
+import pandas as pd
+import functions.erddap as erddap
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def main(dataset_ids, variables, start=None, end=None, server=erddap.ERDDAP_SERVER, chunk_days=7, workers=4,
+         cache_dir=erddap.CACHE_DIR, refresh_last=False):
+    paths = dict()
+    for dataset_id in dataset_ids:
+        try:
+            paths[dataset_id] = erddap.fetch_deployment(dataset_id, variables, start, end, server, chunk_days, workers,
+                                                        cache_dir, refresh_last=refresh_last)
+        except Exception as e:
+            print(f'{dataset_id}: {type(e).__name__}: {e}')
+
+    for dataset_id, path in paths.items():
+        print(f'{dataset_id}: {path}')
+
+    return paths
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Download glider deployments from ERDDAP into the local cache',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('datasets', nargs='+', help='ERDDAP dataset IDs')
+    arg_parser.add_argument('-v', '--variables', default='qc_mld',
+                            help=f'Analysis name ({", ".join(erddap.ANALYSIS_VARIABLES)}) or comma-separated list of '
+                                 f'variables')
+    arg_parser.add_argument('--start', default=None, help='Start time (default: start of the dataset)')
+    arg_parser.add_argument('--end', default=None, help='End time (default: end of the dataset)')
+    arg_parser.add_argument('-s', '--server', default=erddap.ERDDAP_SERVER, help='ERDDAP server url')
+    arg_parser.add_argument('-d', '--chunk-days', type=float, default=7, help='Number of days of data in each request')
+    arg_parser.add_argument('-w', '--workers', type=int, default=4, help='Number of concurrent downloads')
+    arg_parser.add_argument('-c', '--cache-dir', default=erddap.CACHE_DIR, help='Cache directory')
+    arg_parser.add_argument('--refresh-last', action='store_true',
+                            help='Get the dataset info again and download the chunks from the end of the previous '
+                                 'download on (for real-time datasets that are still growing)')
+
+    args = arg_parser.parse_args()
+    variables = args.variables if args.variables in erddap.ANALYSIS_VARIABLES else args.variables.split(',')
+    main(args.datasets, variables, args.start, args.end, args.server, args.chunk_days, args.workers, args.cache_dir,
+         args.refresh_last)
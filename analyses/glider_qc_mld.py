@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+Apply QC to glider data and calculate Mixed Layer Depth in one pass, writing one _qc_mld.nc file. This gives the same
+result as running glider_apply_qc.py and then calculate_mld.py on the _qc.nc file, without writing and re-reading the
+intermediate file (unless it's requested with save_intermediate).
+With derived=True, absolute salinity, conservative temperature and potential density are calculated with gsw after QC,
+e.g. to calculate MLD from potential density (mldvar = 'potential_density'). They're only calculated for each chunk of
+profiles as the MLD stage reads it, so the file is still read once.
+"""
+
+import pandas as pd
+import functions.common as cf
+import functions.pipeline as pipeline
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def main(fname, timevar, mldvar, zvar, save_intermediate, derived=False):
+    savefile = cf.output_file(fname, '_qc_mld.nc')
+    summaries = dict()
+
+    stages = [
+        pipeline.timeseries_stage(),
+        pipeline.qc_stage(summaries=summaries)
+    ]
+    if derived:
+        stages.append(pipeline.derived_stage(zvar=zvar, timevar=timevar, n2=False))
+    stages.append(pipeline.mld_stage(timevar, mldvar, zvar, summaries=summaries))
+    pipeline.run_pipeline(fname, stages, savefile, save_intermediate)
+    print(summaries['qc'])
+    print(summaries['mld'].T)
+
+    return savefile
+
+
+if __name__ == '__main__':
+    ncfile = '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/ru40-20230817T1522/delayed/ru40-20230817T1522-profile-sci-rt-slice.nc'
+    time_variable = 'profile_time'  # time variable on which groups are generated (e.g. profile_time)
+    mldvar = 'density'  # variable used to calculate MLD, e.g. 'density' or 'potential_density' (requires derived)
+    zvar = 'pressure'  # pressure variable
+    save_intermediate = False  # False or list of stages to also write to file, e.g. ['qc'] for the _qc.nc file
+    derived = False  # True to calculate absolute salinity, conservative temperature and potential density after QC
+    main(ncfile, time_variable, mldvar, zvar, save_intermediate, derived)
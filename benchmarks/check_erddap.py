@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Check the ERDDAP download client (functions/erddap.py) against a local stand-in ERDDAP server that serves a synthetic
+deployment (see synthetic.py) from the info and tabledap csv endpoints. The checks cover a full download, resuming
+after failed requests, a real-time dataset that grows between downloads (refresh_last), and later downloads with a
+different time range. The run exits with an error if any of the checks fail.
+Example:
+python check_erddap.py --profiles 200
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import functions.erddap as erddap
+from synthetic import synthetic_deployment
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+DATASET_ID = 'synthetic-profile-sci-rt'
+VARIABLES = ['time', 'profile_time', 'pressure', 'density', 'temperature', 'latitude', 'longitude']
+UNITS = dict(time='UTC', profile_time='UTC', pressure='dbar', density='kg m-3', temperature='degree_Celsius',
+             latitude='degrees_north', longitude='degrees_east')
+
+
+class StandInServer:
+    """
+    Local stand-in for an ERDDAP tabledap server with one dataset. The data available on the server end at
+    available_end (to mimic a real-time dataset that is still growing), and the first fail_requests data requests
+    return a server error (to mimic an interrupted download)
+    """
+    def __init__(self, df):
+        self.df = df
+        self.available_end = df.time.max()
+        self.fail_requests = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/erddap'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def data(self):
+        return self.df[self.df.time <= self.available_end]
+
+    def info_csv(self):
+        data = self.data()
+        rows = [('attribute', 'NC_GLOBAL', 'title', 'String', DATASET_ID),
+                ('attribute', 'NC_GLOBAL', 'time_coverage_start', 'String', f'{data.time.min():%Y-%m-%dT%H:%M:%SZ}'),
+                ('attribute', 'NC_GLOBAL', 'time_coverage_end', 'String', f'{data.time.max():%Y-%m-%dT%H:%M:%SZ}')]
+        for v in VARIABLES:
+            rows.append(('variable', v, '', 'double', ''))
+            rows.append(('attribute', v, 'units', 'String', UNITS[v]))
+        info = pd.DataFrame(rows, columns=['Row Type', 'Variable Name', 'Attribute Name', 'Data Type', 'Value'])
+        return info.to_csv(index=False)
+
+    def tabledap_csv(self, query):
+        """
+        :return: http status and csv of the requested variables in the time range, with the units in the second row
+        """
+        parts = urllib.parse.unquote(query).split('&')
+        variables = parts[0].split(',')
+        data = self.data()
+        for c in parts[1:]:
+            op = '>=' if '>=' in c else '<'
+            t = pd.Timestamp(float(c.split(op)[1]), unit='s')
+            data = data[data.time >= t] if op == '>=' else data[data.time < t]
+        if len(data) == 0:
+            return 404, 'Error {\n    code=404;\n    message="Not Found: Your query produced no matching results.";\n}\n'
+        data = data[variables].copy()
+        for v in ['time', 'profile_time']:
+            if v in data.columns:
+                data[v] = data[v].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+        units = pd.DataFrame([[UNITS[v] for v in variables]], columns=variables)
+        return 200, pd.concat([units, data]).to_csv(index=False, float_format='%.17g')
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == f'/erddap/info/{DATASET_ID}/index.csv':
+                    status, body = 200, server.info_csv()
+                elif path == f'/erddap/tabledap/{DATASET_ID}.csv':
+                    with server.lock:
+                        server.requests += 1
+                        fail = server.fail_requests > 0
+                        server.fail_requests -= 1 if fail else 0
+                    status, body = (500, 'Internal Server Error') if fail else server.tabledap_csv(query)
+                else:
+                    status, body = 404, 'Not Found'
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/csv')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def compare(cached, expected):
+    """
+    :return: True if the cached data are the same observations as the expected data, with no duplicate times
+    """
+    if len(cached) != len(expected) or cached.time.duplicated().any():
+        return False
+    cached = cached.reset_index(drop=True)
+    expected = expected.reset_index(drop=True)
+    return (np.array_equal(cached.time.values, expected.time.values) and
+            all(np.allclose(cached[v].values, expected[v].values, equal_nan=True)
+                for v in ['pressure', 'density', 'temperature']))
+
+
+def main(nprofiles=200, chunk_days=0.5, workers=4):
+    ds = synthetic_deployment(nprofiles=nprofiles)
+    df = ds[VARIABLES[1:]].to_dataframe().reset_index()[VARIABLES]
+    checks = dict()
+    with StandInServer(df) as server, tempfile.TemporaryDirectory() as cache_dir:
+        kwargs = dict(server=server.url, chunk_days=chunk_days, workers=workers, cache_dir=cache_dir, retries=1)
+
+        # interrupted download: the first requests fail, then running again only downloads the missing chunks
+        server.fail_requests = 2
+        path = erddap.fetch_deployment(DATASET_ID, 'mld', **kwargs)
+        nchunks = len(erddap.time_chunks(df.time.min(), df.time.max(), chunk_days))
+        requests = server.requests
+        erddap.fetch_deployment(DATASET_ID, 'mld', **kwargs)
+        checks['resume downloads only the failed chunks'] = server.requests - requests == 2
+        checks['full download == source'] = compare(erddap.read_cache(path), df)
+        requests = server.requests
+        erddap.fetch_deployment(DATASET_ID, 'mld', **kwargs)
+        checks['cached download makes no requests'] = server.requests == requests
+
+        # a later download with a different start and end reuses the cached chunks
+        erddap.fetch_deployment(DATASET_ID, 'mld', start=df.time.iloc[len(df) // 3], end=df.time.max(), **kwargs)
+        checks['different time range adds no chunks'] = (
+            len([f for f in os.listdir(path) if f.endswith('.parquet')]) == nchunks)
+
+    with StandInServer(df) as server, tempfile.TemporaryDirectory() as cache_dir:
+        kwargs = dict(server=server.url, chunk_days=chunk_days, workers=workers, cache_dir=cache_dir, retries=1)
+
+        # real-time dataset: the first download gets part of the deployment, the later ones get the rest
+        for end in [df.time.iloc[len(df) // 3], df.time.iloc[2 * len(df) // 3], df.time.max()]:
+            server.available_end = end
+            path = erddap.fetch_deployment(DATASET_ID, 'mld', refresh_last=True, **kwargs)
+        checks['growing dataset with refresh_last == source'] = compare(erddap.read_cache(path), df)
+
+        # chunks cached with a different chunk length overlap, read_cache keeps one row for each time
+        erddap.fetch_deployment(DATASET_ID, 'mld', **dict(kwargs, chunk_days=chunk_days * 3))
+        checks['overlapping chunks read without duplicates'] = compare(erddap.read_cache(path), df)
+
+        cached = erddap.open_cache(path)
+        checks['open_cache has the server attributes'] = (cached.attrs.get('title') == DATASET_ID and
+                                                          cached.pressure.attrs.get('units') == 'dbar')
+
+    for check, passed in checks.items():
+        print(f'{check}: {"ok" if passed else "FAILED"}')
+
+    return checks
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Check the ERDDAP client against a local stand-in server',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('-n', '--profiles', type=int, default=200, help='Number of profiles in the dataset')
+    arg_parser.add_argument('-d', '--chunk-days', type=float, default=0.5, help='Number of days of data in each request')
+    arg_parser.add_argument('-w', '--workers', type=int, default=4, help='Number of concurrent downloads')
+
+    args = arg_parser.parse_args()
+    checks = main(args.profiles, args.chunk_days, args.workers)
+    failed = [check for check, passed in checks.items() if not passed]
+    if failed:
+        sys.exit(f'failed checks: {", ".join(failed)}')
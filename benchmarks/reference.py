@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+
+"""
+Reference (per-profile) implementations of depth binning, MLD and QC, kept as the baseline that faster
+implementations are timed and checked against.
+"""
+import numpy as np
+import pandas as pd
+import functions.mixed_layer_depth as mldfunc
+
+
+def depth_bin(dataframe, depth_var='depth', depth_min=0, depth_max=None, stride=1):
+    """
+    pd.cut + groupby depth binning
+    """
+    depth_max = depth_max or dataframe[depth_var].max()
+
+    bins = np.arange(depth_min, depth_max+stride, stride)
+    cut = pd.cut(dataframe[depth_var], bins)
+    binned_df = dataframe.groupby(cut, observed=False).mean()
+    return binned_df
+
+
+def mld_by_profile(df, timevar='profile_time', mldvar='density', zvar='pressure'):
+    """
+    Calculate MLD one profile at a time with depth_bin and mixed_layer_depth.profile_mld
+    :param df: dataframe of the deployment
+    :return: dataframe indexed by profile with columns mld, max_n2 and qi
+    """
+    df = df[list(dict.fromkeys([timevar, 'pressure', zvar, mldvar, 'temperature']))].copy()
+    df.loc[df.pressure < 1, ['pressure', mldvar]] = np.nan
+    results = dict()
+    for profile, group in df.groupby(timevar, dropna=False):
+        temp_df = group[[mldvar, zvar, 'temperature']].dropna(how='all')
+        if len(temp_df) == 0 or temp_df[zvar].isna().all():
+            results[profile] = (np.nan, np.nan, np.nan)
+            continue
+        temp_df = depth_bin(temp_df, depth_var=zvar)
+        temp_df.dropna(subset=[mldvar], inplace=True)
+        temp_df.reset_index(drop=True, inplace=True)
+        if len(temp_df) == 0 or np.nanmax(temp_df[zvar]) - np.nanmin(temp_df[zvar]) < 5:
+            results[profile] = (np.nan, np.nan, np.nan)
+            continue
+        results[profile] = mldfunc.profile_mld(temp_df, zvar=zvar)
+
+    results = pd.DataFrame.from_dict(results, orient='index', columns=['mld', 'max_n2', 'qi'])
+    results.index.name = 'profile'
+    return results
+
+
+def apply_qc(ds):
+    """
+    Apply QC one flag variable and target variable at a time
+    """
+    ds = ds.copy(deep=True)
+    qcvars = [x for x in list(ds.data_vars) if '_qartod_summary_flag' in x]
+    for qv in qcvars:
+        if 'pressure' in qv:
+            continue
+        target_var = list([qv.split('_qartod_summary_flag')[0]])
+        if target_var[0] in ['conductivity', 'temperature']:
+            target_var.append('salinity')
+            target_var.append('density')
+        qc_idx = np.where(ds[qv].values == 4)[0]
+        if len(qc_idx) > 0:
+            for tv in target_var:
+                ds[tv][qc_idx] = np.nan
+
+    qcvars = [x for x in list(ds.data_vars) if '_hysteresis_test' in x]
+    for qv in qcvars:
+        target_var = list([qv.split('_hysteresis_test')[0]])
+        target_var.append('salinity')
+        target_var.append('density')
+        qc_idx = np.where(np.logical_or(ds[qv].values == 3, ds[qv].values == 4))[0]
+        if len(qc_idx) > 0:
+            for tv in target_var:
+                ds[tv][qc_idx] = np.nan
+
+    return ds
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the depth binning, MLD and QC code on synthetic glider deployments. Each function is timed (best and mean
+of several runs) and its peak memory is recorded with tracemalloc. The faster implementations are checked against the
+reference per-profile implementations in reference.py and against the saved MLD fixture in fixtures/, and the run
+exits with an error if any of the checks fail.
+Examples:
+python run_benchmarks.py --profiles 2000 --repeat 3 --report benchmarks.csv
+python run_benchmarks.py --make-fixture
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+import functions.common as cf
+import functions.mixed_layer_depth as mldfunc
+import functions.pipeline as pipeline
+import functions.qc as qc
+import reference
+from synthetic import synthetic_deployment
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+warnings.simplefilter('ignore', RuntimeWarning)  # nan slices in the per-profile reference MLD
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mld_reference_200profiles_seed0.csv')
+
+
+def measure(func, repeat):
+    """
+    :param func: function with no arguments
+    :param repeat: number of timed runs
+    :return: output of the function, best and mean run time (seconds) and peak memory (MB)
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    return output, np.min(times), np.mean(times), peak
+
+
+def mld_batch(df, backend='numpy', return_bins=False):
+    df = df[['profile_time', 'pressure', 'density']].copy()
+    df.loc[df.pressure < 1, ['pressure', 'density']] = np.nan
+    return mldfunc.profile_mld_batch(df.profile_time.values, df.pressure.values, df.density.values, backend=backend,
+                                     return_bins=return_bins)
+
+
+def kernel_matches_segments(df, qi_thresholds=(0.5, 0.8, None)):
+    """
+    Run the MLD loop kernel (compiled when numba is installed, otherwise as plain python) and the segmented numpy
+    checks on the same binned profiles, so the kernel is checked whether or not numba is installed
+    :return: True if the kernel and the numpy checks give the same mld, max_n2, qi, reason codes and N**2
+    """
+    _, bins = mld_batch(df, return_bins=True)
+    codes = pd.factorize(bins.profile)[0]
+    z = bins.pressure.values.astype('float64')
+    rho = bins['values'].values.astype('float64')
+    seg = mldfunc._segment_starts(codes)
+    nbins = np.diff(np.append(seg, len(z)))
+    for qi_threshold in qi_thresholds:
+        kernel = mldfunc._mld_kernel(z, rho, seg, nbins, float(qi_threshold or 0), bool(qi_threshold))
+        segments = mldfunc._mld_segments(z, rho, seg, nbins, qi_threshold)
+        if not all(np.allclose(k, s, rtol=1e-9, equal_nan=True) for k, s in zip(kernel, segments)):
+            return False
+
+    return True
+
+
+def bin_by_profile(df, binfunc):
+    return [binfunc(g[['pressure', 'density']], depth_var='pressure') for _, g in df.groupby('profile_time')]
+
+
+def end_to_end(fname, savefile):
+    stages = [pipeline.qc_stage(), pipeline.mld_stage()]
+    pipeline.run_pipeline(fname, stages, savefile)
+
+
+def compare_mld(results, expected):
+    """
+    :return: True if the MLD results match the expected results to floating point rounding
+    """
+    if len(results) != len(expected):
+        return False
+    return all(np.allclose(results[c].values.astype(float), expected[c].values.astype(float), rtol=1e-9,
+                           equal_nan=True) for c in ['mld', 'max_n2', 'qi'])
+
+
+def make_fixture():
+    ds = synthetic_deployment(nprofiles=200, seed=0)
+    results = reference.mld_by_profile(ds.to_dataframe())
+    os.makedirs(os.path.dirname(FIXTURE), exist_ok=True)
+    results.to_csv(FIXTURE)
+    print(f'Saved {FIXTURE}')
+
+
+def main(nprofiles, repeat, seed, report=None):
+    ds = synthetic_deployment(nprofiles=nprofiles, seed=seed)
+    df = ds.to_dataframe()
+    print(f'Synthetic deployment: {nprofiles} profiles, {len(df)} observations')
+
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'synthetic.nc')
+    ds.to_netcdf(fname)
+
+    cases = [
+        ('depth_bin reference (pd.cut, per profile)', lambda: bin_by_profile(df, reference.depth_bin)),
+        ('depth_bin (per profile)', lambda: bin_by_profile(df, cf.depth_bin)),
+        ('depth_bin (stacked profiles)', lambda: cf.depth_bin(df[['profile_time', 'pressure', 'density']],
+                                                              depth_var='pressure', profile_var='profile_time')),
+        ('mld reference (per profile)', lambda: reference.mld_by_profile(df)),
+        ('mld profile_mld_batch', lambda: mld_batch(df)),
+        ('mld profile_mld_batch (numba)', lambda: mld_batch(df, 'numba')),
+        ('qc reference (per variable)', lambda: reference.apply_qc(ds)),
+        ('qc apply_qc', lambda: qc.apply_qc(ds.copy(deep=True))[0]),
+        ('end-to-end qc + mld pipeline', lambda: end_to_end(fname, os.path.join(tmpdir, 'synthetic_qc_mld.nc')))
+    ]
+    if mldfunc.numba is None:
+        cases = [c for c in cases if 'numba' not in c[0]]
+        print('numba is not installed, skipping the numba MLD benchmark')
+
+    rows = []
+    outputs = dict()
+    for name, func in cases:
+        outputs[name], best, mean, peak = measure(func, repeat)
+        rows.append(dict(benchmark=name, best_s=best, mean_s=mean, peak_mb=peak))
+        print(f'{name}: best {best:.4f} s, mean {mean:.4f} s, peak memory {peak:.1f} MB')
+    summary = pd.DataFrame(rows)
+
+    # check the faster implementations against the reference implementations
+    checks = dict()
+    checks['mld batch == reference'] = compare_mld(outputs['mld profile_mld_batch'],
+                                                   outputs['mld reference (per profile)'])
+    if 'mld profile_mld_batch (numba)' in outputs:
+        checks['mld numba == numpy'] = compare_mld(outputs['mld profile_mld_batch (numba)'],
+                                                   outputs['mld profile_mld_batch'])
+    kernel = 'compiled' if mldfunc.numba else 'python'
+    checks[f'mld loop kernel ({kernel}) == numpy segments'] = kernel_matches_segments(df)
+    stacked = outputs['depth_bin (stacked profiles)'].density.values
+    per_profile = np.concatenate([b.density.values for b in outputs['depth_bin reference (pd.cut, per profile)']])
+    checks['depth_bin stacked == reference'] = np.allclose(stacked, per_profile, equal_nan=True)
+    qc_ds = outputs['qc apply_qc']
+    qc_ref = outputs['qc reference (per variable)']
+    checks['apply_qc == reference'] = all(qc_ds[v].equals(qc_ref[v]) for v in qc_ref.data_vars)
+    if os.path.isfile(FIXTURE):
+        expected = pd.read_csv(FIXTURE, index_col='profile', parse_dates=['profile'])
+        fixture_df = synthetic_deployment(nprofiles=200, seed=0).to_dataframe()
+        checks['mld batch == fixture'] = compare_mld(mld_batch(fixture_df), expected)
+    for check, passed in checks.items():
+        print(f'{check}: {"ok" if passed else "FAILED"}')
+
+    if report:
+        summary.to_csv(report, index=False)
+
+    return summary, checks
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark depth binning, MLD and QC on synthetic deployments',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('-n', '--profiles', type=int, default=500, help='Number of profiles')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of timed runs for each benchmark')
+    arg_parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+    arg_parser.add_argument('--report', default=None, help='Optional csv file for the timing results')
+    arg_parser.add_argument('--make-fixture', action='store_true',
+                            help='Save the reference MLD results used to check faster implementations')
+
+    args = arg_parser.parse_args()
+    if args.make_fixture:
+        make_fixture()
+    else:
+        summary, checks = main(args.profiles, args.repeat, args.seed, args.report)
+        failed = [check for check, passed in checks.items() if not passed]
+        if failed:
+            sys.exit(f'failed checks: {", ".join(failed)}')
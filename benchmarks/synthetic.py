@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+
+"""
+Generate synthetic glider deployments for benchmarking and checking the MLD, binning and QC code. Each profile has a
+sigmoid density profile with a random mixed layer depth, and the number of profiles, depth range, noise, data gaps and
+QC flag rates can be changed.
+"""
+import numpy as np
+import xarray as xr
+
+
+def synthetic_deployment(nprofiles=500, depth_range=(10, 80), obs_per_dbar=4, noise=0.01, gap_rate=0.1,
+                         qc_fail_rate=0.02, hysteresis_rate=0.02, seed=0):
+    """
+    :param nprofiles: number of profiles
+    :param depth_range: range of maximum profile depths (dbar)
+    :param obs_per_dbar: average number of observations per dbar
+    :param noise: standard deviation of the noise added to density (kg m-3)
+    :param gap_rate: fraction of profiles with a data gap
+    :param qc_fail_rate: fraction of observations flagged as QARTOD 4/FAIL for each variable
+    :param hysteresis_rate: fraction of observations flagged as 3/SUSPECT or 4/FAIL by the CTD hysteresis tests
+    :param seed: random seed
+    :return: xarray dataset with 'time' as the dimension, sorted by time
+    """
+    rng = np.random.default_rng(seed)
+    t0 = np.datetime64('2023-08-17T00:00:00', 'ns')
+    data = dict(time=[], profile_time=[], pressure=[], density=[], temperature=[])
+    for i in range(nprofiles):
+        depth = rng.uniform(*depth_range)
+        n = rng.poisson(depth * obs_per_dbar)
+        p = np.sort(rng.uniform(0, depth, n))
+        if rng.random() < gap_rate:
+            gap_start = rng.uniform(0, depth)
+            p = p[~((p > gap_start) & (p < gap_start + rng.uniform(5, 40)))]
+        mld = rng.uniform(2, depth)
+        sharpness = rng.uniform(0.3, 5)
+        rho = 1021 + 3 / (1 + np.exp(-(p - mld) / sharpness)) + rng.normal(0, noise, len(p))
+        temp = 24 - 12 / (1 + np.exp(-(p - mld) / sharpness)) + rng.normal(0, noise * 10, len(p))
+        profile_time = t0 + np.timedelta64(i * 1200, 's')
+        data['time'].append(profile_time + (np.arange(len(p)) * 2e9).astype('timedelta64[ns]'))
+        data['profile_time'].append(np.repeat(profile_time, len(p)))
+        data['pressure'].append(p)
+        data['density'].append(rho)
+        data['temperature'].append(temp)
+    data = {k: np.concatenate(v) for k, v in data.items()}
+    n = len(data['time'])
+
+    ds = xr.Dataset({k: ('time', v) for k, v in data.items() if k != 'time'}, coords=dict(time=('time', data['time'])))
+    ds['conductivity'] = ('time', 4 + (ds.temperature.values - 15) / 10)
+    ds['salinity'] = ('time', 32 + (ds.density.values - 1021))
+    ds['latitude'] = ('time', np.linspace(39.5, 40, n))
+    ds['longitude'] = ('time', np.linspace(-74, -73, n))
+    for v in ['conductivity', 'temperature', 'salinity', 'density', 'pressure']:
+        flags = np.ones(n, dtype='int8')
+        flags[rng.random(n) < qc_fail_rate] = 4
+        ds[f'{v}_qartod_summary_flag'] = ('time', flags)
+    for v in ['conductivity', 'temperature']:
+        flags = np.ones(n, dtype='int8')
+        mask = rng.random(n) < hysteresis_rate
+        flags[mask] = rng.choice([3, 4], mask.sum())
+        ds[f'{v}_hysteresis_test'] = ('time', flags)
+
+    ds.pressure.attrs['units'] = 'dbar'
+    ds.density.attrs['units'] = 'kg m-3'
+    ds.attrs['title'] = f'synthetic-{nprofiles}-{seed}'
+
+    return ds
+
+
+def synthetic_dataframe(**kwargs):
+    """
+    :return: the synthetic deployment as a pandas dataframe indexed by time
+    """
+    return synthetic_deployment(**kwargs).to_dataframe()
@@ -1,4 +1,14 @@
+from . import alignment
+from . import bathymetry
+from . import catalog
 from . import common
+from . import derived
+from . import events
+from . import gridded
 from . import mixed_layer_depth
 from . import oxy_colormap_mods
+from . import pipeline
 from . import plotting
+from . import profile_plots
+from . import qc
+from . import ragged
@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+
+"""
+Work with data from multiple glider deployments without merging them into one wide table. Each deployment is kept in
+its own dataframe sorted by time, and data are matched in time only when they're needed: by a merge of the sorted
+times of all deployments, or by nearest-time matching (like pd.merge_asof) within a tolerance. Times without a match
+are nan, never filled with a value.
+"""
+import os
+import numpy as np
+import pandas as pd
+import functions.common as cf
+
+
+def load_deployments(flist, variables, names=None, start=None, end=None):
+    """
+    Read the data from multiple deployments
+    :param flist: list of deployment NetCDF files, deployment directories of a partitioned Parquet dataset (see
+    columnar.convert) or ERDDAP cache directories
+    :param variables: list of variables to read (variables that aren't in a file are skipped)
+    :param names: optional list of names for the deployments, default is the trajectory in each file (or the
+    deployment name for Parquet and ERDDAP cache directories, or the file name if the file doesn't have a trajectory)
+    :param start: optional start time, only data from this time on are returned
+    :param end: optional end time (included)
+    :return: dictionary of deployment name: dataframe indexed by time (sorted), without rows that have no data
+    """
+    deployments = dict()
+    for i, f in enumerate(flist):
+        partition = os.path.basename(os.path.normpath(f)).startswith('deployment=')
+        if partition:
+            # only the days in the time window are read from Parquet (pyarrow is only needed for Parquet deployments)
+            import functions.columnar as columnar
+            ds = columnar.open_partition(f, ['time'] + variables, start=start, end=end)
+        else:
+            ds = cf.open_deployment(f, ['trajectory', 'time'] + variables)
+        if names:
+            deploy = names[i]
+        elif 'trajectory' in ds.variables:
+            deploy = str(ds.trajectory.values.ravel()[0])
+        elif partition:
+            deploy = os.path.basename(os.path.normpath(f)).split('deployment=', 1)[1]
+        elif os.path.isdir(f):
+            deploy = os.path.basename(os.path.dirname(os.path.normpath(f)))  # ERDDAP dataset ID of a cache directory
+        else:
+            deploy = os.path.basename(f).split('.nc')[0]
+        df = pd.DataFrame({v: ds[v].values for v in variables if v in ds.data_vars}, index=ds.time.values)
+        df.index.name = 'time'
+        df = df.dropna(how='all').sort_index(kind='stable')
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df.index <= pd.Timestamp(end)]
+        deployments[deploy] = df
+
+    return deployments
+
+
+def decimate(df, minutes=None, group_var=None):
+    """
+    Reduce the number of observations in a deployment, e.g. for plotting tracks
+    :param df: dataframe indexed by time (sorted)
+    :param minutes: optional, keep the first observation in each N minute interval
+    :param group_var: optional, keep the first observation for each value of this variable (e.g. 'profile_time' for
+    one position per profile)
+    :return: decimated dataframe
+    """
+    keep = np.ones(len(df), dtype=bool)
+    if group_var:
+        values = df[group_var].values
+        keep &= np.concatenate(([True], values[1:] != values[:-1]))
+    if minutes:
+        bins = df.index.values.astype('datetime64[m]').astype('int64') // int(minutes)
+        keep &= np.concatenate(([True], bins[1:] != bins[:-1]))
+
+    return df[keep]
+
+
+def time_range(deployments):
+    """
+    :param deployments: dictionary of deployment name: dataframe indexed by time
+    :return: first and last time of all of the deployments
+    """
+    starts = [df.index[0] for df in deployments.values() if len(df) > 0]
+    ends = [df.index[-1] for df in deployments.values() if len(df) > 0]
+
+    return min(starts), max(ends)
+
+
+def merged_times(deployments):
+    """
+    Merge the sorted times of all of the deployments
+    :param deployments: dictionary of deployment name: dataframe indexed by time (sorted)
+    :return: sorted array of the unique times from all of the deployments
+    """
+    return np.unique(np.concatenate([df.index.values for df in deployments.values()]))
+
+
+def nearest_index(times, target, tolerance=None, direction='nearest'):
+    """
+    Find the observation closest in time to each target time, the same as pd.merge_asof
+    :param times: sorted array of observation times
+    :param target: array of times to match
+    :param tolerance: optional maximum time difference (e.g. np.timedelta64(5, 'm') or pd.Timedelta('5min'))
+    :param direction: 'nearest', 'backward' (last observation at or before the target) or 'forward' (first observation
+    at or after the target)
+    :return: index of the matching observation for each target time, -1 where there isn't a match
+    """
+    times = np.asarray(times)
+    target = np.asarray(target)
+    idx = np.full(len(target), -1, dtype='int64')
+    if len(times) == 0:
+        return idx
+
+    after = np.searchsorted(times, target, side='left')
+    before = np.searchsorted(times, target, side='right') - 1
+    has_before = before >= 0
+    has_after = after < len(times)
+    if direction == 'backward':
+        idx[has_before] = before[has_before]
+    elif direction == 'forward':
+        idx[has_after] = after[has_after]
+    elif direction == 'nearest':
+        # ties go to the earlier observation, like pd.merge_asof
+        dt_before = np.where(has_before, target - times[np.clip(before, 0, None)], np.timedelta64('NaT'))
+        dt_after = np.where(has_after, times[np.clip(after, None, len(times) - 1)] - target, np.timedelta64('NaT'))
+        use_after = has_after & (~has_before | (dt_after < dt_before))
+        idx[has_before] = before[has_before]
+        idx[use_after] = after[use_after]
+    else:
+        raise ValueError(f'Unknown direction: {direction}')
+
+    if tolerance is not None:
+        matched = idx >= 0
+        dt = np.abs(times[idx[matched]] - target[matched])
+        idx[np.flatnonzero(matched)[dt > np.timedelta64(pd.Timedelta(tolerance))]] = -1
+
+    return idx
+
+
+def align(deployments, times=None, tolerance=None, direction='nearest', variables=None):
+    """
+    Match the data from each deployment to a common set of times
+    :param deployments: dictionary of deployment name: dataframe indexed by time (sorted)
+    :param times: times to align the data to, default is the merged times of all of the deployments (in which case
+    only exact time matches are used unless a tolerance is given)
+    :param tolerance: optional maximum time difference for a match, default is no limit when times are provided
+    :param direction: 'nearest', 'backward' or 'forward', see nearest_index
+    :param variables: optional list of variables to align, default is all of them
+    :return: dictionary of deployment name: dataframe indexed by the common times, nan where there isn't a match
+    """
+    if times is None:
+        times = merged_times(deployments)
+        if tolerance is None:
+            tolerance = np.timedelta64(0, 'ns')
+    times = np.asarray(times)
+
+    aligned = dict()
+    for deploy, df in deployments.items():
+        cols = [v for v in (variables or df.columns) if v in df.columns]
+        idx = nearest_index(df.index.values, times, tolerance, direction)
+        matched = idx >= 0
+        data = dict()
+        for v in cols:
+            values = df[v].values
+            if np.issubdtype(values.dtype, np.integer) or values.dtype == bool:
+                values = values.astype('float64')
+            out = np.full(len(times), np.nan, dtype=values.dtype) if values.dtype.kind == 'f' else \
+                np.full(len(times), None, dtype=object)
+            out[matched] = values[idx[matched]]
+            data[v] = out
+        aligned[deploy] = pd.DataFrame(data, index=pd.Index(times, name='time'))
+
+    return aligned
+
+
+def to_wide(aligned):
+    """
+    Combine aligned deployments into one dataframe
+    :param aligned: dictionary of deployment name: dataframe from align
+    :return: dataframe indexed by time with (deployment, variable) columns
+    """
+    return pd.concat(aligned, axis=1)
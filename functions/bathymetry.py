@@ -0,0 +1,168 @@
+#! /usr/bin/env python3
+
+"""
+Bathymetry for map plots. The subset of the GEBCO file for a map extent (optionally coarsened to the map resolution)
+and the contours calculated from it are cached on disk, so maps of the same region don't read the full GEBCO file or
+calculate the contours again. The cache is limited in size and the least recently used files are removed first.
+"""
+import os
+import json
+import pickle
+import hashlib
+import functools
+import numpy as np
+import xarray as xr
+import contourpy
+import matplotlib.contour as mcontour
+import cmocean as cmo
+
+BATHYMETRY_FILE = '/Users/garzio/Documents/rucool/bathymetry/GEBCO_2014_2D_-100.0_0.0_-10.0_50.0.nc'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gliders_cache', 'bathymetry')
+
+
+def cache_key(*args):
+    """
+    :return: hash of the arguments, which must be json serializable
+    """
+    return hashlib.sha1(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()[0:16]
+
+
+def source_id(fname):
+    """
+    :return: file name, size and modification time of the bathymetry file (hashing the contents of the full GEBCO file
+    would take longer than reading the subset)
+    """
+    stat = os.stat(fname)
+    return [os.path.abspath(fname), stat.st_size, int(stat.st_mtime)]
+
+
+def evict(cache_dir=CACHE_DIR, max_mb=500):
+    """
+    Remove the least recently used files from the cache until the cache is smaller than max_mb
+    :param cache_dir: cache directory
+    :param max_mb: maximum size of the cache in MB
+    """
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)]
+    files = sorted([f for f in files if os.path.isfile(f)], key=os.path.getmtime)
+    size = sum(os.path.getsize(f) for f in files)
+    while files and size > max_mb * 2**20:
+        f = files.pop(0)
+        size -= os.path.getsize(f)
+        os.remove(f)
+
+
+def _touch(fname):
+    # the modification time of a cached file is used as the last time it was used
+    os.utime(fname)
+
+
+@functools.lru_cache(maxsize=16)
+def subset(extent, fname=BATHYMETRY_FILE, buffer=.1, resolution=None, cache_dir=CACHE_DIR, max_mb=500):
+    """
+    Bathymetry for a map extent. Subsets are also kept in memory, so don't modify the returned dataset.
+    :param extent: tuple of map limits (lon min, lon max, lat min, lat max)
+    :param fname: bathymetry NetCDF file with lon, lat and elevation
+    :param buffer: degrees added around the extent
+    :param resolution: optional grid spacing in degrees. The bathymetry is coarsened (averaged) when the file has a
+    finer resolution, e.g. to match the resolution of the output map
+    :param cache_dir: cache directory, None to not use the disk cache
+    :param max_mb: maximum size of the disk cache in MB
+    :return: xarray dataset with lon, lat and elevation
+    """
+    if cache_dir:
+        key = cache_key(source_id(fname), list(extent), buffer, resolution)
+        cache_file = os.path.join(cache_dir, f'bathymetry_{key}.nc')
+        if os.path.isfile(cache_file):
+            _touch(cache_file)
+            with xr.open_dataset(cache_file) as ds:
+                return ds.load()
+
+    with xr.open_dataset(fname) as ds:
+        bathy = ds[['elevation']].sel(lon=slice(extent[0] - buffer, extent[1] + buffer),
+                                      lat=slice(extent[2] - buffer, extent[3] + buffer)).load()
+
+    if resolution and len(bathy.lon) > 1:
+        factor = int(resolution // np.abs(np.diff(bathy.lon.values[0:2])[0]))
+        if factor > 1:
+            bathy = bathy.coarsen(lon=factor, lat=factor, boundary='trim').mean()
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        bathy.to_netcdf(cache_file, encoding={'elevation': dict(zlib=True)})
+        evict(cache_dir, max_mb)
+
+    return bathy
+
+
+@functools.lru_cache(maxsize=32)
+def contours(extent, levels, filled=True, fname=BATHYMETRY_FILE, buffer=.1, resolution=None, cache_dir=CACHE_DIR,
+             max_mb=500):
+    """
+    Calculate bathymetry contours with contourpy (the same contouring matplotlib uses)
+    :param extent: tuple of map limits (lon min, lon max, lat min, lat max)
+    :param levels: tuple of contour levels
+    :param filled: True for filled contours (contourf), False for contour lines (contour)
+    :return: tuple of (levels, list of polygons/lines for each level, list of path codes for each level) that can be
+    drawn with matplotlib.contour.ContourSet
+    """
+    if cache_dir:
+        key = cache_key(source_id(fname), list(extent), list(levels), filled, buffer, resolution)
+        cache_file = os.path.join(cache_dir, f'contours_{key}.pkl')
+        if os.path.isfile(cache_file):
+            _touch(cache_file)
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+
+    bathy = subset(extent, fname, buffer, resolution, cache_dir, max_mb)
+    elev = np.ma.masked_invalid(bathy.elevation.values)
+    if filled:
+        gen = contourpy.contour_generator(bathy.lon.values, bathy.lat.values, elev,
+                                          fill_type=contourpy.FillType.OuterCode)
+        paths = [gen.filled(lower, upper) for lower, upper in zip(levels[:-1], levels[1:])]
+    else:
+        gen = contourpy.contour_generator(bathy.lon.values, bathy.lat.values, elev,
+                                          line_type=contourpy.LineType.SeparateCode)
+        paths = [gen.lines(level) for level in levels]
+    result = (levels, [p[0] for p in paths], [p[1] for p in paths])
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(result, f)
+        evict(cache_dir, max_mb)
+
+    return result
+
+
+def add_bathymetry(ax, extent, fill_levels=np.arange(-5000, 5100, 50), line_levels=np.arange(-100, 0, 50),
+                   label_levels=(-100,), cmap=cmo.cm.topo, transform=None, **kwargs):
+    """
+    Add filled bathymetry contours and labeled contour lines to a map using the cached contours
+    :param ax: map axis
+    :param extent: map limits [lon min, lon max, lat min, lat max]
+    :param fill_levels: levels for the filled contours, None to not plot filled contours
+    :param line_levels: levels for the contour lines, None to not plot contour lines
+    :param label_levels: contour lines that are labeled
+    :param cmap: colormap for the filled contours
+    :param transform: coordinate system of the bathymetry (e.g. ccrs.PlateCarree()) for cartopy maps
+    :param kwargs: arguments for subset (fname, buffer, resolution, cache_dir, max_mb)
+    :return: the filled contours and the contour lines
+    """
+    extent = tuple(float(e) for e in extent)
+    kw = dict(transform=transform) if transform else dict()
+    filled = None
+    lines = None
+    # ContourSet can't be created without any contours, e.g. when the map doesn't include any of the levels
+    if fill_levels is not None:
+        levels, allsegs, allkinds = contours(extent, tuple(fill_levels), True, **kwargs)
+        if any(len(segs) > 0 for segs in allsegs):
+            filled = mcontour.ContourSet(ax, levels, allsegs, allkinds, filled=True, cmap=cmap, **kw)
+    if line_levels is not None:
+        levels, allsegs, allkinds = contours(extent, tuple(line_levels), False, **kwargs)
+        if any(len(segs) > 0 for segs in allsegs):
+            lines = mcontour.ContourSet(ax, levels, allsegs, allkinds, linewidths=.75, alpha=.5, colors='k', **kw)
+            labels = [lev for lev in label_levels if lev in levels]
+            if labels:
+                ax.clabel(lines, labels, inline=True, fontsize=7, fmt='%d')
+
+    return filled, lines
@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+
+"""
+Catalog of glider deployment files, saved to an indexed SQLite database. Each file is opened once to summarize it
+(deployment, time range, bounding box, variables, number of profiles), and the file size, modification time and a quick
+hash are saved so the next scan only opens files that are new or changed. A file that was modified but has the same
+quick hash (e.g. values rewritten in the middle of the file) is checked with a hash of the whole file. Maps and
+cross-sections can then find the deployments in an extent and time window from the catalog instead of opening every
+file.
+"""
+import os
+import glob
+import hashlib
+import contextlib
+import sqlite3
+import numpy as np
+import pandas as pd
+import xarray as xr
+import functions.common as cf
+
+CATALOG_COLUMNS = ['path', 'deployment', 'start_time', 'end_time', 'lon_min', 'lon_max', 'lat_min', 'lat_max', 'n_obs',
+                   'n_profiles', 'variables', 'size', 'mtime', 'hash', 'full_hash']
+
+# files written by the analysis scripts next to the deployment files
+EXCLUDE = ['_mld.nc', '_mld_profiles.nc', '_qc.nc', '_timeseries.nc', '_derived.nc']
+
+
+def _create(con):
+    con.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, deployment TEXT, start_time TEXT, '
+                'end_time TEXT, lon_min REAL, lon_max REAL, lat_min REAL, lat_max REAL, n_obs INTEGER, '
+                'n_profiles INTEGER, variables TEXT, size INTEGER, mtime REAL, hash TEXT, full_hash TEXT)')
+    if 'full_hash' not in [row[1] for row in con.execute('PRAGMA table_info(files)')]:
+        con.execute('ALTER TABLE files ADD COLUMN full_hash TEXT')  # catalogs made before full hashes were saved
+    con.execute('CREATE TABLE IF NOT EXISTS file_variables (path TEXT, variable TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_files_time ON files (start_time, end_time)')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_files_location ON files (lon_min, lon_max, lat_min, lat_max)')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_files_deployment ON files (deployment)')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_file_variables ON file_variables (variable, path)')
+
+
+def find_files(paths, pattern='*.nc', exclude=None):
+    """
+    Find the deployment files in directories (searched recursively) and lists of files
+    :param paths: directory, file, or list of directories and files
+    :param pattern: file name pattern in the directories
+    :param exclude: optional list of file name endings to skip, default is EXCLUDE (analysis output files)
+    :return: sorted list of absolute file paths
+    """
+    exclude = EXCLUDE if exclude is None else exclude
+    files = []
+    for p in [paths] if isinstance(paths, str) else paths:
+        if os.path.isdir(p):
+            files.extend(glob.glob(os.path.join(p, '**', pattern), recursive=True))
+        else:
+            files.append(p)
+    files = [os.path.abspath(f) for f in files if not any(f.endswith(e) for e in exclude)]
+
+    return sorted(set(files))
+
+
+def quick_hash(fname, nbytes=1048576):
+    """
+    Quick hash of a file from its size and the first and last nbytes, so large files aren't read completely. Changes
+    in the middle of the file aren't detected, see common.file_hash for a hash of the whole file
+    :return: hex digest
+    """
+    size = os.path.getsize(fname)
+    h = hashlib.sha1(str(size).encode())
+    with open(fname, 'rb') as f:
+        h.update(f.read(nbytes))
+        if size > nbytes:
+            f.seek(max(nbytes, size - nbytes))
+            h.update(f.read(nbytes))
+
+    return h.hexdigest()
+
+
+def _minmax(values):
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return None, None
+    return float(values.min()), float(values.max())
+
+
+def summarize_file(fname):
+    """
+    Summarize one deployment file, only the time, location and profile variables are read
+    :param fname: deployment NetCDF file
+    :return: dictionary with the catalog columns (except size, mtime and hash)
+    """
+    with xr.open_dataset(fname) as ds:
+        if 'trajectory' in ds.variables:
+            deploy = str(ds.trajectory.values.ravel()[0])
+        else:
+            deploy = os.path.basename(fname).split('.nc')[0]
+        variables = [v for v in ds.variables if v not in ds.dims]
+
+        time = pd.to_datetime(ds.time.values.ravel()) if 'time' in ds.variables else pd.DatetimeIndex([])
+        time = time[time.notna()]
+        lon = _minmax(ds.longitude.values.ravel().astype('float64')) if 'longitude' in ds.variables else (None, None)
+        lat = _minmax(ds.latitude.values.ravel().astype('float64')) if 'latitude' in ds.variables else (None, None)
+        if 'profile_time' in ds.variables:
+            n_profiles = int(pd.Series(ds.profile_time.values.ravel()).dropna().nunique())
+        elif 'rowSize' in ds.variables:
+            n_profiles = int(ds.rowSize.size)
+        else:
+            n_profiles = None
+
+    return dict(path=os.path.abspath(fname), deployment=deploy,
+                start_time=str(time.min()) if len(time) else None,
+                end_time=str(time.max()) if len(time) else None,
+                lon_min=lon[0], lon_max=lon[1], lat_min=lat[0], lat_max=lat[1], n_obs=int(len(time)),
+                n_profiles=n_profiles, variables=','.join(variables))
+
+
+def scan(paths, dbfile, pattern='*.nc', exclude=None, prune=True):
+    """
+    Add deployment files to the catalog, or update them. Files with the same size and modification time as in the
+    catalog aren't opened. When the modification time changed but the quick hash is the same, the whole file is hashed
+    and files that were only touched (same full hash) aren't summarized again.
+    :param paths: directory, file, or list of directories and files (see find_files)
+    :param dbfile: catalog database file
+    :param pattern: file name pattern in the directories
+    :param exclude: optional list of file name endings to skip, default is EXCLUDE
+    :param prune: True to remove files from the catalog that are in the scanned directories but no longer exist
+    :return: list of the files found
+    """
+    files = find_files(paths, pattern, exclude)
+    with contextlib.closing(sqlite3.connect(dbfile)) as con, con:
+        _create(con)
+        known = {row[0]: row[1:] for row in con.execute('SELECT path, size, mtime, hash, full_hash FROM files')}
+
+        updated = 0
+        for f in files:
+            stat = os.stat(f)
+            if f in known and known[f][0] == stat.st_size and known[f][1] == stat.st_mtime:
+                continue
+            fhash = quick_hash(f)
+            full_hash = None
+            if f in known and known[f][2] == fhash:
+                # the quick hash doesn't cover the middle of the file, so the whole file is compared
+                full_hash = cf.file_hash(f)
+                if known[f][3] == full_hash:
+                    con.execute('UPDATE files SET size = ?, mtime = ? WHERE path = ?',
+                                (stat.st_size, stat.st_mtime, f))
+                    continue
+            try:
+                summary = summarize_file(f)
+            except Exception as e:
+                print(f'{f}: {e}')
+                continue
+            summary.update(size=stat.st_size, mtime=stat.st_mtime, hash=fhash, full_hash=full_hash)
+            con.execute(f'INSERT OR REPLACE INTO files ({", ".join(CATALOG_COLUMNS)}) '
+                        f'VALUES ({",".join("?" * len(CATALOG_COLUMNS))})',
+                        [summary[c] for c in CATALOG_COLUMNS])
+            con.execute('DELETE FROM file_variables WHERE path = ?', (f,))
+            con.executemany('INSERT INTO file_variables VALUES (?, ?)',
+                            [(f, v) for v in summary['variables'].split(',') if v])
+            updated += 1
+
+        removed = 0
+        if prune:
+            dirs = [os.path.abspath(p) for p in ([paths] if isinstance(paths, str) else paths) if os.path.isdir(p)]
+            found = set(files)
+            gone = [p for p in known if p not in found and any(p.startswith(d + os.sep) for d in dirs)]
+            for p in gone:
+                con.execute('DELETE FROM files WHERE path = ?', (p,))
+                con.execute('DELETE FROM file_variables WHERE path = ?', (p,))
+            removed = len(gone)
+
+    print(f'{dbfile}: {len(files)} files, {updated} added or updated, {removed} removed')
+
+    return files
+
+
+def _where(deployment=None, start=None, end=None, extent=None, variables=None):
+    """
+    :return: SQL conditions on the files table and the query parameters
+    """
+    conditions = []
+    params = []
+    if deployment:
+        conditions.append('deployment = ?')
+        params.append(deployment)
+    if start:
+        conditions.append('end_time >= ?')
+        params.append(str(pd.Timestamp(start)))
+    if end:
+        conditions.append('start_time <= ?')
+        params.append(str(pd.Timestamp(end)))
+    if extent:
+        conditions.append('lon_max >= ? AND lon_min <= ? AND lat_max >= ? AND lat_min <= ?')
+        params.extend(extent)
+    for v in variables or []:
+        conditions.append('path IN (SELECT path FROM file_variables WHERE variable = ?)')
+        params.append(v)
+
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def query(dbfile, deployment=None, start=None, end=None, extent=None, variables=None):
+    """
+    Get the files in the catalog that match the criteria
+    :param dbfile: catalog database file
+    :param deployment: optional deployment name
+    :param start: optional, files with data after this time
+    :param end: optional, files with data before this time
+    :param extent: optional map limits [lon min, lon max, lat min, lat max], files with a bounding box that overlaps
+    the extent
+    :param variables: optional list of variables that the files must have
+    :return: dataframe of files
+    """
+    where, params = _where(deployment, start, end, extent, variables)
+    with contextlib.closing(sqlite3.connect(dbfile)) as con, con:
+        files = pd.read_sql(f'SELECT * FROM files{where} ORDER BY deployment, path', con, params=params,
+                            parse_dates=['start_time', 'end_time'])
+
+    return files
+
+
+def select(dbfile, paths, extent=None, start=None, end=None, variables=None):
+    """
+    Update the catalog for the files and return the ones in the extent and time window, without opening the files
+    that haven't changed since the last scan
+    :param dbfile: catalog database file
+    :param paths: directory, file, or list of directories and files (see find_files)
+    :param extent: optional map limits [lon min, lon max, lat min, lat max]
+    :param start: optional start time
+    :param end: optional end time
+    :param variables: optional list of variables that the files must have
+    :return: sorted list of files
+    """
+    files = scan(paths, dbfile, prune=False)
+    found = set(query(dbfile, start=start, end=end, extent=extent, variables=variables).path)
+
+    return [f for f in files if f in found]
@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+
+"""
+Store glider deployments as partitioned Parquet (one directory per deployment and day, e.g.
+<root>/deployment=ru40-20230817T1522/date=2023-08-17/) and read them back with column projection and filters on
+deployment, time and location. Days outside of the time window are skipped without being opened, and the time and
+location filters are applied by pyarrow while the files are read, so a map or cross-section only reads the columns and
+time window it needs. The variable and global attributes of each deployment are kept in _attrs.json in the
+deployment directory.
+"""
+import os
+import glob
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+import functions.common as cf
+
+PARTITIONING = pads.partitioning(pa.schema([('deployment', pa.string()), ('date', pa.string())]), flavor='hive')
+
+
+def deployment_id(ds, fname):
+    """
+    :return: the trajectory in the dataset, or the file name if the dataset doesn't have a trajectory
+    """
+    if 'trajectory' in ds.variables:
+        return str(ds.trajectory.values.ravel()[0])
+    return os.path.basename(fname).split('.nc')[0]
+
+
+def convert(fname, root, variables=None, chunk_size=1000000):
+    """
+    Convert a deployment NetCDF file to partitioned Parquet, one chunk of observations at a time. Data already stored
+    for the deployment are replaced.
+    :param fname: deployment NetCDF file
+    :param root: root directory of the Parquet dataset
+    :param variables: optional list of variables to store, default is all variables on the observation dimension
+    :param chunk_size: number of observations read and written at a time
+    :return: the deployment directory
+    """
+    ds = cf.open_deployment(fname, chunk_size=chunk_size)
+    deploy = deployment_id(ds, fname)
+    if 'obs' in ds.dims:
+        ds = cf.to_timeseries(ds)
+    dim = ds.time.dims[0]
+    keep = [v for v in (variables or ds.data_vars) if v in ds.data_vars and ds[v].dims == (dim,)]
+
+    path = os.path.join(root, f'deployment={deploy}')
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    for i, start in enumerate(range(0, ds.sizes[dim], chunk_size)):
+        chunk = ds[keep].isel({dim: slice(start, start + chunk_size)}).compute()
+        df = pd.DataFrame({v: chunk[v].values for v in keep})
+        df.insert(0, 'time', chunk.time.values)
+        df = df[df.time.notna()]
+        df['deployment'] = deploy
+        df['date'] = df.time.dt.strftime('%Y-%m-%d')
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), root, partitioning=PARTITIONING,
+                            basename_template=f'part-{i}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore')
+
+    attrs = dict(attrs=ds.attrs, variables={v: ds[v].attrs for v in ['time'] + keep})
+    with open(os.path.join(path, '_attrs.json'), 'w') as f:
+        json.dump(attrs, f, default=_json_value)
+
+    return path
+
+
+def _json_value(value):
+    return value.tolist() if isinstance(value, (np.ndarray, np.generic)) else str(value)
+
+
+def dataset_filter(deployments=None, start=None, end=None, extent=None):
+    """
+    Build the pyarrow filter for the deployments, time window and map extent. The date partitions outside of the time
+    window are skipped without reading them.
+    :param deployments: optional list of deployment names
+    :param start: optional start time
+    :param end: optional end time (included)
+    :param extent: optional map limits [lon min, lon max, lat min, lat max]
+    :return: pyarrow filter expression, or None
+    """
+    conditions = []
+    if deployments:
+        conditions.append(pads.field('deployment').isin(list(deployments)))
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions.append(pads.field('date') >= f'{start:%Y-%m-%d}')
+        conditions.append(pads.field('time') >= pa.scalar(start.as_unit('ns').to_datetime64(), pa.timestamp('ns')))
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions.append(pads.field('date') <= f'{end:%Y-%m-%d}')
+        conditions.append(pads.field('time') <= pa.scalar(end.as_unit('ns').to_datetime64(), pa.timestamp('ns')))
+    if extent:
+        conditions.append((pads.field('longitude') >= extent[0]) & (pads.field('longitude') <= extent[1]) &
+                          (pads.field('latitude') >= extent[2]) & (pads.field('latitude') <= extent[3]))
+    if not conditions:
+        return None
+
+    expression = conditions[0]
+    for c in conditions[1:]:
+        expression = expression & c
+
+    return expression
+
+
+def parquet_files(root, deployments=None):
+    """
+    Find the Parquet files of the deployments in the dataset. Only .parquet files in the deployment directories are
+    read, so other files in the dataset directory (e.g. analysis output) don't break reading the dataset
+    :param root: root directory of the Parquet dataset
+    :param deployments: optional list of deployment names, default is all deployments
+    :return: sorted list of files
+    """
+    dirs = [f'deployment={glob.escape(d)}' for d in deployments] if deployments else ['deployment=*']
+    files = []
+    for d in dirs:
+        files.extend(glob.glob(os.path.join(root, d, '**', '*.parquet'), recursive=True))
+
+    return sorted(files)
+
+
+def read(root, variables=None, deployments=None, start=None, end=None, extent=None):
+    """
+    Read glider data from the partitioned Parquet dataset, only for the variables, deployments, time window and map
+    extent requested
+    :param root: root directory of the Parquet dataset
+    :param variables: optional list of variables to read ('time' and 'deployment' are always read), default is all
+    :param deployments: optional list of deployment names
+    :param start: optional start time
+    :param end: optional end time (included)
+    :param extent: optional map limits [lon min, lon max, lat min, lat max]
+    :return: dataframe with a deployment column, sorted by deployment and time
+    """
+    files = parquet_files(root, deployments)
+
+    # deployments can have different variables, so the schemas of the deployments (from the first file of each) are
+    # combined. Otherwise pyarrow uses the schema of the first file for all of them
+    schemas = dict()
+    for f in files:
+        deploy = os.path.relpath(f, root).split(os.sep)[0]
+        if deploy not in schemas:
+            schemas[deploy] = pq.read_schema(f)
+    if not schemas:
+        return pd.DataFrame(columns=list(dict.fromkeys(['deployment', 'time'] + (variables or []))))
+    schema = pa.unify_schemas(list(schemas.values()) + [PARTITIONING.schema])
+    dataset = pads.dataset(files, schema=schema, format='parquet', partitioning=PARTITIONING, partition_base_dir=root)
+
+    columns = None
+    if variables:
+        columns = list(dict.fromkeys(['deployment', 'time'] + [v for v in variables if v in dataset.schema.names]))
+    table = dataset.to_table(columns=columns, filter=dataset_filter(deployments, start, end, extent))
+    df = table.to_pandas()
+    df = df.drop(columns=[c for c in ['date'] if c in df.columns])
+
+    return df.sort_values(['deployment', 'time'], kind='stable').reset_index(drop=True)
+
+
+def load_deployments(root, variables, deployments=None, start=None, end=None, extent=None):
+    """
+    Read data from the partitioned Parquet dataset in the same format as alignment.load_deployments
+    :return: dictionary of deployment name: dataframe indexed by time (sorted), without rows that have no data
+    """
+    df = read(root, variables, deployments, start, end, extent)
+    data = dict()
+    for deploy, group in df.groupby('deployment', sort=True):
+        group = group.set_index('time').drop(columns=['deployment'])
+        data[deploy] = group.dropna(how='all')
+
+    return data
+
+
+def open_partition(path, variables=None, chunk_size=1000000, start=None, end=None):
+    """
+    Open one deployment directory of the Parquet dataset as a time-series xarray dataset (like common.to_timeseries)
+    with the attributes of the original file. The variables and time window are read into memory, then split into dask
+    chunks
+    :param path: deployment directory, <root>/deployment=<name>
+    :param variables: optional list of variables to read, default is all of them
+    :param chunk_size: number of observations in each dask chunk
+    :param start: optional start time
+    :param end: optional end time (included)
+    :return: xarray dataset with 'time' as the dimension
+    """
+    path = os.path.normpath(path)
+    deploy = os.path.basename(path).split('deployment=', 1)[1]
+    df = read(os.path.dirname(path), variables, [deploy], start, end)
+    ds = xr.Dataset({v: ('time', df[v].values) for v in df.columns if v not in ['time', 'deployment']},
+                    coords={'time': ('time', df['time'].values)})
+
+    attrs_file = os.path.join(path, '_attrs.json')
+    if os.path.isfile(attrs_file):
+        with open(attrs_file) as f:
+            attrs = json.load(f)
+        ds.attrs = attrs['attrs']
+        for v in ds.variables:
+            ds[v].attrs = attrs['variables'].get(v, dict())
+
+    return ds.chunk({'time': chunk_size})
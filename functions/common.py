@@ -2,14 +2,162 @@
 
 """
 Author: Lori Garzio on 10/23/2023
-Last modified: 10/26/2023
+Last modified: 10/16/2026
 """
+import os
+import hashlib
+import functools
+import netCDF4
 import numpy as np
 import pandas as pd
+import xarray as xr
 import cmocean as cmo
+import functions.ragged as ragged
 
 
-def depth_bin(dataframe, depth_var='depth', depth_min=0, depth_max=None, stride=1):
+def bin_index(depth, bins):
+    """
+    Find the depth bin for each value without pd.cut. Bins are closed on the right, like pd.cut: value v is in bin i
+    when bins[i] < v <= bins[i + 1]. The bin is calculated arithmetically from the bin spacing and then checked against
+    the bin edges, so values that land on an edge give the same result as pd.cut.
+    :param depth: array of depth values
+    :param bins: evenly spaced, increasing bin edges
+    :return: array of bin indices, -1 for values that are nan or outside of the bins
+    """
+    depth = np.asarray(depth, dtype='float64')
+    idx = np.full(depth.shape, -1, dtype='int64')
+    nbins = len(bins) - 1
+    if nbins < 1:
+        return idx
+
+    with np.errstate(invalid='ignore'):
+        inside = (depth > bins[0]) & (depth <= bins[-1])
+    stride = (bins[-1] - bins[0]) / nbins
+    idx[inside] = np.clip(np.ceil((depth[inside] - bins[0]) / stride).astype('int64') - 1, 0, nbins - 1)
+
+    # step into the neighboring bin where floating point error put the value on the wrong side of an edge
+    low = inside & (depth <= bins[np.clip(idx, 0, nbins)])
+    idx[low] -= 1
+    high = inside & (depth > bins[np.clip(idx + 1, 0, nbins)])
+    idx[high] += 1
+
+    return idx
+
+
+def depth_bin_arrays(depth, data, profile=None, depth_min=0, depth_max=None, stride=1, counts=False, std=False):
+    """
+    Average data into depth bins using np.bincount. Works on a single profile, or on many profiles stacked together
+    when profile is provided, in which case each profile is binned from depth_min to its own maximum depth (or
+    depth_max), the same as running depth_bin on each profile separately.
+    :param depth: array of depth values used to define the bins
+    :param data: dictionary of arrays (same length as depth) to average into the depth bins
+    :param profile: optional array of integer profile codes (0 to n-1) for each value
+    :param depth_min: the shallowest bin depth
+    :param depth_max: the deepest bin depth
+    :param stride: the amount of space between each bin
+    :param counts: if True, also return the number of values in each bin as <variable>_count
+    :param std: if True, also return the standard deviation (ddof=1) of each bin as <variable>_std
+    :return: the bin edges and a dictionary of binned arrays, including 'bin' (index of the bin in the bin edges) and
+    'profile' (profile code of each bin, all 0 for a single profile)
+    """
+    depth = np.asarray(depth, dtype='float64')
+    if profile is None:
+        profile = np.zeros(len(depth), dtype='int64')
+    profile = np.asarray(profile, dtype='int64')
+    nprofiles = profile.max() + 1 if len(profile) > 0 else 0
+
+    # the number of bins in each profile is based on that profile's maximum depth
+    if depth_max:
+        profile_max = np.full(nprofiles, depth_max, dtype='float64')
+    else:
+        profile_max = np.full(nprofiles, -np.inf)
+        np.fmax.at(profile_max, profile, depth)
+    with np.errstate(invalid='ignore'):
+        nbins = np.ceil((profile_max + stride - depth_min) / stride) - 1
+    nbins = np.where(np.isfinite(nbins) & (nbins > 0), nbins, 0).astype('int64')
+
+    # the bins of each profile are the first nbins of the bins for the deepest profile
+    bins = np.arange(depth_min, profile_max[nbins > 0].max(initial=depth_min) + stride, stride)
+    nbins = np.minimum(nbins, len(bins) - 1)
+
+    idx = bin_index(depth, bins)
+    inbin = (idx >= 0) & (idx < nbins[profile])
+
+    # each bin of each profile gets a position in the output
+    offsets = np.concatenate(([0], np.cumsum(nbins)))
+    key = offsets[profile[inbin]] + idx[inbin]
+    length = offsets[-1]
+
+    binned = dict()
+    binned['profile'] = np.repeat(np.arange(nprofiles), nbins)
+    binned['bin'] = np.arange(length) - offsets[binned['profile']]
+    for name, values in data.items():
+        values = np.asarray(values)[inbin]
+        is_time = np.issubdtype(values.dtype, np.datetime64)
+        if is_time:
+            valid = ~np.isnat(values)
+            x = values.view('int64').astype('float64')
+        else:
+            x = values.astype('float64')
+            valid = ~np.isnan(x)
+        x = np.where(valid, x, 0)
+        count = np.bincount(key, weights=valid, minlength=length)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(key, weights=x, minlength=length) / count
+            if std:
+                sqr = np.where(valid, (x - mean[key]) ** 2, 0)
+                binned[f'{name}_std'] = np.sqrt(np.bincount(key, weights=sqr, minlength=length) / (count - 1))
+                binned[f'{name}_std'][count < 2] = np.nan
+
+        if is_time:
+            mean = np.where(count > 0, mean, np.iinfo('int64').min).astype('int64').view(values.dtype)
+        elif values.dtype == np.float32:
+            mean = mean.astype('float32')
+        binned[name] = mean
+        if counts:
+            binned[f'{name}_count'] = count.astype('int64')
+
+    return bins, binned
+
+
+def depth_bin_profiles(fname, variables, depth_var='depth', depth_min=0, depth_max=None, stride=1, block_profiles=500,
+                       rowsize_var='rowSize'):
+    """
+    Average the profiles in a ragged-array file into depth bins, reading one block of profiles at a time with
+    ragged.iter_blocks. Each profile is binned the same as depth_bin.
+    :param fname: ragged-array NetCDF file name or xarray dataset (opened lazily)
+    :param variables: list of variables on the observation dimension to bin, including depth_var
+    :param depth_var: the name of the depth variable
+    :param depth_min: the shallowest bin depth
+    :param depth_max: the deepest bin depth
+    :param stride: the amount of space between each bin
+    :param block_profiles: number of profiles binned at a time
+    :param rowsize_var: the name of the variable with the number of observations in each profile
+    :return: generator of (profile index, bin edges, dictionary of variable: binned data)
+    """
+    for ids, codes, block in ragged.iter_blocks(fname, variables, rowsize_var, block_profiles):
+        bins, binned = depth_bin_arrays(block[depth_var], block, profile=codes, depth_min=depth_min,
+                                        depth_max=depth_max, stride=stride)
+        # profiles without data aren't in codes
+        nbins = np.bincount(binned['profile'], minlength=len(ids))
+        offsets = np.concatenate(([0], np.cumsum(nbins)))
+        for i, p in enumerate(ids):
+            sl = slice(offsets[i], offsets[i + 1])
+            yield p, bins[:nbins[i] + 1], {v: binned[v][sl] for v in block}
+
+
+@functools.lru_cache(maxsize=128)
+def bin_labels(bins):
+    """
+    :param bins: tuple of bin edges
+    :return: the interval labels pd.cut uses for the bins (pd.cut rounds the bin edges for the labels). Building the
+    labels is the slowest part of binning a single profile, so they are cached
+    """
+    return pd.cut(bins[1:], bins).categories
+
+
+def depth_bin(dataframe, depth_var='depth', depth_min=0, depth_max=None, stride=1, profile_var=None, counts=False,
+              std=False):
     """
     Written by Mike Smith
     :param dataframe: depth profile in the form of a pandas dataframe
@@ -17,16 +165,129 @@ def depth_bin(dataframe, depth_var='depth', depth_min=0, depth_max=None, stride=
     :param depth_min: the shallowest bin depth
     :param depth_max: the deepest bin depth
     :param stride: the amount of space between each bin
+    :param profile_var: optional name of the column identifying profiles when multiple profiles are stacked in the
+    dataframe. Each profile is binned separately and the output is indexed by (profile_var, depth bin)
+    :param counts: if True, add the number of values in each bin as <column>_count
+    :param std: if True, add the standard deviation of each bin as <column>_std
     :return: pandas dataframe where data has been averaged into specified depth bins
     """
-    depth_max = depth_max or dataframe[depth_var].max()
+    columns = [c for c in dataframe.columns if c != profile_var]
+    data = {c: dataframe[c].values for c in columns}
+    if profile_var:
+        profiles, profile = np.unique(dataframe[profile_var].values, return_inverse=True)
+        profile = profile.ravel()
+    else:
+        profile = None
+    bins, binned = depth_bin_arrays(dataframe[depth_var].values, data, profile=profile, depth_min=depth_min,
+                                    depth_max=depth_max, stride=stride, counts=counts, std=std)
+    intervals = bin_labels(tuple(bins))
+
+    output_columns = []
+    for c in columns:
+        output_columns.append(c)
+        if counts:
+            output_columns.append(f'{c}_count')
+        if std:
+            output_columns.append(f'{c}_std')
+    binned_df = pd.DataFrame({c: binned[c] for c in output_columns})
+
+    if profile_var:
+        binned_df.index = pd.MultiIndex.from_arrays(
+            [profiles[binned['profile']], pd.Categorical.from_codes(binned['bin'], intervals, ordered=True)],
+            names=[profile_var, depth_var])
+    else:
+        binned_df.index = pd.CategoricalIndex(intervals, ordered=True, name=depth_var)
 
-    bins = np.arange(depth_min, depth_max+stride, stride)  # Generate array of depths you want to bin at
-    cut = pd.cut(dataframe[depth_var], bins)  # Cut/Bin the dataframe based on the bins variable we just generated
-    binned_df = dataframe.groupby(cut, observed=False).mean()  # Groupby the cut and do the mean
     return binned_df
 
 
+def open_deployment(fname, variables=None, chunk_size=1000000):
+    """
+    Open a glider deployment as a dataset backed by dask arrays. NetCDF files are opened lazily, so data are only read
+    from disk (one chunk at a time) when they're used and peak memory is bounded by the chunk size rather than the file
+    size. Parquet deployments and ERDDAP caches are read into memory (only the requested variables) and then chunked,
+    so their memory use depends on the size of the deployment
+    :param fname: deployment NetCDF file, a deployment directory of a partitioned Parquet dataset
+    (<root>/deployment=<name>, see columnar.convert) or an ERDDAP cache directory from erddap.fetch_deployment
+    :param variables: optional list of variables to keep (if they're in the file), the rest of the data variables are
+    never read
+    :param chunk_size: number of observations in each chunk
+    :return: xarray dataset backed by dask arrays
+    """
+    # the Parquet readers (and erddapy) are only imported for the directory formats, columnar also imports this module
+    if os.path.isdir(fname) and os.path.basename(os.path.normpath(fname)).startswith('deployment='):
+        import functions.columnar as columnar
+        return columnar.open_partition(fname, variables, chunk_size)
+    if os.path.isdir(fname):
+        import functions.erddap as erddap
+        return erddap.open_cache(fname, variables, chunk_size)
+    with xr.open_dataset(fname) as ds:
+        chunks = {dim: chunk_size for dim in ds.dims}
+    ds = xr.open_dataset(fname, chunks=chunks)
+    if variables:
+        ds = ds[[v for v in variables if v in ds.variables]]
+
+    return ds
+
+
+def output_file(fname, suffix):
+    """
+    Name an output file for a deployment. Outputs for a NetCDF file are written next to it. Outputs for a deployment
+    directory of a partitioned Parquet dataset are written next to the dataset root (never inside it, where they would
+    be read as part of the dataset) and named with the deployment, and outputs for an ERDDAP cache directory are named
+    with the dataset ID
+    :param fname: deployment NetCDF file or directory (see open_deployment)
+    :param suffix: ending added to the name, e.g. '_mld.nc'
+    :return: output file name
+    """
+    if not os.path.isdir(fname):
+        return f'{fname.split(".nc")[0]}{suffix}'
+    path = os.path.normpath(fname)
+    name = os.path.basename(path)
+    if name.startswith('deployment='):
+        return os.path.join(os.path.dirname(os.path.dirname(path)), f'{name.split("deployment=", 1)[1]}{suffix}')
+
+    # ERDDAP cache directory <cache_dir>/<dataset ID>/<variables hash>
+    return os.path.join(os.path.dirname(path), f'{os.path.basename(os.path.dirname(path))}{suffix}')
+
+
+def to_timeseries(ds):
+    """
+    Convert a ragged-array glider dataset with an 'obs' dimension to a time-series dataset with 'time' as the
+    dimension, sorted by time
+    :param ds: xarray dataset
+    :return: xarray dataset
+    """
+    try:
+        ds = ds.drop_vars(names=['profile_id', 'rowSize'])
+    except ValueError as e:
+        print(e)
+    try:
+        ds = ds.swap_dims({'obs': 'time'})
+    except ValueError as e:
+        print(e)
+    ds = ds.sortby(ds.time)
+
+    return ds
+
+
+def profile_chunks(profile_codes, nprofiles=500):
+    """
+    Split observations into chunks of consecutive profiles without splitting any profile across two chunks
+    :param profile_codes: array of profile identifiers for each observation, with the observations of each profile
+    next to each other (e.g. data sorted by time)
+    :param nprofiles: number of profiles in each chunk
+    :return: generator of slices of the observations
+    """
+    profile_codes = np.asarray(profile_codes)
+    if len(profile_codes) == 0:
+        return
+    starts = np.flatnonzero(np.concatenate(([True], profile_codes[1:] != profile_codes[:-1])))
+    bounds = np.append(starts[::nprofiles], len(profile_codes))
+    for i in range(len(bounds) - 1):
+        yield slice(bounds[i], bounds[i + 1])
+
+
 def glider_extent(lats, lons):
     """
     Calculate the map extents for plotting a glider deployment
@@ -36,3 +297,58 @@ def glider_extent(lats, lons):
 
     return extent
 
+
+def file_hash(fname, blocksize=2**20):
+    """
+    :param fname: file name
+    :param blocksize: number of bytes read at a time
+    :return: sha1 hash of the file contents
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def append_netcdf(ds, fname, start):
+    """
+    Write a dataset over the end of an existing NetCDF file along its unlimited dimension, starting at index start, so
+    the data before start aren't read or rewritten. The data are encoded with the units, fill values and data types of
+    the variables in the file.
+    :param ds: xarray dataset with the same variables on the dimension as the file (e.g. the new observations)
+    :param fname: NetCDF file written with the dimension unlimited (e.g. ds.to_netcdf(fname, unlimited_dims=['time']))
+    :param start: index on the dimension where the data are written
+    :return: True if the data were written, False if the file doesn't match the dataset and has to be rewritten
+    """
+    dim = ds.time.dims[0]
+    with netCDF4.Dataset(fname, 'a') as nc:
+        if dim not in nc.dimensions or not nc.dimensions[dim].isunlimited() or len(nc.dimensions[dim]) < start:
+            return False
+        file_vars = [v for v in nc.variables if dim in nc[v].dimensions]
+        data_vars = [v for v in ds.variables if dim in ds[v].dims]
+        if sorted(file_vars) != sorted(data_vars) or any(ds[v].dims != nc[v].dimensions for v in data_vars):
+            return False
+        # the file can't shrink, so the data have to reach the end of the observations already in the file
+        if start + ds.sizes[dim] < len(nc.dimensions[dim]):
+            return False
+
+        encoded = dict()
+        for v in data_vars:
+            var = ds[v].variable.copy(deep=False)
+            var.encoding = {k: nc[v].getncattr(k) for k in ['units', 'calendar', '_FillValue', 'scale_factor',
+                                                             'add_offset'] if k in nc[v].ncattrs()}
+            if isinstance(nc[v].dtype, np.dtype):
+                var.encoding['dtype'] = nc[v].dtype
+            try:
+                encoded[v] = xr.conventions.encode_cf_variable(var, name=v).values
+            except (ValueError, TypeError, OverflowError) as e:
+                print(f'{v} can\'t be appended with the encoding in {fname}: {e}')
+                return False
+
+        nc.set_auto_maskandscale(False)
+        for v, values in encoded.items():
+            nc[v][start:start + len(values)] = values
+
+    return True
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+"""
+Calculate derived seawater variables with gsw: absolute salinity, conservative temperature, potential density,
+in-situ density (if the file doesn't have it) and the buoyancy frequency squared (N**2) of each profile. Absolute salinity, conservative temperature and potential density
+are calculated lazily (one dask chunk at a time when they're used), so a later stage that reads them, e.g. calculating
+MLD from potential density, only reads the file once. N**2 is calculated for one chunk of profiles at a time.
+"""
+import numpy as np
+import xarray as xr
+import gsw
+import functions.common as cf
+
+
+def _attrs(long_name, units, ancillary, comment):
+    return {
+        'long_name': long_name,
+        'units': units,
+        'observation_type': 'calculated',
+        'ancillary_variables': ancillary,
+        'comment': comment
+    }
+
+
+def practical_salinity(ds, salvar='salinity', tempvar='temperature', zvar='pressure', condvar='conductivity'):
+    """
+    :return: practical salinity from the dataset, or calculated from conductivity if the dataset doesn't have salinity
+    """
+    if salvar in ds:
+        return ds[salvar]
+    cond = ds[condvar]
+    if cond.attrs.get('units', '').replace(' ', '') in ['Sm-1', 'S/m', 'S.m-1']:
+        cond = cond * 10  # S/m to mS/cm
+    return xr.apply_ufunc(gsw.SP_from_C, cond, ds[tempvar], ds[zvar], dask='parallelized', output_dtypes=['float64'])
+
+
+def add_derived(ds, salvar='salinity', tempvar='temperature', zvar='pressure', timevar='profile_time', n2=True,
+                chunk_profiles=500):
+    """
+    Add absolute salinity, conservative temperature, potential density (referenced to 0 dbar), in-situ density (if the
+    dataset doesn't have density) and optionally N**2 to the dataset
+    :param ds: xarray dataset sorted by time, with 'time' as the only dimension
+    :param salvar: the name of the practical salinity variable (salinity is calculated from conductivity if it's not
+    in the dataset)
+    :param tempvar: the name of the in-situ temperature variable
+    :param zvar: the name of the pressure variable
+    :param timevar: the name of the variable identifying profiles, used for N**2
+    :param n2: True to also calculate N**2 for each profile
+    :param chunk_profiles: number of profiles read at a time to calculate N**2
+    :return: dataset with absolute_salinity, conservative_temperature, potential_density (and
+    buoyancy_frequency_squared) added
+    """
+    sp = practical_salinity(ds, salvar, tempvar, zvar)
+    sa = xr.apply_ufunc(gsw.SA_from_SP, sp, ds[zvar], ds.longitude, ds.latitude, dask='parallelized',
+                        output_dtypes=['float64'])
+    ds['absolute_salinity'] = sa
+    ds['absolute_salinity'].attrs = _attrs('Absolute Salinity', 'g kg-1', [salvar, zvar, 'longitude', 'latitude'],
+                                           'Calculated with gsw.SA_from_SP')
+
+    ct = xr.apply_ufunc(gsw.CT_from_t, ds.absolute_salinity, ds[tempvar], ds[zvar], dask='parallelized',
+                        output_dtypes=['float64'])
+    ds['conservative_temperature'] = ct
+    ds['conservative_temperature'].attrs = _attrs('Conservative Temperature', 'degrees_Celsius',
+                                                  ['absolute_salinity', tempvar, zvar],
+                                                  'Calculated with gsw.CT_from_t')
+
+    sigma0 = xr.apply_ufunc(gsw.sigma0, ds.absolute_salinity, ds.conservative_temperature, dask='parallelized',
+                            output_dtypes=['float64'])
+    ds['potential_density'] = sigma0 + 1000
+    ds['potential_density'].attrs = _attrs('Potential Density', 'kg m-3',
+                                           ['absolute_salinity', 'conservative_temperature'],
+                                           'Potential density referenced to 0 dbar, calculated with gsw.sigma0 + 1000')
+
+    if 'density' not in ds:
+        rho = xr.apply_ufunc(gsw.rho, ds.absolute_salinity, ds.conservative_temperature, ds[zvar], dask='parallelized',
+                             output_dtypes=['float64'])
+        ds['density'] = rho
+        ds['density'].attrs = _attrs('Density', 'kg m-3', ['absolute_salinity', 'conservative_temperature', zvar],
+                                     'In-situ density calculated with gsw.rho')
+
+    if n2:
+        ds = add_n2(ds, zvar, timevar, chunk_profiles)
+
+    return ds
+
+
+def profile_n2(profile_code, pressure, sa, ct, lat):
+    """
+    Calculate N**2 between consecutive observations (sorted by pressure) within each profile with gsw.Nsquared
+    :param profile_code: array of profile identifiers for each observation
+    :param pressure: array of pressure
+    :param sa: array of absolute salinity
+    :param ct: array of conservative temperature
+    :param lat: array of latitude
+    :return: array of N**2 for each observation, calculated between the observation and the next deeper valid
+    observation in the profile (nan for the deepest observation of each profile)
+    """
+    n2 = np.full(len(pressure), np.nan)
+    valid = np.flatnonzero(~np.isnan(pressure) & ~np.isnan(sa) & ~np.isnan(ct) & ~np.isnan(lat))
+    if len(valid) < 2:
+        return n2
+
+    order = valid[np.lexsort((pressure[valid], profile_code[valid]))]
+    pairs, _ = gsw.Nsquared(sa[order], ct[order], pressure[order], lat[order])
+
+    # don't use pairs that span two profiles or have the same pressure
+    same_profile = profile_code[order][1:] == profile_code[order][:-1]
+    with np.errstate(invalid='ignore'):
+        pairs = np.where(same_profile & (np.diff(pressure[order]) > 0), pairs, np.nan)
+    n2[order[:-1]] = pairs
+
+    return n2
+
+
+def add_n2(ds, zvar='pressure', timevar='profile_time', chunk_profiles=500):
+    """
+    Add N**2 for each profile, calculated for one chunk of profiles at a time (see profile_n2)
+    :param ds: xarray dataset sorted by time with absolute_salinity and conservative_temperature
+    :return: dataset with buoyancy_frequency_squared added
+    """
+    dim = ds.time.dims[0]
+    profile_ids = ds[timevar].values
+    n2 = np.full(len(profile_ids), np.nan)
+    read_vars = [zvar, 'absolute_salinity', 'conservative_temperature', 'latitude']
+    for sl in cf.profile_chunks(profile_ids, chunk_profiles):
+        chunk = ds[read_vars].isel({dim: sl}).compute()
+        n2[sl] = profile_n2(profile_ids[sl], chunk[zvar].values.astype('float64'),
+                            chunk.absolute_salinity.values, chunk.conservative_temperature.values,
+                            chunk.latitude.values.astype('float64'))
+
+    ds['buoyancy_frequency_squared'] = xr.DataArray(n2, coords=ds[zvar].coords, dims=ds[zvar].dims)
+    ds['buoyancy_frequency_squared'].attrs = _attrs(
+        'Buoyancy Frequency Squared', 's-2', ['absolute_salinity', 'conservative_temperature', zvar, 'latitude'],
+        'N**2 between each observation and the next deeper observation in the profile, calculated with gsw.Nsquared')
+
+    return ds
@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+
+"""
+Download glider deployments from an ERDDAP tabledap server into a local Parquet cache. Each deployment is requested in
+time chunks (on a fixed calendar grid) by a pool of download threads, only for the variables that are needed, and each
+chunk is saved to its own Parquet file as soon as it's downloaded. Chunks that are already in the cache aren't
+downloaded again, so an interrupted download picks up where it stopped. The cache directory returned by fetch_deployment can be used in place
+of a NetCDF file name by the analysis and map scripts (see common.open_deployment).
+"""
+import os
+import json
+import glob
+import time
+import hashlib
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import xarray as xr
+from erddapy import ERDDAP
+
+ERDDAP_SERVER = 'https://slocum-data.marine.rutgers.edu/erddap'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gliders_cache', 'erddap')
+
+# variables needed by each analysis ('time' is always requested)
+QC_FLAGS = [f'{v}_qartod_summary_flag' for v in ['conductivity', 'temperature', 'salinity', 'density']] + \
+           [f'{v}_hysteresis_test' for v in ['conductivity', 'temperature']]
+ANALYSIS_VARIABLES = {
+    'mld': ['profile_time', 'pressure', 'density', 'temperature', 'latitude', 'longitude'],
+    'qc_mld': ['profile_time', 'pressure', 'density', 'temperature', 'salinity', 'conductivity', 'latitude',
+               'longitude'] + QC_FLAGS,
+    'tracks': ['profile_time', 'latitude', 'longitude']
+}
+
+
+def dataset_info(dataset_id, server=ERDDAP_SERVER):
+    """
+    Get the metadata for a dataset from the ERDDAP info page
+    :param dataset_id: ERDDAP dataset ID
+    :param server: ERDDAP server url
+    :return: dictionary with the global attributes ('global') and a dictionary of attributes for each variable
+    ('variables')
+    """
+    e = ERDDAP(server=server, protocol='tabledap')
+    info = pd.read_csv(e.get_info_url(dataset_id, response='csv'))
+    attrs = info[info['Row Type'] == 'attribute']
+    variables = info.loc[info['Row Type'] == 'variable', 'Variable Name'].tolist()
+
+    metadata = dict(variables={v: dict() for v in variables})
+    metadata['global'] = dict(zip(attrs.loc[attrs['Variable Name'] == 'NC_GLOBAL', 'Attribute Name'],
+                                  attrs.loc[attrs['Variable Name'] == 'NC_GLOBAL', 'Value']))
+    for row in attrs[attrs['Variable Name'] != 'NC_GLOBAL'].itertuples(index=False):
+        metadata['variables'].setdefault(row[1], dict())[row[2]] = row[4]
+
+    return metadata
+
+
+def time_chunks(start, end, days=7):
+    """
+    Find the chunks of a fixed calendar grid (every `days` days from 1970-01-01) that cover a time range. The chunk
+    edges don't depend on the start and end times, so later downloads with a different time range reuse the same chunks
+    instead of adding chunks that overlap the cached ones
+    :param start: start time
+    :param end: end time (included in the last chunk)
+    :param days: length of each chunk in days
+    :return: list of (chunk start, chunk end) timestamps, the end of each chunk isn't included in the chunk
+    """
+    epoch = pd.Timestamp('1970-01-01')
+    step = pd.Timedelta(days=days)
+    first = (_utc(start) - epoch) // step
+    last = (_utc(end) - epoch) // step
+    edges = [epoch + k * step for k in range(first, last + 2)]
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _utc(t):
+    t = pd.Timestamp(t)
+    return t.tz_convert(None) if t.tz is not None else t
+
+
+def download_url(dataset_id, variables, start, end, server=ERDDAP_SERVER):
+    """
+    :return: tabledap csv url for the variables from start (included) to end (not included)
+    """
+    e = ERDDAP(server=server, protocol='tabledap', response='csv')
+    e.dataset_id = dataset_id
+    e.variables = variables
+    e.constraints = {'time>=': start, 'time<': end}
+
+    return e.get_download_url()
+
+
+def download_chunk(url, fname, variables, timeout=300):
+    """
+    Download one chunk and save it to a Parquet file. The file is written under a temporary name and renamed when it's
+    complete, so an interrupted download never leaves a partial chunk in the cache.
+    :param url: tabledap csv url
+    :param fname: Parquet file name
+    :param variables: list of variables that were requested
+    :param timeout: request timeout in seconds
+    :return: number of rows in the chunk
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            df = pd.read_csv(response, skiprows=[1])  # the second row of the csv has the units
+    except urllib.error.HTTPError as e:
+        # ERDDAP returns an error when there are no data in the time range, which is saved as an empty chunk
+        if e.code == 404 and 'no matching results' in e.read().decode(errors='ignore'):
+            df = pd.DataFrame({v: np.array([], dtype='float64') for v in variables})
+        else:
+            raise
+    for v in [x for x in ['time', 'profile_time'] if x in df.columns]:
+        df[v] = pd.to_datetime(df[v], utc=True).dt.tz_convert(None)
+
+    tmp = f'{fname}.part'
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, fname)
+
+    return len(df)
+
+
+def cache_path(dataset_id, variables, cache_dir=CACHE_DIR):
+    """
+    Find the cache directory for a dataset and set of variables. A cache that already has all of the variables is used
+    if there is one, otherwise a new directory is named with a hash of the variables.
+    :return: the cache directory
+    """
+    variables = sorted(set(variables))
+    for vfile in glob.glob(os.path.join(cache_dir, dataset_id, '*', 'variables.json')):
+        with open(vfile) as f:
+            if set(variables) <= set(json.load(f)):
+                return os.path.dirname(vfile)
+    key = hashlib.sha1(json.dumps(variables).encode()).hexdigest()[0:16]
+
+    return os.path.join(cache_dir, dataset_id, key)
+
+
+def fetch_deployment(dataset_id, variables, start=None, end=None, server=ERDDAP_SERVER, chunk_days=7, workers=4,
+                     cache_dir=CACHE_DIR, retries=3, refresh_last=False):
+    """
+    Download a deployment from ERDDAP into the Parquet cache, one time chunk per request. Chunks that are already in
+    the cache are skipped, so running this again resumes an interrupted download.
+    :param dataset_id: ERDDAP dataset ID
+    :param variables: list of variables to download, or the name of an analysis in ANALYSIS_VARIABLES
+    :param start: optional start time, default is the start of the dataset
+    :param end: optional end time, default is the end of the dataset
+    :param server: ERDDAP server url
+    :param chunk_days: number of days of data in each request
+    :param workers: number of concurrent downloads
+    :param cache_dir: cache directory
+    :param retries: number of times to try each chunk
+    :param refresh_last: True to get the dataset info from the server again and download the chunks from the end of
+    the previous download on again even if they're cached (e.g. real-time datasets that are still growing)
+    :return: the cache directory for the deployment, which can be opened with open_cache (or common.open_deployment)
+    """
+    variables = ANALYSIS_VARIABLES.get(variables, variables) if isinstance(variables, str) else variables
+    variables = list(dict.fromkeys(['time'] + list(variables)))
+    path = cache_path(dataset_id, variables, cache_dir)
+    os.makedirs(path, exist_ok=True)
+
+    info_file = os.path.join(os.path.dirname(path), 'info.json')
+    refresh_from = None
+    if os.path.isfile(info_file):
+        with open(info_file) as f:
+            info = json.load(f)
+    if refresh_last or not os.path.isfile(info_file):
+        if refresh_last and os.path.isfile(info_file):
+            # chunks up to the end of the dataset when it was last downloaded are complete
+            refresh_from = _utc(info['global']['time_coverage_end'])
+        info = dataset_info(dataset_id, server)
+        with open(info_file, 'w') as f:
+            json.dump(info, f)
+    variables = [v for v in variables if v in info['variables']]
+    vfile = os.path.join(path, 'variables.json')
+    if not os.path.isfile(vfile):
+        with open(vfile, 'w') as f:
+            json.dump(sorted(variables), f)
+    else:
+        with open(vfile) as f:
+            variables = json.load(f)  # an existing cache with more variables keeps all of them up to date
+
+    start = start or info['global']['time_coverage_start']
+    end = end or info['global']['time_coverage_end']
+    chunks = time_chunks(start, end, chunk_days)
+    todo = []
+    for i, (t0, t1) in enumerate(chunks):
+        fname = os.path.join(path, f'{t0:%Y%m%dT%H%M%S}_{t1:%Y%m%dT%H%M%S}.parquet')
+        if refresh_from is None:
+            refresh = refresh_last and i == len(chunks) - 1
+        else:
+            refresh = t1 > refresh_from
+        if not os.path.isfile(fname) or refresh:
+            todo.append((download_url(dataset_id, variables, t0, t1, server), fname))
+    print(f'{dataset_id}: downloading {len(todo)} of {len(chunks)} chunks with {workers} workers')
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_download_retry, url, fname, variables, retries): fname for url, fname in todo}
+        for future in as_completed(futures):
+            error = future.result()
+            if error:
+                failed.append(futures[future])
+                print(f'{dataset_id}: failed {os.path.basename(futures[future])}: {error}')
+    if failed:
+        print(f'{dataset_id}: {len(failed)} chunks failed, run again to resume the download')
+
+    return path
+
+
+def _download_retry(url, fname, variables, retries=3):
+    """
+    :return: error message if the chunk couldn't be downloaded, otherwise None
+    """
+    error = None
+    for attempt in range(retries):
+        try:
+            download_chunk(url, fname, variables)
+            return None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)
+
+    return error
+
+
+def read_cache(path, variables=None):
+    """
+    Read a deployment from the Parquet cache. Chunk files that overlap (e.g. cached with a different chunk length) can
+    have the same observations, so only the row from the most recently downloaded file is kept for each time
+    :param path: cache directory from fetch_deployment
+    :param variables: optional list of variables to read, default is all of the cached variables
+    :return: dataframe sorted by time
+    """
+    with open(os.path.join(path, 'variables.json')) as f:
+        cached = json.load(f)
+    columns = list(dict.fromkeys(['time'] + [v for v in (variables or cached) if v in cached]))
+    files = sorted(glob.glob(os.path.join(path, '*.parquet')), key=os.path.getmtime)
+    chunks = [pd.read_parquet(f, columns=columns) for f in files]
+    chunks = [df for df in chunks if len(df) > 0]
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(chunks, ignore_index=True).sort_values('time', kind='stable')
+
+    return df.drop_duplicates('time', keep='last')
+
+
+def open_cache(path, variables=None, chunk_size=1000000):
+    """
+    Open a deployment from the Parquet cache as a time-series xarray dataset (like common.to_timeseries) with the
+    attributes from the ERDDAP server. The variables are read into memory, then split into dask chunks
+    :param path: cache directory from fetch_deployment
+    :param variables: optional list of variables to read, default is all of the cached variables
+    :param chunk_size: number of observations in each dask chunk
+    :return: xarray dataset with 'time' as the dimension
+    """
+    df = read_cache(path, variables)
+    ds = xr.Dataset({v: ('time', df[v].values) for v in df.columns if v != 'time'},
+                    coords={'time': ('time', df['time'].values)})
+
+    info_file = os.path.join(os.path.dirname(path), 'info.json')
+    if os.path.isfile(info_file):
+        with open(info_file) as f:
+            info = json.load(f)
+        ds.attrs = info['global']
+        for v in ds.variables:
+            attrs = {k: a for k, a in info['variables'].get(v, dict()).items() if k not in ['_FillValue', 'actual_range']}
+            if np.issubdtype(ds[v].dtype, np.datetime64):
+                attrs.pop('units', None)  # times are already decoded
+            ds[v].attrs = attrs
+
+    return ds.chunk({'time': chunk_size})
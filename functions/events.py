@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+
+"""
+Detect events (e.g. hypoxia, low aragonite saturation) in glider deployments. Each rule in EVENT_RULES is checked once
+for all of the deployments together, exceedances from the same deployment that are close in time are merged into
+events, and the events and the data points in them are saved to an indexed SQLite database so maps and reports can
+query them without reading the deployment files again.
+"""
+import contextlib
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# name: event type
+# variable: variable the rule is applied to
+# scale: optional factor applied to the variable first (e.g. unit conversion)
+# below/above: the variable is in an event when it's below (or above) this value
+EVENT_RULES = [
+    dict(name='low_do', variable='oxygen_concentration_shifted', scale=31.998 / 1000, below=3, units='mg/L'),  # umol/L to mg/L
+    dict(name='low_omega', variable='aragonite_saturation_state', below=1, units='1'),
+    dict(name='low_ph', variable='pH_corrected', below=7.75, units='1')
+]
+
+EVENT_COLUMNS = ['event_id', 'rule', 'variable', 'deployment', 'start_time', 'end_time', 'n_obs', 'lon_min', 'lon_max',
+                 'lat_min', 'lat_max', 'depth_min', 'depth_max', 'extreme_value']
+POINT_COLUMNS = ['event_id', 'rule', 'deployment', 'time', 'longitude', 'latitude', 'depth', 'value']
+
+
+def _concat(deployments, variable):
+    values = [df[variable].values if variable in df.columns else np.full(len(df), np.nan)
+              for df in deployments.values()]
+    return np.concatenate(values).astype('float64') if values else np.array([])
+
+
+def detect_events(deployments, rules=None, max_gap=np.timedelta64(2, 'h'), depth_var='depth_interpolated'):
+    """
+    Find the data that exceed each rule and merge the exceedances into events. Exceedances from the same deployment are
+    in the same event unless they are more than max_gap apart.
+    :param deployments: dictionary of deployment name: dataframe indexed by time (sorted) with longitude, latitude,
+    depth and the rule variables, e.g. from alignment.load_deployments
+    :param rules: list of event rules, default is EVENT_RULES
+    :param max_gap: maximum time between exceedances in the same event
+    :param depth_var: the name of the depth variable
+    :return: dataframe of events (start/end time and extent of each event) and dataframe of the data points in the
+    events
+    """
+    rules = rules or EVENT_RULES
+    names = np.array(list(deployments.keys()), dtype=object)
+    code = np.repeat(np.arange(len(names)), [len(df) for df in deployments.values()])
+    times = np.concatenate([df.index.values for df in deployments.values()]) if len(names) else np.array([])
+    lon = _concat(deployments, 'longitude')
+    lat = _concat(deployments, 'latitude')
+    depth = _concat(deployments, depth_var)
+
+    events = []
+    points = []
+    next_id = 0
+    for rule in rules:
+        values = _concat(deployments, rule['variable']) * rule.get('scale', 1)
+        with np.errstate(invalid='ignore'):
+            if 'below' in rule:
+                exceeds = values < rule['below']
+            else:
+                exceeds = values > rule['above']
+        idx = np.flatnonzero(exceeds)
+        if len(idx) == 0:
+            continue
+
+        # a new event starts at a different deployment or after a gap
+        c = code[idx]
+        t = times[idx]
+        new = np.concatenate(([True], (c[1:] != c[:-1]) | (np.diff(t) > max_gap)))
+        starts = np.flatnonzero(new)
+        ends = np.append(starts[1:], len(idx)) - 1
+        event_id = next_id + np.cumsum(new) - 1
+        extreme = np.fmin.reduceat(values[idx], starts) if 'below' in rule else np.fmax.reduceat(values[idx], starts)
+
+        events.append(pd.DataFrame(dict(
+            event_id=event_id[starts], rule=rule['name'], variable=rule['variable'], deployment=names[c[starts]],
+            start_time=t[starts], end_time=t[ends], n_obs=ends - starts + 1,
+            lon_min=np.fmin.reduceat(lon[idx], starts), lon_max=np.fmax.reduceat(lon[idx], starts),
+            lat_min=np.fmin.reduceat(lat[idx], starts), lat_max=np.fmax.reduceat(lat[idx], starts),
+            depth_min=np.fmin.reduceat(depth[idx], starts), depth_max=np.fmax.reduceat(depth[idx], starts),
+            extreme_value=extreme)))
+        points.append(pd.DataFrame(dict(event_id=event_id, rule=rule['name'], deployment=names[c], time=t,
+                                        longitude=lon[idx], latitude=lat[idx], depth=depth[idx], value=values[idx])))
+        next_id = event_id[-1] + 1
+
+    events = pd.concat(events, ignore_index=True) if events else pd.DataFrame(columns=EVENT_COLUMNS)
+    points = pd.concat(points, ignore_index=True) if points else pd.DataFrame(columns=POINT_COLUMNS)
+
+    return events, points
+
+
+def write_events(events, points, dbfile, replace=True):
+    """
+    Save events and event data points to an SQLite database, indexed by event type, deployment, time and location
+    :param events: dataframe of events from detect_events
+    :param points: dataframe of event data points from detect_events
+    :param dbfile: database file
+    :param replace: True to replace the events already in the database, False to add to them. Added events are
+    numbered after the events already in the database, so event ids are unique
+    """
+    with contextlib.closing(sqlite3.connect(dbfile)) as con, con:
+        mode = 'replace' if replace else 'append'
+        exists = con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'events'").fetchone()
+        if not replace and exists:
+            last_id = con.execute('SELECT MAX(event_id) FROM events').fetchone()[0]
+            offset = 0 if last_id is None else int(last_id) + 1
+            events = events.assign(event_id=events.event_id + offset)
+            points = points.assign(event_id=points.event_id + offset)
+        events.assign(start_time=events.start_time.astype(str), end_time=events.end_time.astype(str)).to_sql(
+            'events', con, if_exists=mode, index=False)
+        points.assign(time=points.time.astype(str)).to_sql('event_points', con, if_exists=mode, index=False)
+        con.execute('CREATE INDEX IF NOT EXISTS idx_events_rule_time ON events (rule, start_time, end_time)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_events_deployment ON events (deployment)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_events_location ON events (lon_min, lon_max, lat_min, lat_max)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_event_points_event ON event_points (event_id)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_event_points_rule ON event_points (rule, deployment)')
+
+
+def _where(rule=None, deployment=None, start=None, end=None, extent=None):
+    """
+    :return: SQL conditions on the events table and the query parameters
+    """
+    conditions = []
+    params = []
+    if rule:
+        conditions.append('rule = ?')
+        params.append(rule)
+    if deployment:
+        conditions.append('deployment = ?')
+        params.append(deployment)
+    if start:
+        conditions.append('end_time >= ?')
+        params.append(str(pd.Timestamp(start)))
+    if end:
+        conditions.append('start_time <= ?')
+        params.append(str(pd.Timestamp(end)))
+    if extent:
+        conditions.append('lon_max >= ? AND lon_min <= ? AND lat_max >= ? AND lat_min <= ?')
+        params.extend(extent)
+
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def query_events(dbfile, rule=None, deployment=None, start=None, end=None, extent=None):
+    """
+    Get the events that match the criteria
+    :param dbfile: database file
+    :param rule: optional event type (e.g. 'low_do')
+    :param deployment: optional deployment name
+    :param start: optional, events that end after this time
+    :param end: optional, events that start before this time
+    :param extent: optional map limits [lon min, lon max, lat min, lat max], events that overlap the extent
+    :return: dataframe of events
+    """
+    where, params = _where(rule, deployment, start, end, extent)
+    with contextlib.closing(sqlite3.connect(dbfile)) as con, con:
+        events = pd.read_sql(f'SELECT * FROM events{where} ORDER BY event_id', con, params=params,
+                             parse_dates=['start_time', 'end_time'])
+
+    return events
+
+
+def query_points(dbfile, rule=None, deployment=None, start=None, end=None, extent=None):
+    """
+    Get the data points in the events that match the criteria (see query_events). Only the points in the time window
+    and extent are returned, not every point of an event that overlaps them
+    :return: dataframe of event data points
+    """
+    where, params = _where(rule, deployment, start, end, extent)
+    conditions = [f'event_id IN (SELECT event_id FROM events{where})']
+    if start:
+        conditions.append('time >= ?')
+        params.append(str(pd.Timestamp(start)))
+    if end:
+        conditions.append('time <= ?')
+        params.append(str(pd.Timestamp(end)))
+    if extent:
+        conditions.append('longitude >= ? AND longitude <= ? AND latitude >= ? AND latitude <= ?')
+        params.extend(extent)
+    with contextlib.closing(sqlite3.connect(dbfile)) as con, con:
+        points = pd.read_sql(f'SELECT * FROM event_points WHERE {" AND ".join(conditions)} ORDER BY event_id, time',
+                             con, params=params, parse_dates=['time'])
+
+    return points
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+
+"""
+Grid glider deployments onto a regular (profile, depth) grid using common.depth_bin_arrays. Gridded datasets can be
+cached on disk (Zarr if it's installed, otherwise NetCDF) keyed by the source file hash and the binning settings, so
+later analyses can load the regular grid without binning the raw data again.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+import functions.common as cf
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def cache_key(fname, variables, zvar, timevar, depth_min, depth_max, stride):
+    """
+    :return: hash of the source file contents and the gridding settings
+    """
+    settings = dict(variables=sorted(variables), zvar=zvar, timevar=timevar, depth_min=depth_min,
+                    depth_max=depth_max, stride=stride)
+    key = hashlib.sha1(cf.file_hash(fname).encode())
+    key.update(json.dumps(settings, sort_keys=True).encode())
+
+    return key.hexdigest()[0:16]
+
+
+def grid_deployment(fname, variables, zvar='pressure', timevar='profile_time', depth_min=0, depth_max=None, stride=1,
+                    cache_dir=None, profile_chunk=256):
+    """
+    Average the data from each profile in a deployment into depth bins and return a dense (profile, depth) dataset.
+    All profiles share the same depth bins, from depth_min to depth_max (or the deepest observation).
+    :param fname: deployment NetCDF file
+    :param variables: list of variables to grid
+    :param zvar: the name of the depth variable used to define the bins, default is 'pressure'
+    :param timevar: the name of the variable identifying the profiles, default is 'profile_time'
+    :param depth_min: the shallowest bin depth
+    :param depth_max: the deepest bin depth
+    :param stride: the amount of space between each bin
+    :param cache_dir: optional directory for cached gridded datasets. If a cached dataset for this file and these
+    settings exists it's returned instead of gridding the data again
+    :param profile_chunk: number of profiles in each dask chunk (and chunk of the cached dataset)
+    :return: xarray dataset with dimensions (profile, depth), backed by dask arrays chunked by profile whether it was
+    read from the cache or gridded
+    """
+    if cache_dir:
+        key = cache_key(fname, variables, zvar, timevar, depth_min, depth_max, stride)
+        ext = 'zarr' if zarr else 'nc'
+        cache_file = os.path.join(cache_dir, f'{os.path.basename(fname).split(".nc")[0]}_gridded_{key}.{ext}')
+        if os.path.exists(cache_file):
+            return _open_cache(cache_file)
+
+    with xr.open_dataset(fname) as ds:
+        attrs = {v: ds[v].attrs for v in variables + [zvar]}
+        deploy = ds.attrs.get('title', os.path.basename(fname))
+        depth = ds[zvar].values
+        data = {v: ds[v].values for v in variables if v != zvar}
+        data[zvar] = depth
+        profiles, profile = np.unique(ds[timevar].values, return_inverse=True)
+
+    bins, binned = cf.depth_bin_arrays(depth, data, profile=profile.ravel(), depth_min=depth_min,
+                                       depth_max=depth_max or np.nanmax(depth), stride=stride, counts=True)
+    shape = (len(profiles), len(bins) - 1)
+
+    gridded = xr.Dataset(coords=dict(profile=('profile', profiles), depth=('depth', (bins[:-1] + bins[1:]) / 2)))
+    gridded['profile'].attrs = dict(long_name='Profile Time', comment=f'Values of {timevar} for each profile')
+    gridded['depth'].attrs = dict(long_name='Depth Bin Center', units=attrs[zvar].get('units', ''),
+                                  bounds='depth_bnds')
+    gridded['depth_bnds'] = (('depth', 'nv'), np.column_stack((bins[:-1], bins[1:])))
+    for v in data.keys():
+        name = f'{zvar}_mean' if v == zvar else v
+        gridded[name] = (('profile', 'depth'), binned[v].reshape(shape))
+        gridded[name].attrs = attrs[v]
+    gridded['count'] = (('profile', 'depth'), binned[f'{zvar}_count'].reshape(shape).astype('int32'))
+    gridded['count'].attrs = dict(long_name='Number of Observations in Bin')
+    gridded.attrs = dict(title=deploy, source_file=os.path.basename(fname), timevar=timevar, zvar=zvar,
+                         depth_min=depth_min, stride=stride,
+                         comment=f'Data averaged into {stride} {attrs[zvar].get("units", "")} bins for each profile')
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        if zarr:
+            gridded.chunk({'profile': profile_chunk}).to_zarr(cache_file, mode='w')
+        else:
+            encoding = {v: dict(zlib=True, chunksizes=(min(profile_chunk, shape[0]), shape[1]))
+                        for v in gridded.data_vars if gridded[v].dims == ('profile', 'depth')}
+            gridded.to_netcdf(cache_file, encoding=encoding)
+        return _open_cache(cache_file)
+
+    return gridded.chunk({'profile': profile_chunk})
+
+
+def _open_cache(cache_file):
+    """
+    :return: the cached gridded dataset, opened lazily with the chunks it was saved with
+    """
+    if zarr:
+        return xr.open_zarr(cache_file)
+    return xr.open_dataset(cache_file, chunks={})
@@ -1,6 +1,79 @@
 #! /usr/bin/env python3
 
+import time
+import warnings
 import numpy as np
+import pandas as pd
+import xarray as xr
+import gsw
+import functions.common as cf
+import functions.ragged as ragged
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# reason codes for profiles without MLD, in the order the checks are run (0 means MLD was calculated)
+MLD_REASONS = {
+    0: 'mld_calculated',
+    1: 'no_data',
+    2: 'pressure_range_lt_5dbar',
+    3: 'fewer_than_5_bins',
+    4: 'fewer_than_3_n2_values',
+    5: 'data_gap_exceeds_threshold',
+    6: 'max_n2_at_profile_edge',
+    7: 'mld_lt_5dbar',
+    8: 'mld_within_2dbar_of_profile_bounds',
+    9: 'qi_below_threshold'
+}
+
+MLD_COMMENT = ('Mixed Layer Depth calculated as the depth of max Brunt‐Vaisala frequency squared (N**2) from Carvalho et al '
+               '2016 (https://doi.org/10.1002/2016GL071205)')
+# profile_mld_batch runs the N**2, MLD and QI checks with the compiled loop kernel when numba is installed, otherwise
+# with segmented numpy operations
+MLD_BACKEND = 'numba' if numba else 'numpy'
+
+N2_COMMENT = ('Maximum Brunt‐Vaisala frequency squared (N**2) for each profile used to calculate Mixed Layer Depth from '
+              'Carvalho et al 2016 (https://doi.org/10.1002/2016GL071205). This can be used as a measurement for '
+              'stratification strength')
+
+# alternative MLD criteria that can be calculated with the max N**2 MLD, on the same binned profiles (see
+# profile_mld_batch). Each criterion is calculated by the function for its method in MLD_METHODS
+# name: used for the output columns/variables (e.g. mld_<name>)
+# method: 'threshold' - depth where the variable first differs from the value at the reference depth by more than
+#   delta, interpolated between bins. The reference value is from the first bin at or below ref_depth, and the
+#   criterion isn't calculated if that bin is more than 5 dbar below ref_depth
+#   'gradient' - depth (midpoint of the two bins) where the absolute vertical gradient of the variable first exceeds
+#   gradient (units per dbar), below ref_depth
+#   'max_n2' - depth of max N**2 with the same checks and Quality Index as profile_mld (e.g. for a different variable)
+# variable: variable the criterion is applied to
+MLD_CRITERIA = [
+    dict(name='density_threshold', method='threshold', variable='density', delta=0.03, ref_depth=10,
+         comment='Depth where density differs from the density at 10 dbar by 0.03 kg m-3, de Boyer Montegut et al 2004 '
+                 '(https://doi.org/10.1029/2004JC002378)'),
+    dict(name='temperature_threshold', method='threshold', variable='temperature', delta=0.2, ref_depth=10,
+         comment='Depth where temperature differs from the temperature at 10 dbar by 0.2 degrees C, de Boyer '
+                 'Montegut et al 2004 (https://doi.org/10.1029/2004JC002378)'),
+    dict(name='density_gradient', method='gradient', variable='density', gradient=0.0005, ref_depth=10,
+         comment='Depth where the density gradient first exceeds 0.0005 kg m-3 per dbar below 10 dbar, Dong et al '
+                 '2008 (https://doi.org/10.1029/2006JC004051)'),
+    dict(name='potential_density_max_n2', method='max_n2', variable='potential_density',
+         comment='Depth of max N**2 of potential density (see derived.add_derived) with the same checks and Quality '
+                 'Index as the max N**2 MLD, Carvalho et al 2016 (https://doi.org/10.1002/2016GL071205)')
+]
+
+
+def select_criteria(names):
+    """
+    :param names: list of MLD criteria names (see MLD_CRITERIA)
+    :return: list of the criteria, in the order of the names
+    """
+    criteria = {c['name']: c for c in MLD_CRITERIA}
+    unknown = [n for n in names or [] if n not in criteria]
+    if unknown:
+        raise ValueError(f'Unknown MLD criteria {unknown}, options are {list(criteria)}')
+
+    return [criteria[n] for n in dict.fromkeys(names or [])]
 
 
 def gap(prange):
@@ -22,7 +95,7 @@ def gap(prange):
     return gap_threshold
 
 
-def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5):
+def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5, return_reason=False):
     """
     Written by Sam Coakley and Lori Garzio, Jan 2022
     Calculates the Mixed Layer Depth (MLD) for a single profile as the depth of max Brunt‐Vaisala frequency squared
@@ -35,23 +108,33 @@ def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5):
     :param mld_var: the name of the variable for which MLD is calculated, default is 'density'
     :param zvar: the name of the depth variable in the dataframe, default is 'pressure'
     :param qi_threshold: quality index threshold for determining well-mixed water, default is 0.5
+    :param return_reason: if True, also return the reason code for why MLD wasn't calculated (see MLD_REASONS)
     :return: the depth of the mixed layer in the units of zvar and the max buoyancy frequency in units of s-2
     """
     df.dropna(subset=[mld_var], inplace=True)
     pN2 = np.sqrt(9.81 / np.nanmean(df[mld_var]) * np.diff(df[mld_var], prepend=np.nan) / np.diff(df[zvar], prepend=np.nan)) ** 2
-    if len(df) < 5:  # if there are <5 data bins, don't calculate MLD
+    reason = 0
+    if len(df) == 0:
         mld = np.nan
         maxN2 = np.nan
         qi = np.nan
+        reason = 1
+    elif len(df) < 5:  # if there are <5 data bins, don't calculate MLD
+        mld = np.nan
+        maxN2 = np.nan
+        qi = np.nan
+        reason = 3
     elif np.sum(~np.isnan(pN2)) < 3:  # if there are <3 values calculated for pN2, don't calculate MLD
         mld = np.nan
         maxN2 = np.nan
         qi = np.nan
+        reason = 4
     elif np.nanmax(np.diff(df[zvar])) > gap(np.nanmax(df[zvar]) - np.nanmin(df[zvar])):
         # if there is a gap in the profile that exceeds the defined threshold, don't calculate MLD
         mld = np.nan
         maxN2 = np.nan
         qi = np.nan
+        reason = 5
     else:
         pressure_range = [np.nanmin(df[zvar]), np.nanmax(df[zvar])]
 
@@ -63,6 +146,7 @@ def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5):
             mld = np.nan
             maxN2 = np.nan
             qi = np.nan
+            reason = 6
         else:
             mld = np.nanmean([df[zvar][mld_idx], df[zvar][mld_idx + 1]])
 
@@ -71,11 +155,13 @@ def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5):
                 mld = np.nan
                 maxN2 = np.nan
                 qi = np.nan
+                reason = 7
             elif np.logical_or(mld < pressure_range[0] + 2, mld > pressure_range[1] - 2):
                 # if MLD is within 2 dbar of the top or bottom of the profile, return nan
                 mld = np.nan
                 maxN2 = np.nan
                 qi = np.nan
+                reason = 8
             else:
                 if qi_threshold:
                     # find MLD  1.5
@@ -93,5 +179,756 @@ def profile_mld(df, mld_var='density', zvar='pressure', qi_threshold=0.5):
                         # if the Quality Index is < the threshold, this indicates well-mixed water so don't return MLD
                         mld = np.nan
                         maxN2 = np.nan
+                        reason = 9
+
+    if return_reason:
+        return mld, maxN2, qi, reason
 
     return mld, maxN2, qi
+
+
+def gap_batch(prange):
+    """
+    Vectorized version of gap
+    :param prange: array of profile pressure ranges
+    :return: array of the maximum allowable data gap for each profile
+    """
+    prange = np.asarray(prange, dtype='float64')
+    conditions = [prange < 20, prange < 50, prange < 200, prange < 500]
+    return np.select(conditions, [8, 10, 25, 50], default=75)
+
+
+def _timer(timings, stage, start):
+    """
+    Add the time since start to the stage in the timings dictionary (if timings is provided)
+    :return: the current time, the start of the next stage
+    """
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + now - start
+    return now
+
+
+def _segment_starts(codes):
+    """
+    :param codes: sorted array of segment codes
+    :return: index of the first element of each run of identical codes
+    """
+    return np.flatnonzero(np.diff(codes, prepend=codes[:1] - 1))
+
+
+def profile_mld_batch(profile_id, pressure, values, qi_threshold=0.5, return_bins=False, timings=None, backend=None,
+                      criteria=None, data=None):
+    """
+    Calculates the Mixed Layer Depth (MLD) for every profile in a deployment at once using the same method as
+    profile_mld. Data are averaged into 1 dbar pressure bins with common.depth_bin_arrays and the N**2, data gap and
+    Quality Index (QI) checks are run for all profiles together with segmented numpy operations (or in one compiled
+    loop over the profiles when numba is installed) instead of grouping the data by profile. Results agree with
+    depth_bin + profile_mld to floating point rounding.
+    :param profile_id: array of profile identifiers for each observation (e.g. profile_time)
+    :param pressure: array of pressure for each observation, data collected at the surface should already be set to nan
+    :param values: array of the variable used to calculate MLD (e.g. density) for each observation
+    :param qi_threshold: quality index threshold for determining well-mixed water, default is 0.5
+    :param return_bins: if True, also return the binned N**2 profiles
+    :param timings: optional dictionary that the time spent (seconds) binning the data, calculating N**2 and running
+    the checks, and calculating QI is added to ('binning', 'n2' and 'qi'). The numba backend runs the checks and QI
+    together in the 'n2' stage
+    :param backend: 'numba' to run the checks for each profile in a compiled loop, or 'numpy' for segmented numpy
+    operations, default is MLD_BACKEND. Both give the same results
+    :param criteria: optional list of additional MLD criteria (see MLD_CRITERIA), calculated on the same bins. The time
+    spent is added to the 'criteria' stage in timings
+    :param data: dictionary of variable: array for each observation with the variables used by the criteria, data
+    collected at the surface should already be set to nan
+    :return: pandas dataframe indexed by profile with columns mld (units of pressure), max_n2 (s-2), qi and reason (why
+    MLD wasn't calculated, see MLD_REASONS), plus <column>_<name> columns for each criterion (e.g.
+    mld_density_threshold).
+    If return_bins is True, also a dataframe of the bins used to calculate MLD (sorted by profile and pressure) with
+    columns profile, pressure, values (the binned MLD variable), n2 and the binned criteria variables
+    """
+    start = time.perf_counter()
+    backend = backend or MLD_BACKEND
+    if backend == 'numba' and numba is None:
+        warnings.warn('numba is not installed, calculating MLD with numpy', stacklevel=2)
+        backend = 'numpy'
+    profiles, inverse = np.unique(np.asarray(profile_id), return_inverse=True)
+    inverse = inverse.ravel()
+    pressure = np.asarray(pressure, dtype='float64')
+    values = np.asarray(values, dtype='float64')
+    nprofiles = len(profiles)
+
+    mld = np.full(nprofiles, np.nan)
+    max_n2 = np.full(nprofiles, np.nan)
+    qi = np.full(nprofiles, np.nan)
+    reason = np.ones(nprofiles, dtype='int8')
+    result = pd.DataFrame(dict(mld=mld, max_n2=max_n2, qi=qi, reason=reason), index=pd.Index(profiles, name='profile'))
+    bins = pd.DataFrame(dict(profile=profiles[:0], pressure=np.array([]), values=np.array([]), n2=np.array([])))
+    for v in list(dict.fromkeys(c['variable'] for c in criteria or [])):
+        bins[v] = np.array([])
+
+    # average the data (and the variables for the other MLD criteria) into 1 dbar bins for each profile. The pressure
+    # of the bins for each criteria variable is the mean pressure of the observations that have data for the variable
+    criteria = criteria or []
+    criteria_vars = list(dict.fromkeys(c['variable'] for c in criteria))
+    arrays = dict(pressure=pressure, values=values)
+    for v in criteria_vars:
+        arrays[v] = np.asarray(data[v], dtype='float64')
+        arrays[f'_pressure_{v}'] = np.where(np.isnan(arrays[v]), np.nan, pressure)
+    _, binned = cf.depth_bin_arrays(pressure, arrays, profile=inverse, counts=True)
+    start = _timer(timings, 'binning', start)
+
+    # the other MLD criteria, each using the bins that have data for its variable
+    for criterion in criteria:
+        var = criterion['variable']
+        keep = binned[f'{var}_count'] > 0
+        cprof = binned['profile'][keep]
+        cseg = _segment_starts(cprof)
+        cnbins = np.diff(np.append(cseg, len(cprof)))
+        output = MLD_METHODS[criterion['method']](binned[f'_pressure_{var}'][keep], binned[var][keep], cseg, cnbins,
+                                                  criterion, qi_threshold=qi_threshold, backend=backend)
+        for key, seg_values in output.items():
+            column = np.ones(nprofiles, dtype='int8') if key == 'reason' else np.full(nprofiles, np.nan)
+            column[cprof[cseg]] = seg_values
+            result[f'{key}_{criterion["name"]}'] = column
+    if criteria:
+        start = _timer(timings, 'criteria', start)
+
+    # drop bins without data for the MLD variable
+    keep = binned['values_count'] > 0
+    z = binned['pressure'][keep]
+    rho = binned['values'][keep]
+    bin_prof = binned['profile'][keep]
+    if len(z) == 0:
+        return (result, bins) if return_bins else result
+
+    # profile segments of the binned data
+    seg = _segment_starts(bin_prof)
+    nbins = np.diff(np.append(seg, len(z)))
+    if backend == 'numba':
+        seg_mld, seg_max_n2, seg_qi, seg_reason, pn2 = _mld_kernel(z, rho, seg, nbins, float(qi_threshold or 0),
+                                                                   bool(qi_threshold))
+        _timer(timings, 'n2', start)
+    else:
+        seg_mld, seg_max_n2, seg_qi, seg_reason, pn2 = _mld_segments(z, rho, seg, nbins, qi_threshold, timings, start)
+
+    profile_idx = bin_prof[seg]
+    mld[profile_idx] = seg_mld
+    max_n2[profile_idx] = seg_max_n2
+    qi[profile_idx] = seg_qi
+    reason[profile_idx] = seg_reason
+    result['mld'] = mld
+    result['max_n2'] = max_n2
+    result['qi'] = qi
+    result['reason'] = reason
+
+    if return_bins:
+        bins = pd.DataFrame(dict(profile=profiles[bin_prof], pressure=z, values=rho, n2=pn2))
+        for v in criteria_vars:
+            bins[v] = binned[v][keep]
+        return result, bins
+
+    return result
+
+
+def _mld_segments(z, rho, seg, nbins, qi_threshold=0.5, timings=None, start=None):
+    """
+    Calculate N**2, MLD and QI for binned profiles stored one after the other with segmented numpy operations
+    :param z: binned pressure, sorted by profile and pressure
+    :param rho: binned MLD variable
+    :param seg: index of the first bin of each profile
+    :param nbins: number of bins in each profile
+    :param qi_threshold: quality index threshold for determining well-mixed water
+    :param timings: optional dictionary that the time spent in the 'n2' and 'qi' stages is added to
+    :param start: start time of the 'n2' stage
+    :return: mld, max_n2, qi and reason code for each profile and N**2 for each bin
+    """
+    start = start or time.perf_counter()
+    seg_id = np.repeat(np.arange(len(seg)), nbins)
+    local_idx = np.arange(len(z)) - seg[seg_id]
+    last = seg + nbins - 1
+    zmin = z[seg]
+    zmax = z[last]
+
+    # calculate N2 for every bin, the first bin of each profile is nan
+    rho_mean = np.add.reduceat(rho, seg) / nbins
+    drho = np.diff(rho, prepend=np.nan)
+    dz = np.diff(z, prepend=np.nan)
+    drho[seg] = np.nan
+    dz[seg] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pn2 = np.sqrt(9.81 / rho_mean[seg_id] * drho / dz) ** 2
+    n2_count = np.add.reduceat(~np.isnan(pn2), seg)
+    max_gap = np.fmax.reduceat(dz, seg)
+    seg_max_n2 = np.fmax.reduceat(pn2, seg)
+
+    # profiles that span <5 dbar, have <5 data bins, <3 N2 values or a gap exceeding the threshold are skipped
+    with np.errstate(invalid='ignore'):
+        checks = [zmax - zmin < 5, nbins < 5, n2_count < 3, max_gap > gap_batch(zmax - zmin)]
+    valid = ~np.logical_or.reduce(checks)
+
+    # index of the first occurrence of max N2 in each profile
+    ismax = pn2 == seg_max_n2[seg_id]
+    mld_idx = np.minimum.reduceat(np.where(ismax, local_idx, len(z)), seg)
+
+    # if the max N2 is the first or last data point of the profile, don't calculate MLD
+    checks.append((mld_idx == 0) | (mld_idx >= nbins - 1))
+    valid &= ~checks[-1]
+    mld_pos = seg + np.where(valid, mld_idx, 0)
+    seg_mld = np.where(valid, (z[mld_pos] + z[np.minimum(mld_pos + 1, len(z) - 1)]) / 2, np.nan)
+
+    # if MLD is <5 or within 2 dbar of the top or bottom of the profile, don't calculate MLD
+    with np.errstate(invalid='ignore'):
+        checks.append(~(seg_mld >= 5))
+        checks.append(~((seg_mld >= zmin + 2) & (seg_mld <= zmax - 2)))
+    valid &= ~checks[-2] & ~checks[-1]
+    seg_mld[~valid] = np.nan
+    seg_max_n2[~valid] = np.nan
+    seg_qi = np.full(len(seg), np.nan)
+    mixed = np.zeros(len(seg), dtype=bool)
+    start = _timer(timings, 'n2', start)
+
+    if qi_threshold and np.any(valid):
+        # index of the data point closest to MLD * 1.5
+        dist = np.abs(z - seg_mld[seg_id] * 1.5)
+        dist[np.isnan(dist)] = np.inf
+        isclosest = dist == np.minimum.reduceat(dist, seg)[seg_id]
+        mld15_idx = np.minimum.reduceat(np.where(isclosest, local_idx, len(z)), seg)
+
+        # Calculate Quality index (QI) from Lorbacher et al, 2006 doi:10.1029/2003JC002157
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std_mld = _segment_std(rho, seg, seg_id, local_idx < mld_idx[seg_id])
+            std_mld15 = _segment_std(rho, seg, seg_id, local_idx < mld15_idx[seg_id])
+            seg_qi = np.where(valid, 1 - std_mld / std_mld15, np.nan)
+
+        # if the Quality Index is < the threshold, this indicates well-mixed water so don't return MLD
+        mixed = seg_qi < qi_threshold
+        seg_mld[mixed] = np.nan
+        seg_max_n2[mixed] = np.nan
+    checks.append(mixed)
+    _timer(timings, 'qi', start)
+
+    # the reason code is the first check that failed
+    seg_reason = np.select(checks, np.arange(2, len(checks) + 2), default=0)
+
+    return seg_mld, seg_max_n2, seg_qi, seg_reason, pn2
+
+
+def _jit(func):
+    """
+    Compile a function with numba if it's installed, divisions by zero return inf/nan like numpy
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, error_model='numpy')(func)
+
+
+@_jit
+def _std_first(values, start, count):
+    """
+    :return: population standard deviation of the first count values from start, nan if count is 0
+    """
+    if count == 0:
+        return np.nan
+    mean = 0.0
+    for i in range(start, start + count):
+        mean += values[i]
+    mean /= count
+    sqr = 0.0
+    for i in range(start, start + count):
+        sqr += (values[i] - mean) ** 2
+    return np.sqrt(sqr / count)
+
+
+@_jit
+def _mld_kernel(z, rho, seg, nbins, qi_threshold, calc_qi):
+    """
+    Loop version of _mld_segments: the N**2, data gap, MLD and QI checks are run one profile at a time on the raw
+    arrays. Compiled with numba, this avoids the temporary arrays of the segmented numpy operations
+    :param z: binned pressure, sorted by profile and pressure
+    :param rho: binned MLD variable
+    :param seg: index of the first bin of each profile
+    :param nbins: number of bins in each profile
+    :param qi_threshold: quality index threshold for determining well-mixed water
+    :param calc_qi: False to skip the Quality Index
+    :return: mld, max_n2, qi and reason code for each profile and N**2 for each bin
+    """
+    nseg = len(seg)
+    mld = np.full(nseg, np.nan)
+    max_n2 = np.full(nseg, np.nan)
+    qi = np.full(nseg, np.nan)
+    reason = np.zeros(nseg, dtype=np.int8)
+    pn2 = np.full(len(z), np.nan)
+    for s in range(nseg):
+        a = seg[s]
+        n = nbins[s]
+        zmin = z[a]
+        zmax = z[a + n - 1]
+        prange = zmax - zmin
+
+        # N2 for each bin (the first bin is nan), the largest gap and the first bin with max N2
+        rho_mean = 0.0
+        for i in range(a, a + n):
+            rho_mean += rho[i]
+        rho_mean /= n
+        n2_count = 0
+        max_gap = np.nan
+        seg_max_n2 = np.nan
+        mld_idx = -1
+        for i in range(a + 1, a + n):
+            dz = z[i] - z[i - 1]
+            pn2[i] = np.sqrt(9.81 / rho_mean * (rho[i] - rho[i - 1]) / dz) ** 2
+            if np.isnan(max_gap) or dz > max_gap:
+                max_gap = dz
+            if not np.isnan(pn2[i]):
+                n2_count += 1
+                if np.isnan(seg_max_n2) or pn2[i] > seg_max_n2:
+                    seg_max_n2 = pn2[i]
+                    mld_idx = i - a
+
+        # maximum allowable data gap, see gap
+        if prange < 20:
+            gap_threshold = 8
+        elif prange < 50:
+            gap_threshold = 10
+        elif prange < 200:
+            gap_threshold = 25
+        elif prange < 500:
+            gap_threshold = 50
+        else:
+            gap_threshold = 75
+
+        # the reason code is the first check that fails, in the same order as _mld_segments
+        if prange < 5:
+            reason[s] = 2
+        elif n < 5:
+            reason[s] = 3
+        elif n2_count < 3:
+            reason[s] = 4
+        elif max_gap > gap_threshold:
+            reason[s] = 5
+        elif mld_idx <= 0 or mld_idx >= n - 1:
+            reason[s] = 6
+        else:
+            seg_mld = (z[a + mld_idx] + z[a + mld_idx + 1]) / 2
+            if not seg_mld >= 5:
+                reason[s] = 7
+            elif not (zmin + 2 <= seg_mld <= zmax - 2):
+                reason[s] = 8
+            else:
+                mld[s] = seg_mld
+                max_n2[s] = seg_max_n2
+                if calc_qi:
+                    # index of the data point closest to MLD * 1.5
+                    target = seg_mld * 1.5
+                    closest = np.inf
+                    mld15_idx = 0
+                    for i in range(n):
+                        dist = abs(z[a + i] - target)
+                        if dist < closest:
+                            closest = dist
+                            mld15_idx = i
+
+                    # Calculate Quality index (QI) from Lorbacher et al, 2006 doi:10.1029/2003JC002157
+                    qi[s] = 1 - _std_first(rho, a, mld_idx) / _std_first(rho, a, mld15_idx)
+                    if qi[s] < qi_threshold:
+                        # well-mixed water, don't return MLD
+                        mld[s] = np.nan
+                        max_n2[s] = np.nan
+                        reason[s] = 9
+
+    return mld, max_n2, qi, reason, pn2
+
+
+def _threshold_criterion(z, values, seg, nbins, criterion, **kwargs):
+    """
+    MLD where the variable first differs from the value at the reference depth by more than criterion['delta'],
+    interpolated between the bins on either side of the crossing
+    :param z: binned pressure, sorted by profile and pressure
+    :param values: binned variable
+    :param seg: index of the first bin of each profile
+    :param nbins: number of bins in each profile
+    :param criterion: criterion dictionary (see MLD_CRITERIA)
+    :return: dictionary with the MLD for each profile
+    """
+    seg_id = np.repeat(np.arange(len(seg)), nbins)
+    local_idx = np.arange(len(z)) - seg[seg_id]
+
+    # the reference value is from the first bin at or below the reference depth
+    ref_idx = np.minimum.reduceat(np.where(z >= criterion['ref_depth'], local_idx, len(z)), seg)
+    has_ref = ref_idx < nbins
+    ref_pos = seg + np.where(has_ref, ref_idx, 0)
+    has_ref &= z[np.minimum(ref_pos, len(z) - 1)] <= criterion['ref_depth'] + 5
+    diff = np.abs(values - values[np.minimum(ref_pos, len(z) - 1)][seg_id])
+
+    # first bin below the reference that exceeds the threshold
+    cross = (local_idx > ref_idx[seg_id]) & (diff > criterion['delta'])
+    first = np.minimum.reduceat(np.where(cross, local_idx, len(z)), seg)
+    found = has_ref & (first < nbins)
+    pos = np.clip(seg + first, 1, len(z) - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mld = z[pos - 1] + (criterion['delta'] - diff[pos - 1]) / (diff[pos] - diff[pos - 1]) * (z[pos] - z[pos - 1])
+
+    return dict(mld=np.where(found, mld, np.nan))
+
+
+def _gradient_criterion(z, values, seg, nbins, criterion, **kwargs):
+    """
+    MLD at the midpoint of the first two bins below the reference depth where the absolute vertical gradient of the
+    variable exceeds criterion['gradient'] (see _threshold_criterion for the parameters)
+    :return: dictionary with the MLD for each profile
+    """
+    seg_id = np.repeat(np.arange(len(seg)), nbins)
+    local_idx = np.arange(len(z)) - seg[seg_id]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gradient = np.abs(np.diff(values, prepend=np.nan) / np.diff(z, prepend=np.nan))
+        gradient[seg] = np.nan
+
+        # the shallower bin of the pair is at or below the reference depth
+        cross = (np.roll(z, 1) >= criterion['ref_depth']) & (gradient > criterion['gradient'])
+    first = np.minimum.reduceat(np.where(cross, local_idx, len(z)), seg)
+    found = first < nbins
+    pos = np.clip(seg + first, 1, len(z) - 1)
+
+    return dict(mld=np.where(found, (z[pos - 1] + z[pos]) / 2, np.nan))
+
+
+def _max_n2_criterion(z, values, seg, nbins, criterion, qi_threshold=0.5, backend='numpy'):
+    """
+    MLD from the depth of max N**2, the same as the main profile_mld_batch result (see _threshold_criterion for the
+    parameters). The criterion can have its own qi_threshold
+    :return: dictionary with the MLD, max N**2, QI and reason code for each profile
+    """
+    qi_threshold = criterion.get('qi_threshold', qi_threshold)
+    if backend == 'numba':
+        output = _mld_kernel(z, values, seg, nbins, float(qi_threshold or 0), bool(qi_threshold))
+    else:
+        output = _mld_segments(z, values, seg, nbins, qi_threshold)
+
+    return dict(mld=output[0], max_n2=output[1], qi=output[2], reason=output[3])
+
+
+# function for each MLD criterion method, called as function(z, values, seg, nbins, criterion, qi_threshold, backend)
+# with the binned profiles of the criterion variable and returning a dictionary of arrays with one value per profile
+MLD_METHODS = dict(threshold=_threshold_criterion, gradient=_gradient_criterion, max_n2=_max_n2_criterion)
+
+
+def profile_mld_iter(fname, mldvar='density', zvar='pressure', qi_threshold=0.5, block_profiles=500,
+                     rowsize_var='rowSize'):
+    """
+    Calculates the Mixed Layer Depth for the profiles in a ragged-array file in one pass, with profile_mld_batch run
+    on one block of profiles at a time (read with ragged.iter_blocks). Data collected at the surface (< 1 dbar) aren't
+    used.
+    :param fname: ragged-array NetCDF file name or xarray dataset (opened lazily)
+    :param mldvar: the name of the variable for which MLD is calculated, default is 'density'
+    :param zvar: the name of the pressure variable, default is 'pressure'
+    :param qi_threshold: quality index threshold for determining well-mixed water, default is 0.5
+    :param block_profiles: number of profiles calculated at a time
+    :param rowsize_var: the name of the variable with the number of observations in each profile
+    :return: pandas dataframe indexed by profile index with columns mld, max_n2, qi and reason (see MLD_REASONS)
+    """
+    results = []
+    for ids, codes, block in ragged.iter_blocks(fname, [zvar, mldvar], rowsize_var, block_profiles):
+        pressure = block[zvar].astype('float64')
+        values = block[mldvar].astype('float64')
+        surface = pressure < 1
+        pressure[surface] = np.nan
+        values[surface] = np.nan
+        block_results = profile_mld_batch(codes, pressure, values, qi_threshold).reindex(np.arange(len(ids)))
+        block_results.index = pd.Index(ids, name='profile')
+        results.append(block_results)
+
+    if not results:
+        return pd.DataFrame(columns=['mld', 'max_n2', 'qi', 'reason'], index=pd.Index([], name='profile'))
+
+    return pd.concat(results)
+
+
+def _segment_std(values, seg, seg_id, mask):
+    """
+    Population standard deviation of the masked values in each segment
+    :param values: array of values
+    :param seg: index of the first element of each segment
+    :param seg_id: segment number of each element
+    :param mask: boolean array, True for values to include
+    :return: standard deviation for each segment
+    """
+    count = np.add.reduceat(mask, seg)
+    mean = np.add.reduceat(np.where(mask, values, 0), seg) / count
+    sqr = np.where(mask, (values - mean[seg_id]) ** 2, 0)
+    return np.sqrt(np.add.reduceat(sqr, seg) / count)
+
+
+def mld_summary(reasons, timings=None, name=None):
+    """
+    Summarize why profiles in a deployment don't have MLD and where the calculation time went
+    :param reasons: array of the reason code for each profile (see MLD_REASONS), -1 for profiles that used the values
+    from a previous run
+    :param timings: optional dictionary of stage: seconds (e.g. from profile_mld_batch)
+    :param name: deployment name
+    :return: one-row dataframe indexed by deployment with the number of profiles, the number of profiles for each
+    reason code and the seconds spent in each stage
+    """
+    reasons = np.asarray(reasons, dtype='int64')
+    counts = np.bincount(reasons[reasons >= 0], minlength=len(MLD_REASONS))
+    row = dict(profiles=len(reasons), previous=int(np.sum(reasons < 0)))
+    row.update({MLD_REASONS[code]: counts[code] for code in MLD_REASONS})
+    row.update({f'{stage}_seconds': round(seconds, 4) for stage, seconds in (timings or {}).items()})
+
+    return pd.DataFrame([row], index=pd.Index([name], name='deployment'))
+
+
+def add_mld(ds, timevar='profile_time', mldvar='density', zvar='pressure', previous=None, chunk_profiles=500,
+            summary=False, profile_results=None):
+    """
+    Calculate the Mixed Layer Depth for every profile in a dataset using profile_mld_batch and add the MLD (dbar and
+    m) and max buoyancy frequency variables to the dataset. Data are read one chunk of profiles at a time, so the
+    dataset can be opened lazily (e.g. with common.open_deployment). Data collected at the surface (pressure < 1 dbar)
+    aren't used to calculate MLD.
+    :param ds: xarray dataset sorted by time, with 'time' as the only dimension
+    :param timevar: the name of the variable identifying profiles, default is 'profile_time'
+    :param mldvar: the name of the variable for which MLD is calculated, default is 'density'
+    :param zvar: the name of the pressure variable, default is 'pressure'
+    :param previous: optional dataframe indexed by profile with columns mld, max_n2, nobs (number of observations) and
+    optionally end_time (time of the last observation) from a previous run. Profiles with the same number of
+    observations (and last observation time) use the previous values and aren't recalculated
+    :param chunk_profiles: number of profiles read and calculated at a time
+    :param summary: if True, also return the reason codes and timings summary from mld_summary
+    :param profile_results: optional list that dataframes of the results for each profile (indexed by profile, with
+    columns mld, max_n2, qi and reason) are appended to, e.g. for profile_plots.plot_tasks. Profiles that use the
+    values from the previous run have qi nan and reason -1
+    :return: dataset with mld_dbar, mld and max_n2 added
+    """
+    dim = ds.time.dims[0]
+    read_vars = list(dict.fromkeys([timevar, 'pressure', zvar, mldvar]))
+
+    profile_ids = ds[timevar].values
+    profiles, profile_idx, nobs = np.unique(profile_ids, return_inverse=True, return_counts=True)
+    profile_idx = profile_idx.ravel()
+
+    mld = np.full(len(profile_ids), np.nan)
+    max_n2 = np.full(len(profile_ids), np.nan)
+    done = np.zeros(len(profiles), dtype=bool)
+    if previous is not None:
+        previous = previous.reindex(profiles)
+        done = previous.nobs.values == nobs
+        if 'end_time' in previous.columns:
+            # a reprocessed profile can have the same number of observations, so the last observation time is compared
+            done &= previous.end_time.values == pd.Series(ds.time.values).groupby(profile_idx).max().values
+        mld = previous.mld.values[profile_idx]
+        max_n2 = previous.max_n2.values[profile_idx]
+        if profile_results is not None and np.any(done):
+            profile_results.append(previous.loc[done, ['mld', 'max_n2']].assign(qi=np.nan, reason=-1))
+    reasons = np.full(len(profiles), -1)
+    timings = dict()
+
+    for sl in cf.profile_chunks(profile_idx, chunk_profiles):
+        calc = ~done[profile_idx[sl]]
+        if not np.any(calc):
+            continue
+        start = time.perf_counter()
+        df = ds[read_vars].isel({dim: sl}).to_dataframe()
+        _timer(timings, 'read', start)
+
+        # remove data (pressure plus the variable you're using to calculate MLD) that's collected at the surface (< 1 dbar)
+        df.loc[df.pressure < 1, ['pressure', mldvar]] = np.nan
+        df = df[calc]
+
+        # calculate MLD for all profiles in the chunk at once, then map the profile values back to each observation
+        results = profile_mld_batch(df[timevar].values, df[zvar].values, df[mldvar].values, timings=timings)
+        idx = np.searchsorted(results.index.values, df[timevar].values)
+        mld[sl][calc] = results.mld.values[idx]
+        max_n2[sl][calc] = results.max_n2.values[idx]
+        reasons[np.searchsorted(profiles, results.index.values)] = results.reason.values
+        if profile_results is not None:
+            profile_results.append(results[['mld', 'max_n2', 'qi', 'reason']])
+
+    # add mld to the dataset
+    mld_min = np.nanmin(mld)
+    mld_max = np.nanmax(mld)
+    attrs = {
+        'actual_range': np.array([mld_min, mld_max]),
+        'ancillary_variables': [mldvar, zvar],
+        'observation_type': 'calculated',
+        'units': ds[zvar].units,
+        'comment': MLD_COMMENT,
+        'long_name': 'Mixed Layer Depth'
+        }
+    da = xr.DataArray(mld, coords=ds[mldvar].coords, dims=ds[mldvar].dims,
+                      name='mld_dbar', attrs=attrs)
+    ds['mld_dbar'] = da
+
+    # calculate MLD in meters
+    mld_meters = gsw.z_from_p(-ds.mld_dbar.values, ds.latitude.values)
+
+    attrs = {
+        'actual_range': np.array([np.nanmin(mld_meters), np.nanmax(mld_meters)]),
+        'observation_type': 'calculated',
+        'units': 'm',
+        'comment': f'{MLD_COMMENT}. Calculated from MLD in dbar and latitude using gsw.z_from_p',
+        'long_name': 'Mixed Layer Depth'
+    }
+    da = xr.DataArray(mld_meters, coords=ds.mld_dbar.coords, dims=ds.mld_dbar.dims,
+                      name='mld', attrs=attrs)
+    ds['mld'] = da
+
+    # add maximum buoyancy frequency N2 (measure of stratification strength) to the dataset
+    n2_min = np.nanmin(max_n2)
+    n2_max = np.nanmax(max_n2)
+    attrs = {
+        'actual_range': np.array([n2_min, n2_max]),
+        'ancillary_variables': [mldvar, zvar],
+        'observation_type': 'calculated',
+        'units': 's-2',
+        'comment': N2_COMMENT,
+        'long_name': 'Maximum Buoyancy Frequency'
+    }
+    da = xr.DataArray(max_n2, coords=ds[mldvar].coords, dims=ds[mldvar].dims,
+                      name='max_n2', attrs=attrs)
+    ds['max_n2'] = da
+
+    if summary:
+        return ds, mld_summary(reasons, timings, ds.attrs.get('title'))
+
+    return ds
+
+
+def mld_profiles(ds, timevar='profile_time', mldvar='density', zvar='pressure', chunk_profiles=500, qi_threshold=0.5,
+                 summary=False, criteria=None):
+    """
+    Calculate the Mixed Layer Depth for every profile in a dataset (the same as add_mld) and return the results as a
+    profile-level dataset instead of repeating them for every observation. MLD, max N**2, QI and the reason code are on
+    the 'profile' dimension and the binned N**2 profiles are stored one after the other on the 'obs' dimension, with the
+    number of bins in each profile in 'rowSize' (CF contiguous ragged array, can be read with ragged.iter_profiles).
+    :param ds: xarray dataset sorted by time, with 'time' as the only dimension
+    :param timevar: the name of the variable identifying profiles, default is 'profile_time'
+    :param mldvar: the name of the variable for which MLD is calculated, default is 'density'
+    :param zvar: the name of the pressure variable, default is 'pressure'
+    :param chunk_profiles: number of profiles read and calculated at a time
+    :param qi_threshold: quality index threshold for determining well-mixed water, default is 0.5
+    :param summary: if True, also return the reason codes and timings summary from mld_summary
+    :param criteria: optional list of additional MLD criteria (see MLD_CRITERIA) calculated on the same binned profiles
+    and written side by side with the max N**2 MLD (mld_dbar_<name>, plus max_n2_<name>, qi_<name> and
+    mld_reason_<name> for max_n2 criteria). The binned criteria variables are also written (bin_<variable>)
+    :return: xarray dataset of profile-level MLD results and binned N**2 profiles, with an empty profile dimension if
+    the dataset doesn't have any profiles. Profiles are always all calculated, results from a previous run aren't
+    reused (incremental mode is only available with add_mld)
+    """
+    dim = ds.time.dims[0]
+    criteria = criteria or []
+    missing = [c['name'] for c in criteria if c['variable'] not in ds]
+    if missing:
+        warnings.warn(f'MLD criteria skipped, variable not in the dataset: {missing}', stacklevel=2)
+    criteria = [c for c in criteria if c['variable'] in ds]
+    criteria_vars = list(dict.fromkeys(c['variable'] for c in criteria))
+    read_vars = list(dict.fromkeys([timevar, 'pressure', zvar, mldvar, 'latitude', 'longitude'] + criteria_vars))
+    profile_ids = ds[timevar].values
+
+    results = []
+    bins = []
+    timings = dict()
+    # a dataset without profiles (e.g. all of the data were filtered out) is run as one empty chunk, so the output has
+    # the same variables with an empty profile dimension
+    for sl in list(cf.profile_chunks(profile_ids, chunk_profiles)) or [slice(0, 0)]:
+        start = time.perf_counter()
+        chunk = ds[read_vars].isel({dim: sl}).compute()
+        _timer(timings, 'read', start)
+        pid = chunk[timevar].values
+
+        # remove data (pressure plus the variable you're using to calculate MLD) that's collected at the surface (< 1 dbar)
+        surface = chunk.pressure.values < 1
+        z = chunk[zvar].values.astype('float64')
+        values = chunk[mldvar].values.astype('float64')
+        values[surface] = np.nan
+        if zvar == 'pressure':
+            z[surface] = np.nan
+
+        data = dict()
+        for v in criteria_vars:
+            data[v] = chunk[v].values.astype('float64')
+            data[v][surface] = np.nan
+
+        chunk_results, chunk_bins = profile_mld_batch(pid, z, values, qi_threshold, return_bins=True, timings=timings,
+                                                      criteria=criteria, data=data)
+
+        # number of observations and mean position of each profile
+        _, inverse, nobs = np.unique(pid, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        chunk_results['nobs'] = nobs
+        for v in ['latitude', 'longitude']:
+            pos = chunk[v].values.astype('float64')
+            ok = ~np.isnan(pos)
+            with np.errstate(invalid='ignore'):
+                chunk_results[v] = (np.bincount(inverse[ok], pos[ok], minlength=len(nobs)) /
+                                    np.bincount(inverse[ok], minlength=len(nobs)))
+        results.append(chunk_results)
+        bins.append(chunk_bins)
+
+    results = pd.concat(results)
+    bins = pd.concat(bins, ignore_index=True)
+    rowsize = bins.groupby('profile').size().reindex(results.index, fill_value=0).values
+    mld_meters = gsw.z_from_p(-results.mld.values, results.latitude.values)
+
+    zunits = ds[zvar].units
+    out = xr.Dataset(
+        data_vars={
+            timevar: ('profile', results.index.values, ds[timevar].attrs),
+            'latitude': ('profile', results.latitude.values, dict(long_name='Mean Profile Latitude',
+                                                                  units='degrees_north')),
+            'longitude': ('profile', results.longitude.values, dict(long_name='Mean Profile Longitude',
+                                                                    units='degrees_east')),
+            'mld_dbar': ('profile', results.mld.values, dict(long_name='Mixed Layer Depth', units=zunits,
+                                                             ancillary_variables=[mldvar, zvar],
+                                                             observation_type='calculated', comment=MLD_COMMENT)),
+            'mld': ('profile', mld_meters, dict(long_name='Mixed Layer Depth', units='m', observation_type='calculated',
+                                                comment=f'{MLD_COMMENT}. Calculated from MLD in dbar and latitude '
+                                                        f'using gsw.z_from_p')),
+            'max_n2': ('profile', results.max_n2.values, dict(long_name='Maximum Buoyancy Frequency', units='s-2',
+                                                              ancillary_variables=[mldvar, zvar],
+                                                              observation_type='calculated', comment=N2_COMMENT)),
+            'qi': ('profile', results.qi.values, dict(long_name='MLD Quality Index', units='1',
+                                                      comment='Quality Index from Lorbacher et al, 2006 '
+                                                              'doi:10.1029/2003JC002157')),
+            'mld_reason': ('profile', results.reason.values.astype('int8'),
+                           dict(long_name='Reason MLD was not calculated',
+                                flag_values=np.array(list(MLD_REASONS.keys()), dtype='int8'),
+                                flag_meanings=' '.join(MLD_REASONS.values()))),
+            'nobs': ('profile', results.nobs.values.astype('int32'), dict(long_name='Number of Observations')),
+            'rowSize': ('profile', rowsize.astype('int32'), dict(long_name='Number of Bins in the Profile',
+                                                                 sample_dimension='obs')),
+            'bin_pressure': ('obs', bins.pressure.values, dict(long_name='Bin Pressure', units=zunits,
+                                                               comment='Mean pressure of the data in the 1 dbar bin')),
+            f'bin_{mldvar}': ('obs', bins['values'].values, dict(long_name=f'Binned {mldvar}',
+                                                                 units=ds[mldvar].attrs.get('units', ''))),
+            'n2': ('obs', bins.n2.values, dict(long_name='Buoyancy Frequency Squared', units='s-2',
+                                               ancillary_variables=[f'bin_{mldvar}', 'bin_pressure'],
+                                               observation_type='calculated',
+                                               comment='N**2 of the binned profile used to calculate MLD'))
+        },
+        attrs=dict(ds.attrs)
+    )
+    out.attrs['featureType'] = 'profile'
+
+    # MLD from the other criteria, side by side with the max N**2 MLD
+    for c in criteria:
+        comment = c.get('comment', ', '.join(f'{k}={v}' for k, v in c.items() if k != 'name'))
+        out[f'mld_dbar_{c["name"]}'] = ('profile', results[f'mld_{c["name"]}'].values,
+                                        dict(long_name=f'Mixed Layer Depth ({c["name"]})', units=zunits,
+                                             ancillary_variables=[c['variable'], zvar], observation_type='calculated',
+                                             comment=comment))
+        if c['method'] == 'max_n2':
+            out[f'max_n2_{c["name"]}'] = ('profile', results[f'max_n2_{c["name"]}'].values,
+                                          dict(long_name=f'Maximum Buoyancy Frequency ({c["name"]})', units='s-2',
+                                               ancillary_variables=[c['variable'], zvar], comment=comment))
+            out[f'qi_{c["name"]}'] = ('profile', results[f'qi_{c["name"]}'].values,
+                                      dict(long_name=f'MLD Quality Index ({c["name"]})', units='1'))
+            out[f'mld_reason_{c["name"]}'] = ('profile', results[f'reason_{c["name"]}'].values.astype('int8'),
+                                              dict(long_name=f'Reason MLD was not calculated ({c["name"]})',
+                                                   flag_values=np.array(list(MLD_REASONS.keys()), dtype='int8'),
+                                                   flag_meanings=' '.join(MLD_REASONS.values())))
+    for v in criteria_vars:
+        if f'bin_{v}' not in out:
+            out[f'bin_{v}'] = ('obs', bins[v].values, dict(long_name=f'Binned {v}', units=ds[v].attrs.get('units', '')))
+
+    if summary:
+        return out, mld_summary(results.reason.values, timings, ds.attrs.get('title'))
+
+    return out
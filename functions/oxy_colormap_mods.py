@@ -1,11 +1,13 @@
+import functools
 import cmocean
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import numpy as np
 
 """
 Author: Laura Nazzaro on 10/24/2023
-Last modified: 10/24/2023
+Last modified: 10/16/2026
 Functions to modify colormaps with defined breakpoints.
 Mostly for oxygen, but who knows where this will take us.
 Individual colors can be removed from any version
@@ -15,7 +17,11 @@ cm_rygg: red to yellow to gray to green
 cm_rogg: red to orange to gray to green (gray shading reversed from original oxy)
 cm_partialturbo_r: red to orange/yellow to gray to blue
 
-Based on our best research (Fed and NJ) so far, 
+Each colormap is built by breakpoint_colormap from the segments in COLORMAP_FAMILIES. Colormaps are cached (and
+registered with matplotlib) for each combination of family, vmin, vmax, breaks and colors, so plotting loops get the
+same colormap back instead of building it again.
+
+Based on our best research (Fed and NJ) so far,
 and concentration/saturation equivalents based on summer 2023 ru28 and ru40 deployments
 (concentration to saturation conversions are variable so these should be used with a grain of salt):
 
@@ -24,54 +30,90 @@ low DO = < 5 mg/L, = 156.25 umol/L, approx = 65% saturation
 supersaturation = > 100% saturation, approx = 7.5 mg/L, = 234.375
 """
 
-def cm_oxy_mod(vmin=2, vmax=9, breaks=[3,7.5], red=True, gray=True, yellow=True):
+# the colors in each colormap family, in order: (color name, source colormap, start and end of the source colormap)
+COLORMAP_FAMILIES = {
+    'oxy_mod': [('red', cmocean.cm.oxy, 0, .19),  # dark to less dark
+                ('gray', cmocean.cm.oxy, .2, .79),  # dark to light
+                ('yellow', cmocean.cm.oxy, .8, 1)],  # light to dark-ish
+    'rygg': [('red', cmocean.cm.oxy, 0, .19),  # dark to less dark
+             ('yellow', cmocean.cm.oxy, .8, 1),  # light to dark-ish
+             ('gray', cmocean.cm.oxy, .2, .79),  # dark to light
+             ('green', cmocean.cm.algae, 0, .5)],  # light to mid
+    'rogg': [('red', cmocean.cm.oxy, 0, .19),  # dark to less dark
+             ('orange', plt.cm.Oranges, .8, .4),  # dark-ish to light
+             ('gray', cmocean.cm.oxy, .7, .2),  # light to dark
+             ('green', plt.cm.Oranges, .8, .4)],  # mid to light
+    'partialturbo_r': [('red', plt.cm.turbo, 1, .85),  # dark to bright
+                       ('orange', plt.cm.turbo, .75, .6),  # orangey orange to orangey yellow
+                       ('gray', cmocean.cm.oxy, .3, .79),  # dark to light
+                       ('blue', plt.cm.turbo, .3, .1)]  # cyan to bright
+}
+
+
+@functools.lru_cache(maxsize=256)
+def breakpoint_colormap(family, vmin=2, vmax=9, breaks=(3, 5, 7.5), colors=None):
     """
-    Modify cmocean oxy colormap with defined break points
-    red (dark to less dark) to gray (dark to light) to yellow (light to dark-ish)
+    Build a colormap with defined break points from the colors of a colormap family. Each color covers the values
+    between two break points, sampled every (vmax - vmin)/100.
+    :param family: name of the colormap family in COLORMAP_FAMILIES
+    :param vmin: minimum value
+    :param vmax: maximum value
+    :param breaks: tuple of break points between the colors
+    :param colors: tuple of the names of the colors to use, default is all of the colors in the family
+    :return: ListedColormap and the BoundaryNorm that puts the color changes at the break points, or (0, 0) if the
+    break points don't work with the colors
     """
-    all_nums = np.append(np.append(vmin,breaks),vmax)
+    segments = COLORMAP_FAMILIES[family]
+    if colors is not None:
+        segments = [s for s in segments if s[0] in colors]
+    all_nums = np.append(np.append(vmin, breaks), vmax)
     # check that all values are real numbers
     if not np.all(np.isreal(all_nums)) or np.any(np.isnan(all_nums)):
         print('All values must be real numbers.')
-        return 0
+        return 0, 0
     # check that all values increase in the right order
-    if np.any(np.diff(all_nums)<0):
+    if np.any(np.diff(all_nums) < 0):
         print('All values must be increasing from vmin -> breaks -> vmax')
-        return 0
+        return 0, 0
     # check that number of break values works with number of colors
-    if red+gray+yellow != len(breaks)+1:
-        print(f'Number of breakpoints ({len(breaks)}) must be one less than number of colors ({red+gray+yellow})')
-        return 0
+    if len(segments) != len(breaks) + 1:
+        print(f'Number of breakpoints ({len(breaks)}) must be one less than number of colors ({len(segments)})')
+        return 0, 0
     # define interval
-    ni = (vmax-vmin)/100
-    
-    b=1
-    if red:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(0,.19,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if gray:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.2,.79,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if yellow:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.8,1,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    newmap = mcolors.LinearSegmentedColormap.from_list('my_colormap',cmfull)
-    return newmap
+    ni = (vmax - vmin) / 100
+
+    cmfull = []
+    boundaries = [vmin]
+    for b, (color, cmap, start, end) in enumerate(segments, start=1):
+        nints = int(np.floor((all_nums[b] - all_nums[b - 1]) / ni))
+        cmfull.append(cmap(np.linspace(start, end, nints)))
+        boundaries.extend(np.linspace(all_nums[b - 1], all_nums[b], nints + 1)[1:])
+    cmfull = np.vstack(cmfull)
+
+    name = f'{family}_{vmin}_{vmax}_{"-".join(str(x) for x in breaks)}_{"-".join(s[0] for s in segments)}'
+    newmap = mcolors.ListedColormap(cmfull, name=name)
+    if name not in matplotlib.colormaps:
+        matplotlib.colormaps.register(newmap)
+    norm = mcolors.BoundaryNorm(boundaries, len(cmfull))
+
+    return newmap, norm
+
+
+def _colormap(family, vmin, vmax, breaks, enabled):
+    """
+    :param enabled: dictionary of color name: True/False
+    :return: the cached colormap for the family with the enabled colors
+    """
+    colors = tuple(c for c, on in enabled.items() if on)
+    return breakpoint_colormap(family, vmin, vmax, tuple(breaks), colors)[0]
+
+
+def cm_oxy_mod(vmin=2, vmax=9, breaks=[3,7.5], red=True, gray=True, yellow=True):
+    """
+    Modify cmocean oxy colormap with defined break points
+    red (dark to less dark) to gray (dark to light) to yellow (light to dark-ish)
+    """
+    return _colormap('oxy_mod', vmin, vmax, breaks, dict(red=red, gray=gray, yellow=yellow))
 
 
 def cm_rygg(vmin=2, vmax=9, breaks=[3,5,7.5], red=True, yellow=True, gray=True, green=True):
@@ -79,171 +121,20 @@ def cm_rygg(vmin=2, vmax=9, breaks=[3,5,7.5], red=True, yellow=True, gray=True,
     Modify cmocean oxy colormap with defined break points
     red (dark to less dark) to yellow (light to dark-ish)to gray (dark to light) to green (light to mid)
     """
-    all_nums = np.append(np.append(vmin,breaks),vmax)
-    # check that all values are real numbers
-    if not np.all(np.isreal(all_nums)) or np.any(np.isnan(all_nums)):
-        print('All values must be real numbers.')
-        return 0
-    # check that all values increase in the right order
-    if np.any(np.diff(all_nums)<0):
-        print('All values must be increasing from vmin -> breaks -> vmax')
-        return 0
-    # check that number of break values works with number of colors
-    if red+yellow+gray+green != len(breaks)+1:
-        print(f'Number of breakpoints ({len(breaks)}) must be one less than number of colors ({red+yellow+gray+green})')
-        return 0
-    # define interval
-    ni = (vmax-vmin)/100
-    
-    b=1
-    if red:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(0,.19,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if yellow:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.8,1,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if gray:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.2,.79,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if green:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.algae(np.linspace(0,.5,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    
-    newmap = mcolors.LinearSegmentedColormap.from_list('my_colormap',cmfull)
-    return newmap
+    return _colormap('rygg', vmin, vmax, breaks, dict(red=red, yellow=yellow, gray=gray, green=green))
+
 
 def cm_rogg(vmin=2, vmax=9, breaks=[3,5,7.5], red=True, orange=True, gray=True, green=True):
     """
     Modify cmocean oxy colormap with defined break points
     red (dark to less dark) to orange (dark-ish to light)to gray (light to dark) to green (mid to light)
     """
-    all_nums = np.append(np.append(vmin,breaks),vmax)
-    # check that all values are real numbers
-    if not np.all(np.isreal(all_nums)) or np.any(np.isnan(all_nums)):
-        print('All values must be real numbers.')
-        return 0
-    # check that all values increase in the right order
-    if np.any(np.diff(all_nums)<0):
-        print('All values must be increasing from vmin -> breaks -> vmax')
-        return 0
-    # check that number of break values works with number of colors
-    if red+orange+gray+green != len(breaks)+1:
-        print(f'Number of breakpoints ({len(breaks)}) must be one less than number of colors ({red+orange+gray+green})')
-        return 0
-    # define interval
-    ni = (vmax-vmin)/100
-    
-    b=1
-    if red:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(0,.19,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if orange:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = plt.cm.Oranges(np.linspace(.8,.4,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if gray:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.7,.2,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if green:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = plt.cm.Oranges(np.linspace(.8,.4,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    
-    newmap = mcolors.LinearSegmentedColormap.from_list('my_colormap',cmfull)
-    return newmap
+    return _colormap('rogg', vmin, vmax, breaks, dict(red=red, orange=orange, gray=gray, green=green))
+
 
 def cm_partialturbo_r(vmin=2, vmax=9, breaks=[3,5,7.5], red=True, orange=True, gray=True, blue=True):
     """
     Modify cmocean oxy colormap with defined break points
     red (dark to bright) to orange/yellow (orangey orange to orangey yellow)to gray (dark to light) to blue (cyan to bright)
     """
-    all_nums = np.append(np.append(vmin,breaks),vmax)
-    # check that all values are real numbers
-    if not np.all(np.isreal(all_nums)) or np.any(np.isnan(all_nums)):
-        print('All values must be real numbers.')
-        return 0
-    # check that all values increase in the right order
-    if np.any(np.diff(all_nums)<0):
-        print('All values must be increasing from vmin -> breaks -> vmax')
-        return 0
-    # check that number of break values works with number of colors
-    if red+orange+gray+blue != len(breaks)+1:
-        print(f'Number of breakpoints ({len(breaks)}) must be one less than number of colors ({red+orange+gray+blue})')
-        return 0
-    # define interval
-    ni = (vmax-vmin)/100
-    
-    b=1
-    if red:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = plt.cm.turbo(np.linspace(1,.85,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if orange:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = plt.cm.turbo(np.linspace(.75,.6,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if gray:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = cmocean.cm.oxy(np.linspace(.3,.79,nints))  #cm0 = plt.cm.binary(np.linspace(.8,.3,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    if blue:
-        nints = int(np.floor((all_nums[b]-all_nums[b-1])/ni))
-        cm0 = plt.cm.turbo(np.linspace(.3,.1,nints))
-        if b==1:
-            cmfull = cm0
-        else:
-            cmfull = np.vstack((cmfull,cm0))
-        b+=1
-    
-    newmap = mcolors.LinearSegmentedColormap.from_list('my_colormap',cmfull)
-    return newmap
\ No newline at end of file
+    return _colormap('partialturbo_r', vmin, vmax, breaks, dict(red=red, orange=orange, gray=gray, blue=blue))
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+"""
+Run processing stages (QC, derived variables, MLD) over one lazily-opened glider dataset and write one output file,
+instead of writing and re-reading an intermediate file after each step. Each stage is a (name, function) pair, where the
+function takes a dataset and returns the processed dataset.
+"""
+import functions.common as cf
+import functions.derived as derived
+import functions.mixed_layer_depth as mldfunc
+import functions.qc as qc
+
+
+def timeseries_stage():
+    """
+    Convert the ragged-array dataset to a time-series sorted by time (only needs to happen once, at the start)
+    """
+    return 'timeseries', cf.to_timeseries
+
+
+def qc_stage(rules=None, summaries=None):
+    """
+    Set data that fail QC tests to nan, see qc.apply_qc
+    :param rules: optional list of QC rules, default is qc.QC_RULES
+    :param summaries: optional dictionary that the summary of the data set to nan by each test is added to as 'qc'
+    """
+    def apply(ds):
+        ds, summary = qc.apply_qc(ds, rules)
+        if summaries is not None:
+            summaries['qc'] = summary
+        return ds
+
+    return 'qc', apply
+
+
+def derived_stage(salvar='salinity', tempvar='temperature', zvar='pressure', timevar='profile_time', n2=True,
+                  chunk_profiles=500):
+    """
+    Calculate absolute salinity, conservative temperature, potential density and N**2, see derived.add_derived. The
+    variables (except N**2) are calculated lazily, so a following MLD stage on potential_density reads the file once
+    """
+    def apply(ds):
+        return derived.add_derived(ds, salvar, tempvar, zvar, timevar, n2=n2, chunk_profiles=chunk_profiles)
+
+    return 'derived', apply
+
+
+def mld_stage(timevar='profile_time', mldvar='density', zvar='pressure', chunk_profiles=500, summaries=None):
+    """
+    Calculate Mixed Layer Depth for each profile, see mixed_layer_depth.add_mld. Surface data are masked and the
+    profiles are binned inside this stage for each chunk of profiles, the dataset itself isn't changed
+    :param summaries: optional dictionary that the reason code and timings summary (see mixed_layer_depth.mld_summary)
+    is added to as 'mld'
+    """
+    def apply(ds):
+        ds, summary = mldfunc.add_mld(ds, timevar, mldvar, zvar, chunk_profiles=chunk_profiles, summary=True)
+        if summaries is not None:
+            summaries['mld'] = summary
+        return ds
+
+    return 'mld', apply
+
+
+def run_pipeline(fname, stages, savefile, save_intermediate=False):
+    """
+    Open a deployment lazily, run each processing stage and write the result
+    :param fname: deployment NetCDF file
+    :param stages: list of (name, function) stages
+    :param savefile: output file name
+    :param save_intermediate: optional list of stage names (or True for all stages) to also write the output of the
+    stage to <fname>_<stage name>.nc (see common.output_file). The next stage reads from the written file
+    :return: the processed dataset
+    """
+    ds = cf.open_deployment(fname)
+    for name, stage in stages[:-1]:
+        ds = stage(ds)
+        if save_intermediate is True or name in (save_intermediate or []):
+            sfile = cf.output_file(fname, f'_{name}.nc')
+            ds.to_netcdf(sfile)
+            ds = cf.open_deployment(sfile)
+
+    if stages:
+        ds = stages[-1][1](ds)
+    ds.to_netcdf(savefile)
+
+    return ds
@@ -2,21 +2,91 @@
 
 """
 Author: Lori Garzio on 10/23/2023
-Last modified: 10/23/2023
+Last modified: 10/16/2026
 """
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 plt.rcParams.update({'font.size': 12})
 
 
-def xsection(fig, ax, x, y, z, xlabel='Time', ylabel='Depth (m)', clabel=None, cmap='jet', title=None, date_fmt=None,
-             grid=None, extend='both', vlims=None):
+def grid_data(x, y, z, bins=(500, 100)):
+    """
+    Average scattered data onto a regular x (e.g. time) by y (e.g. depth) grid
+    :param x: array of x values, numeric or datetime64
+    :param y: array of y values
+    :param z: array of data values
+    :param bins: (x, y) number of bins (covering the range of the data) or arrays of bin edges. Data outside of the bin
+    edges are left out, and each bin includes its lower edge but not its upper edge
+    :return: x bin edges (matplotlib date numbers if x is datetime64), y bin edges and the gridded mean values with
+    shape (y, x), nan where the grid cell has no data
+    """
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = mdates.date2num(x)
+    x = x.astype('float64')
+    y = np.asarray(y, dtype='float64')
+    z = np.asarray(z, dtype='float64')
+    valid = ~np.isnan(x) & ~np.isnan(y) & ~np.isnan(z)
+    x, y, z = x[valid], y[valid], z[valid]
+
+    edges = []
+    idx = []
+    inside = np.ones(len(z), dtype=bool)
+    for values, b in zip([x, y], bins):
+        i = None
+        if np.ndim(b) == 0:
+            vrange = (values.min(), values.max()) if len(values) > 0 else (0, 1)
+            b = np.linspace(*vrange, int(b) + 1)
+            i = np.searchsorted(b, values, side='right') - 1
+            # the bins cover the data range, so the maximum value goes in the last bin
+            i[i == len(b) - 1] = len(b) - 2
+        b = np.asarray(b, dtype='float64')
+        if i is None:
+            # data outside of the bin edges aren't gridded
+            i = np.searchsorted(b, values, side='right') - 1
+            inside &= (i >= 0) & (i < len(b) - 1)
+        edges.append(b)
+        idx.append(i)
+    nx, ny = len(edges[0]) - 1, len(edges[1]) - 1
+
+    key = (idx[1] * nx + idx[0])[inside]
+    z = z[inside]
+    count = np.bincount(key, minlength=nx * ny)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(key, weights=z, minlength=nx * ny) / count
 
-    if vlims:
-        xc = ax.scatter(x, y, c=z, cmap=cmap, s=10, vmin=vlims[0], vmax=vlims[1], edgecolor='None')
+    return edges[0], edges[1], mean.reshape(ny, nx)
+
+
+def xsection(fig, ax, x, y, z, xlabel='Time', ylabel='Depth (m)', clabel=None, cmap='jet', title=None, date_fmt=None,
+             grid=None, extend='both', vlims=None, mode='scatter', bins=(500, 100), rasterized=False, decimate=None):
+    """
+    Plot a cross-section of the data
+    :param mode: 'scatter' to plot every observation, or 'grid' to average the data onto a regular x by y grid
+    (see grid_data) and draw it with pcolormesh, which is much faster to draw for large deployments and the figure size
+    doesn't depend on the number of observations
+    :param bins: (x, y) number of grid bins or arrays of bin edges for mode='grid'
+    :param rasterized: if True, the data are drawn as an image in vector outputs (pdf, svg) instead of as one shape
+    per observation or grid cell
+    :param decimate: plot every Nth observation for mode='scatter'
+    """
+    vmin, vmax = vlims if vlims else (None, None)
+    if mode == 'grid':
+        xedges, yedges, gridded = grid_data(x, y, z, bins)
+        xc = ax.pcolormesh(xedges, yedges, np.ma.masked_invalid(gridded), cmap=cmap, vmin=vmin, vmax=vmax,
+                           rasterized=rasterized)
+        if np.issubdtype(np.asarray(x).dtype, np.datetime64):
+            ax.xaxis_date()
     else:
-        xc = ax.scatter(x, y, c=z, cmap=cmap, s=10, edgecolor='None')
+        x, y, z = np.asarray(x), np.asarray(y), np.asarray(z, dtype='float64')
+        keep = ~np.isnan(z)
+        if decimate:
+            keep &= np.arange(len(z)) % decimate == 0
+        xc = ax.scatter(x[keep], y[keep], c=z[keep], cmap=cmap, s=10, vmin=vmin, vmax=vmax, edgecolor='None',
+                        rasterized=rasterized)
 
     ax.invert_yaxis()
     ax.set_ylabel(ylabel)
@@ -43,3 +113,36 @@ def xsection(fig, ax, x, y, z, xlabel='Time', ylabel='Depth (m)', clabel=None, c
 
     if grid:
         ax.grid(ls='--', lw=.5)
+
+
+def track_collection(lon, lat, times, norm, cmap='rainbow', max_gap=None, **kwargs):
+    """
+    Build a glider track as one LineCollection colored by time, which draws much faster than a scatter of every point
+    :param lon: array of longitudes
+    :param lat: array of latitudes
+    :param times: array of times (datetime64)
+    :param norm: matplotlib Normalize for the times (as matplotlib date numbers), shared by all tracks on a map
+    :param cmap: colormap
+    :param max_gap: optional maximum time between points that are connected (e.g. np.timedelta64(6, 'h'))
+    :param kwargs: other LineCollection arguments (e.g. linewidths, transform, zorder)
+    :return: LineCollection, with one segment between each pair of consecutive points
+    """
+    lon = np.asarray(lon, dtype='float64')
+    lat = np.asarray(lat, dtype='float64')
+    times = np.asarray(times)
+    valid = ~np.isnan(lon) & ~np.isnan(lat)
+    lon, lat, times = lon[valid], lat[valid], times[valid]
+
+    points = np.column_stack((lon, lat))
+    segments = np.stack((points[:-1], points[1:]), axis=1)
+    tnum = mdates.date2num(times)
+    colors = (tnum[:-1] + tnum[1:]) / 2
+    if max_gap is not None:
+        connected = np.diff(times) <= max_gap
+        segments = segments[connected]
+        colors = colors[connected]
+
+    lc = LineCollection(segments, cmap=cmap, norm=norm, **kwargs)
+    lc.set_array(colors)
+
+    return lc
@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+
+"""
+Render the per-profile MLD diagnostic plots (binned temperature and density profiles with the MLD) after MLD has been
+calculated, separately from the calculation. The plot data are prepared one chunk of profiles at a time with the MLD
+results from the calculation, then the figures are drawn by a pool of worker processes. Each worker draws on one
+reused figure with the Agg renderer (no display needed).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib
+from matplotlib.figure import Figure
+import functions.common as cf
+
+# figure and axes reused by every plot drawn in a worker process
+_figure = None
+
+
+def plot_files(plots, tstr):
+    """
+    :return: the temperature and density plot file names for a profile
+    """
+    return os.path.join(plots, f'temperature_{tstr}.png'), os.path.join(plots, f'density{tstr}.png')
+
+
+def plot_tasks(ds, results, plots, timevar='profile_time', mldvar='density', zvar='pressure', every=1,
+               skip_existing=False, chunk_profiles=500):
+    """
+    Prepare the data for the profile plots: the profiles are read and depth binned one chunk of profiles at a time,
+    and plotted with the MLD results that were calculated for them
+    :param ds: xarray dataset sorted by time, with 'time' as the only dimension
+    :param results: dataframe indexed by profile with columns mld, max_n2 and qi, e.g. from the profile_results of
+    mixed_layer_depth.add_mld or the output of mixed_layer_depth.mld_profiles. Profiles that aren't in results aren't
+    plotted
+    :param plots: save directory
+    :param timevar: the name of the variable identifying profiles, default is 'profile_time'
+    :param mldvar: the name of the variable for which MLD is calculated, default is 'density'
+    :param zvar: the name of the pressure variable, default is 'pressure'
+    :param every: plot every Nth profile, default is 1 (all profiles)
+    :param skip_existing: if True, don't plot profiles that already have both plot files
+    :param chunk_profiles: number of profiles read and binned at a time
+    :return: list of dictionaries with the plot data for each profile
+    """
+    dim = ds.time.dims[0]
+    profile_ids = ds[timevar].values
+    profiles, profile_idx = np.unique(profile_ids, return_inverse=True)
+    profile_idx = profile_idx.ravel()
+
+    tstrs = pd.to_datetime(profiles).strftime('%Y-%m-%dT%H%M%SZ')
+    selected = np.zeros(len(profiles), dtype=bool)
+    selected[::every] = True
+    selected &= np.isin(profiles, results.index.values)
+    if skip_existing:
+        selected &= [not all(os.path.isfile(f) for f in plot_files(plots, t)) for t in tstrs]
+    if not np.any(selected):
+        return []
+    results = results.reindex(profiles)
+
+    read_vars = list(dict.fromkeys([timevar, 'pressure', zvar, mldvar, 'temperature']))
+    tasks = []
+    for sl in cf.profile_chunks(profile_idx, chunk_profiles):
+        obs = selected[profile_idx[sl]]
+        if not np.any(obs):
+            continue
+        df = ds[read_vars].isel({dim: np.arange(sl.start, sl.stop)[obs]}).to_dataframe()
+        df.loc[df.pressure < 1, ['pressure', mldvar]] = np.nan
+        codes, profile_code = np.unique(profile_idx[sl][obs], return_inverse=True)
+        profile_code = profile_code.ravel()
+
+        data = {v: df[v].values for v in [mldvar, zvar, 'temperature']}
+        bins, binned = cf.depth_bin_arrays(df[zvar].values, data, profile=profile_code)
+        keep = ~np.isnan(binned[mldvar])
+        binned = {v: values[keep] for v, values in binned.items()}
+
+        # the bins are sorted by profile, so each profile is one slice of the bins
+        seg = np.searchsorted(binned['profile'], np.arange(len(codes) + 1))
+        for i, code in enumerate(codes):
+            pbins = slice(seg[i], seg[i + 1])
+            tasks.append(dict(tstr=tstrs[code], temperature=binned['temperature'][pbins],
+                              density=binned[mldvar][pbins], z=binned[zvar][pbins], mld=results.mld.values[code],
+                              qi=results.qi.values[code], max_n2=results.max_n2.values[code]))
+
+    return tasks
+
+
+def _init_worker(figsize=(8, 10)):
+    global _figure
+    _figure = Figure(figsize=figsize)
+    _figure.add_subplot(1, 1, 1)
+
+
+def _render_batch(tasks, plots, dpi):
+    """
+    Draw the temperature and density plots for a batch of profiles on the worker's figure
+    :return: number of files saved
+    """
+    if _figure is None:
+        _init_worker()
+    ax = _figure.axes[0]
+    saved = 0
+    with matplotlib.rc_context({'font.size': 14}):
+        for task in tasks:
+            tfile, dfile = plot_files(plots, task['tstr'])
+            for xvar, sfile in [('temperature', tfile), ('density', dfile)]:
+                ax.cla()
+                ax.scatter(task[xvar], task['z'])
+                ax.invert_yaxis()
+                ax.set_ylabel('Pressure (dbar)')
+                ax.set_xlabel(xvar)
+                if xvar == 'density':
+                    ax.set_title(f'QI = {task["qi"]}\nN2 = {task["max_n2"]}')
+                ax.axhline(y=task['mld'], ls='--', c='k')
+                _figure.savefig(sfile, dpi=dpi)
+                saved += 1
+
+    return saved
+
+
+def render_plots(tasks, plots, workers=1, dpi=300, batch_size=None):
+    """
+    Render the profile plots prepared by plot_tasks
+    :param tasks: list of plot data from plot_tasks
+    :param plots: save directory
+    :param workers: number of worker processes, 1 draws the plots in this process
+    :param dpi: resolution of the saved figures
+    :param batch_size: number of profiles sent to a worker at a time, default splits the profiles into 4 batches per
+    worker (up to 50 profiles per batch)
+    :return: number of files saved
+    """
+    batch_size = batch_size or max(1, min(50, int(np.ceil(len(tasks) / (workers * 4)))))
+    batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+    if workers == 1 or len(batches) < 2:
+        return sum(_render_batch(batch, plots, dpi) for batch in batches)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        saved = executor.map(_render_batch, batches, [plots] * len(batches), [dpi] * len(batches))
+        return sum(saved)
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+
+"""
+Apply QC flags to glider data. The QC tests are defined in QC_RULES: data flagged by a test are set to nan in the
+flagged variable and in the variables derived from it (e.g. salinity and density are calculated from conductivity and
+temperature). All of the rules for a variable are combined into one mask before the data are masked.
+"""
+import dask
+import pandas as pd
+import xarray as xr
+
+# variables calculated from each variable, which are also removed when the variable fails a QC test
+DERIVED_VARIABLES = {
+    'conductivity': ['salinity', 'density'],
+    'temperature': ['salinity', 'density']
+}
+
+# suffix: ending of the QC variable names for the test
+# fail: flag values that fail the test
+# skip: the test isn't applied to QC variables with any of these in the name
+# derived: optional list of variables that are always removed with the flagged variable, in place of DERIVED_VARIABLES
+QC_RULES = [
+    dict(suffix='_qartod_summary_flag', fail=[4], skip=['pressure']),  # QARTOD 4/FAIL
+    # CTD hysteresis 3/SUSPECT and 4/FAIL, always removed from salinity and density
+    dict(suffix='_hysteresis_test', fail=[3, 4], skip=[], derived=['salinity', 'density'])
+]
+
+
+def qc_tests(ds, rules=None):
+    """
+    Find the QC variables in the dataset for each rule
+    :param ds: xarray dataset
+    :param rules: list of QC rules, default is QC_RULES
+    :return: list of (QC variable name, flag values that fail, list of variables to remove)
+    """
+    rules = rules or QC_RULES
+    tests = []
+    for rule in rules:
+        for qv in [x for x in ds.data_vars if rule['suffix'] in x]:
+            if any(s in qv for s in rule['skip']):
+                continue
+            var = qv.split(rule['suffix'])[0]
+            derived = rule['derived'] if 'derived' in rule else DERIVED_VARIABLES.get(var, [])
+            targets = [var] + [tv for tv in derived if tv != var]
+            targets = [tv for tv in targets if tv in ds.data_vars]
+            tests.append((qv, rule['fail'], targets))
+
+    return tests
+
+
+def qc_masks(ds, tests):
+    """
+    :param ds: xarray dataset
+    :param tests: list of QC tests from qc_tests
+    :return: dictionary of QC variable: boolean mask of failed data, and dictionary of variable: combined boolean
+    mask of data to remove from the variable
+    """
+    fail_masks = dict()
+    target_masks = dict()
+    for qv, fail, targets in tests:
+        fail_masks[qv] = ds[qv].isin(fail)
+        for tv in targets:
+            if tv in target_masks:
+                target_masks[tv] = target_masks[tv] | fail_masks[qv]
+            else:
+                target_masks[tv] = fail_masks[qv]
+
+    return fail_masks, target_masks
+
+
+def apply_qc(ds, rules=None):
+    """
+    Set data that fail the QC tests to nan. Each variable is masked once with the combination of all of the tests
+    that apply to it.
+    :param ds: xarray dataset
+    :param rules: list of QC rules, default is QC_RULES
+    :return: the QC'd dataset and a dataframe summarizing the number of data points flagged by each test and the
+    number removed. Points that fail more than one test are only counted as removed by the first test, so the removed
+    column adds up to the number of points removed by all of the tests
+    """
+    tests = qc_tests(ds, rules)
+    fail_masks, target_masks = qc_masks(ds, tests)
+
+    # count the failed points (and failed points that had data in the target variables and weren't already removed by
+    # an earlier test) for each test in one pass
+    counts = dict()
+    removed = None
+    for qv, fail, targets in tests:
+        has_data = xr.concat([ds[tv].notnull() for tv in targets], dim='target').any(dim='target')
+        test_removed = fail_masks[qv] & has_data
+        counts[f'{qv}|flagged'] = fail_masks[qv].sum()
+        counts[f'{qv}|removed'] = test_removed.sum() if removed is None else (test_removed & ~removed).sum()
+        removed = test_removed if removed is None else removed | test_removed
+    counts = dict(zip(counts.keys(), dask.compute(*counts.values())))
+
+    summary = pd.DataFrame(
+        [dict(test=qv, fail_flags=fail, targets=', '.join(targets), flagged=int(counts[f'{qv}|flagged']),
+              removed=int(counts[f'{qv}|removed'])) for qv, fail, targets in tests],
+        columns=['test', 'fail_flags', 'targets', 'flagged', 'removed'])
+
+    for tv, mask in target_masks.items():
+        ds[tv] = ds[tv].where(~mask)
+
+    return ds, summary
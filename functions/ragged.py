@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+"""
+Read glider profiles from contiguous ragged-array NetCDF files (observations on the 'obs' dimension, stored one profile
+after the other, with the number of observations in each profile in 'rowSize'). Profiles are read from disk one block
+at a time and returned as array views of the block (or as the whole block), without building a DataFrame, so a
+deployment can be processed in one pass with memory bounded by the block size.
+"""
+import numpy as np
+import xarray as xr
+
+
+def profile_offsets(rowsize):
+    """
+    :param rowsize: number of observations in each profile
+    :return: index of the first observation of each profile, plus the total number of observations at the end
+    """
+    return np.concatenate(([0], np.cumsum(rowsize))).astype('int64')
+
+
+def _variable_dims(ds, variables, rowsize):
+    """
+    Sort the variables into the observation and profile dimensions of a ragged-array dataset. Variables on other
+    dimensions (e.g. a deployment-level trajectory variable) can't be split into profiles, so they're skipped
+    :return: list of observation variables and list of profile variables
+    """
+    profile_dim = rowsize.dims[0]
+    obs_dim = rowsize.attrs.get('sample_dimension')
+    if obs_dim not in ds.dims:
+        nobs = int(rowsize.sum())
+        obs_dim = [d for d, n in ds.sizes.items() if n == nobs and d != profile_dim]
+        obs_dim = obs_dim[0] if obs_dim else None
+    obs_vars = [v for v in variables if ds[v].ndim > 0 and ds[v].dims[0] == obs_dim]
+    profile_vars = [v for v in variables if ds[v].ndim > 0 and ds[v].dims[0] == profile_dim]
+    skipped = [v for v in variables if v not in obs_vars + profile_vars]
+    if skipped:
+        print(f'skipping variables not on the {obs_dim} or {profile_dim} dimension: {skipped}')
+
+    return obs_vars, profile_vars
+
+
+def _read_blocks(fname, variables, rowsize_var='rowSize', block_profiles=500):
+    """
+    Generator that reads one block of consecutive profiles at a time, sliced from the file with the rowSize offsets
+    :return: generator of (index of the first and last + 1 profile in the block, the profile offsets relative to the
+    start of the block, dictionary of variable: observation data, dictionary of variable: profile data)
+    """
+    ds = xr.open_dataset(fname) if isinstance(fname, str) else fname
+    rowsize = ds[rowsize_var]
+    offsets = profile_offsets(rowsize.values)
+    obs_vars, profile_vars = _variable_dims(ds, variables, rowsize)
+    nprofiles = len(rowsize)
+
+    try:
+        for b in range(0, nprofiles, block_profiles):
+            e = min(b + block_profiles, nprofiles)
+            start, stop = offsets[b], offsets[e]
+            obs = {v: ds[v][start:stop].values for v in obs_vars}
+            prof = {v: ds[v][b:e].values for v in profile_vars}
+            yield b, e, offsets[b:e + 1] - start, obs, prof
+    finally:
+        if isinstance(fname, str):
+            ds.close()
+
+
+def iter_profiles(fname, variables, rowsize_var='rowSize', block_profiles=500):
+    """
+    Generator that walks the rowSize offsets of a ragged-array file and yields one profile at a time
+    :param fname: NetCDF file name or xarray dataset (opened lazily)
+    :param variables: list of variables to read. Variables on the observation dimension are returned as arrays
+    (views of the block that was read), variables on the profile dimension as a single value. Variables on other
+    dimensions are skipped
+    :param rowsize_var: the name of the variable with the number of observations in each profile
+    :param block_profiles: number of profiles read from the file at a time
+    :return: generator of (profile index, dictionary of variable: data)
+    """
+    for b, e, offsets, obs, prof in _read_blocks(fname, variables, rowsize_var, block_profiles):
+        for p in range(b, e):
+            s0, s1 = offsets[p - b], offsets[p - b + 1]
+            data = {v: obs[v][s0:s1] for v in obs}
+            data.update({v: prof[v][p - b] for v in prof})
+            yield p, data
+
+
+def iter_blocks(fname, variables, rowsize_var='rowSize', block_profiles=500):
+    """
+    Generator that reads blocks of consecutive profiles from a ragged-array file so they can be processed together
+    with the batch functions (e.g. mixed_layer_depth.profile_mld_batch, common.depth_bin_arrays). Each block is one
+    slice of the observation variables, so the observations aren't copied or concatenated
+    :param fname: NetCDF file name or xarray dataset (opened lazily)
+    :param variables: list of variables to read, only variables on the observation dimension are returned
+    :param rowsize_var: the name of the variable with the number of observations in each profile
+    :param block_profiles: number of profiles in each block
+    :return: generator of (array of profile indices, array of the profile code (0 to n-1) of each observation,
+    dictionary of variable: observation arrays)
+    """
+    for b, e, offsets, obs, prof in _read_blocks(fname, variables, rowsize_var, block_profiles):
+        codes = np.repeat(np.arange(e - b), np.diff(offsets))
+        yield np.arange(b, e), codes, obs
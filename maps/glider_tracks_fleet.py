@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Plot the tracks of many glider deployments (e.g. a season overview) on one map. Only time, latitude and longitude
+(and profile_time for one position per profile) are read from each file, the tracks are optionally decimated, and each
+track is drawn as one line colored by time on the same scale for all gliders. If the map extent is not specified, it
+will be provided using the glider data
+"""
+
+import glob
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+import matplotlib.dates as mdates
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+import cartopy.crs as ccrs
+import cool_maps.plot as cplt
+import functions.common as cf
+import functions.alignment as alignment
+import functions.bathymetry as bathy
+import functions.plotting as pf
+plt.rcParams.update({'font.size': 14})
+pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
+
+
+def main(patterns, extent, sfilename, minutes=None, per_profile=False, max_gap_hours=12, labels=True, start=None,
+         end=None):
+    flist = sorted(set(f for p in patterns for f in glob.glob(p)))
+    print(f'Plotting tracks for {len(flist)} deployments')
+
+    variables = ['longitude', 'latitude'] + (['profile_time'] if per_profile else [])
+    deployments = alignment.load_deployments(flist, variables, start=start, end=end)
+    for d, df in deployments.items():
+        df = df.dropna(subset=['longitude', 'latitude'])
+        deployments[d] = alignment.decimate(df, minutes, 'profile_time' if per_profile else None)
+    deployments = {d: df for d, df in deployments.items() if len(df) > 1}
+
+    # define the plotting limits based on the glider data if the extent is not provided
+    if not extent:
+        lats = np.concatenate([df.latitude.values for df in deployments.values()])
+        lons = np.concatenate([df.longitude.values for df in deployments.values()])
+        extent = cf.glider_extent(lats, lons)
+
+    kwargs = dict()
+    kwargs['landcolor'] = 'none'
+    kwargs['oceancolor'] = 'none'
+    fig, ax = cplt.create(extent, **kwargs)
+
+    # add bathymetry
+    bathymetry = '/Users/garzio/Documents/rucool/bathymetry/GEBCO_2014_2D_-100.0_0.0_-10.0_50.0.nc'
+    bathy.add_bathymetry(ax, extent, transform=ccrs.PlateCarree(), fname=bathymetry)
+
+    # add glider tracks, colored by time on the same scale for all gliders
+    tmin, tmax = alignment.time_range(deployments)
+    norm = mcolors.Normalize(vmin=mdates.date2num(tmin), vmax=mdates.date2num(tmax))
+    max_gap = np.timedelta64(int(max_gap_hours * 3600), 's') if max_gap_hours else None
+    for d, df in deployments.items():
+        lc = pf.track_collection(df.longitude, df.latitude, df.index.values, norm, cmap='rainbow', max_gap=max_gap,
+                                 linewidths=2, transform=ccrs.PlateCarree(), zorder=10)
+        ax.add_collection(lc)
+        if labels:
+            ax.text(df.longitude.values[-1], df.latitude.values[-1], d, fontsize=8, transform=ccrs.PlateCarree(),
+                    zorder=11)
+
+    # Set colorbar height equal to plot height
+    divider = make_axes_locatable(ax)
+    cax = divider.new_horizontal(size='5%', pad=0.05, axes_class=plt.Axes)
+    fig.add_axes(cax)
+
+    # generate colorbar
+    cbar = plt.colorbar(plt.cm.ScalarMappable(norm=norm, cmap='rainbow'), cax=cax)
+    cbar.ax.yaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+
+    plt.savefig(sfilename, dpi=200)
+    plt.close()
+
+
+if __name__ == '__main__':
+    # NetCDF files, or Parquet deployment directories (see analyses/convert_parquet.py) which only read the position
+    # columns for the days needed, e.g. '/Users/garzio/Documents/rucool/Saba/gliderdata/parquet/deployment=*'
+    file_patterns = ['/Users/garzio/Documents/rucool/Saba/gliderdata/2023/*/delayed/*-delayed*.nc',
+                     '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/*/*-rt-slice.nc']
+    map_extent = None  # None or list [-75, -72.25, 38.5, 40.75]
+    decimate_minutes = 30  # None or keep one position every N minutes
+    one_per_profile = False  # True to keep one position per profile
+    start_time = None  # None or only plot tracks from this time on, e.g. '2023-08-01'
+    end_time = None  # None or only plot tracks up to this time, e.g. '2023-09-30'
+    savefile = '/Users/garzio/Documents/rucool/Saba/RMI/2023_lowDO_event/glider_tracks_2023.png'
+    main(file_patterns, map_extent, savefile, decimate_minutes, one_per_profile, start=start_time, end=end_time)
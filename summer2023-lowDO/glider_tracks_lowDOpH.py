@@ -2,39 +2,55 @@
 
 """
 Author: Lori Garzio on 10/26/2023
-Last modified: 11/1/2023
+Last modified: 10/16/2026
 Plot glider tracks for the low DO/pH event in summer 2023, with the areas of low DO and omega or pH highlighted.
 Also plot locations of reported fish/crab/lobster mortalities.
+The events are detected from the deployment data (and saved to an SQLite database, see functions/events.py), or with
+saved_events=True the events saved by a previous run are read from the database and only the glider tracks are read
+from the deployment files.
 """
 
-import numpy as np
-import xarray as xr
 import pandas as pd
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-import cmocean as cmo
 import cool_maps.plot as cplt
+import functions.alignment as alignment
+import functions.catalog as catalog
+import functions.events as events
+import functions.bathymetry as bathy
 plt.rcParams.update({'font.size': 14})
 pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
 
 
-def main(flist, extent, sfilename):
-    # grab locations from gliders and merge into one dataframe
-    data = dict()
-    deployments = []
-    plot_vars = ['oxygen_concentration_shifted', 'aragonite_saturation_state']  # 'aragonite_saturation_state'  'pH_corrected'
-    for f in flist:
-        ds = xr.open_dataset(f)
-        deploy = ds.trajectory.values[0]
-        deployments.append(deploy)
-        data[deploy] = dict()
-        data[deploy]['lon'] = ds.longitude.values
-        data[deploy]['lat'] = ds.latitude.values
-        for pv in plot_vars:
-            try:
-                data[deploy][pv] = ds[pv].values
-            except KeyError:
-                continue
+def main(flist, extent, sfilename, dbfile=None, catalog_db=None, start=None, end=None, saved_events=False):
+    plot_rules = ['low_do', 'low_omega']  # 'low_omega'  'low_ph'
+    rules = [r for r in events.EVENT_RULES if r['name'] in plot_rules]
+    plot_vars = [r['variable'] for r in rules]
+
+    if catalog_db:
+        # only open the deployments that overlap the map extent and time window, flist can also be a directory
+        flist = catalog.select(catalog_db, flist, extent=extent, start=start, end=end)
+        print(f'{len(flist)} deployments in the map extent and time window')
+
+    if saved_events:
+        # the events are read from the database, so only the glider tracks are needed from the deployment files
+        deployments = alignment.load_deployments(flist, ['longitude', 'latitude'], start=start, end=end)
+        event_summary = pd.concat([events.query_events(dbfile, rule=r, start=start, end=end, extent=extent)
+                                   for r in plot_rules], ignore_index=True)
+        event_points = pd.concat([events.query_points(dbfile, rule=r, start=start, end=end, extent=extent)
+                                  for r in plot_rules], ignore_index=True)
+        event_summary = event_summary[event_summary.deployment.isin(deployments.keys())]
+        event_points = event_points[event_points.deployment.isin(deployments.keys())]
+    else:
+        # grab locations and data from gliders, each deployment is kept in its own dataframe
+        deployments = alignment.load_deployments(flist, ['longitude', 'latitude', 'depth_interpolated'] + plot_vars,
+                                                 start=start, end=end)
+
+        # find the low DO/omega/pH events for all of the gliders at once
+        event_summary, event_points = events.detect_events(deployments, rules)
+        if dbfile:
+            events.write_events(event_summary, event_points, dbfile)
+    print(event_summary.groupby(['deployment', 'rule']).n_obs.agg(['count', 'sum']))
 
     kwargs = dict()
     kwargs['landcolor'] = 'none'
@@ -44,39 +60,18 @@ def main(flist, extent, sfilename):
 
     # add bathymetry
     bathymetry = '/Users/garzio/Documents/rucool/bathymetry/GEBCO_2014_2D_-100.0_0.0_-10.0_50.0.nc'
-    bathy = xr.open_dataset(bathymetry)
-    bathy = bathy.sel(lon=slice(extent[0] - .1, extent[1] + .1),
-                      lat=slice(extent[2] - .1, extent[3] + .1))
-    levels = np.arange(-5000, 5100, 50)
-    bath_lat = bathy.lat
-    bath_lon = bathy.lon
-    bath_elev = bathy.elevation
-    plt.contourf(bath_lon, bath_lat, bath_elev, levels, cmap=cmo.cm.topo, transform=ccrs.PlateCarree())
-
-    levels = np.arange(-100, 0, 50)
-    CS = plt.contour(bath_lon, bath_lat, bath_elev, levels, linewidths=.75, alpha=.5, colors='k',
-                     transform=ccrs.PlateCarree())
-    ax.clabel(CS, [-100], inline=True, fontsize=7, fmt='%d')
-
-    for key, values in data.items():
-        df = pd.DataFrame(values)
-        #ax.scatter(df.lon, df.lat, color='#595959', marker='.', s=10, transform=ccrs.PlateCarree(), zorder=5)  # dark gray
-        ax.plot(df.lon, df.lat, color='#595959', linewidth=2, transform=ccrs.PlateCarree(), zorder=5)  # dark gray
-
-        # plot locations where omega < 1
-        if 'aragonite_saturation_state' in df.columns:
-            df = df[df.aragonite_saturation_state < 1]
-            ax.scatter(df.lon, df.lat, c='cyan', marker='.', s=150, transform=ccrs.PlateCarree(), zorder=10)
-
-        # # plot locations where pH < 1
-        # if 'pH_corrected' in df.columns:
-        #     df = df[df.pH_corrected < 7.75]
-        #     ax.scatter(df.lon, df.lat, c='magenta', marker='.', s=150, transform=ccrs.PlateCarree(), zorder=10)
-
-        # plot locations where DO < 3 mg/L
-        elif 'oxygen_concentration_shifted' in df.columns:
-            df = df[df.oxygen_concentration_shifted * 31.998 / 1000 < 3]
-            ax.scatter(df.lon, df.lat, c='magenta', marker='.', s=150, transform=ccrs.PlateCarree(), zorder=10)
+    # the bathymetry subset and contours for this extent are cached, so they're only calculated the first time
+    bathy.add_bathymetry(ax, extent, transform=ccrs.PlateCarree(), fname=bathymetry)
+
+    for key, df in deployments.items():
+        #ax.scatter(df.longitude, df.latitude, color='#595959', marker='.', s=10, transform=ccrs.PlateCarree(), zorder=5)  # dark gray
+        ax.plot(df.longitude, df.latitude, color='#595959', linewidth=2, transform=ccrs.PlateCarree(), zorder=5)  # dark gray
+
+    # plot locations where DO < 3 mg/L (magenta), omega < 1 (cyan) and pH < 7.75 (magenta)
+    colors = dict(low_do='magenta', low_omega='cyan', low_ph='magenta')
+    for rule in plot_rules:
+        df = event_points[event_points.rule == rule]
+        ax.scatter(df.longitude, df.latitude, c=colors[rule], marker='.', s=150, transform=ccrs.PlateCarree(), zorder=10)
 
     # plot locations of reported fish/crab/lobster mortalities
     ax.scatter(-73.525, 40.025, marker='X', c='r', edgecolors='k', s=200, transform=ccrs.PlateCarree(), zorder=10)  # Lillian wreck
@@ -107,4 +102,10 @@ if __name__ == '__main__':
              '/Users/garzio/Documents/rucool/Saba/gliderdata/2023/ru28-20230906T1601/ru28-20230906T1601-profile-sci-rt-slice.nc']
     map_extent = [-75, -72.25, 38.5, 40.75]
     savefile = '/Users/garzio/Documents/rucool/Saba/RMI/2023_lowDO_event/rmi_dep_deployments_202308-lowDO-magenta-omega-cyan.png'
-    main(file_list, map_extent, savefile)
+    event_db = '/Users/garzio/Documents/rucool/Saba/RMI/2023_lowDO_event/lowDO_events.db'  # None or SQLite file to save the events
+    saved_events = False  # True to plot the events saved in event_db by a previous run instead of detecting them again
+    catalog_file = None  # None or SQLite deployment catalog (see analyses/catalog_deployments.py), e.g. '/Users/garzio/Documents/rucool/Saba/gliderdata/catalog.db'
+    # with a catalog, file_list can be a directory of deployments, e.g. '/Users/garzio/Documents/rucool/Saba/gliderdata/2023'
+    start_time = None  # None or only plot data from this time on, e.g. '2023-08-17'
+    end_time = None  # None or only plot data up to this time, e.g. '2023-09-30'
+    main(file_list, map_extent, savefile, event_db, catalog_file, start_time, end_time, saved_events)
@@ -2,17 +2,17 @@
 
 """
 Author: Lori Garzio on 10/23/2023
-Last modified: 10/24/2023
+Last modified: 10/16/2026
 Plot cross-sections of data from paired glider deployments with shared axes.
 THIS IS A WORK-IN-PROGRESS
 """
 
 import os
 import pandas as pd
-import xarray as xr
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import cmocean as cmo
+import functions.alignment as alignment
 import functions.plotting as pf
 import functions.oxy_colormap_mods as ocm
 pd.set_option('display.width', 320, "display.max_columns", 10)  # for display in pycharm console
@@ -26,43 +26,15 @@ def format_date_axis(axis, figure):
     figure.autofmt_xdate()
 
 
-def main(fname1, fname2, fname3, vars, sdir):
+def main(fname1, fname2, fname3, vars, sdir, mode='scatter', start=None, end=None):
     os.makedirs(sdir, exist_ok=True)
 
-    ds1 = xr.open_dataset(fname1)
-    ds2 = xr.open_dataset(fname2)
-    ds3 = xr.open_dataset(fname3)
-
-    data1 = dict(time=ds1.time.values,
-                 depth1=ds1.depth_interpolated.values)
-    data2 = dict(time=ds2.time.values,
-                 depth2=ds2.depth_interpolated.values)
-    data3 = dict(time=ds3.time.values,
-                 depth3=ds3.depth_interpolated.values)
-
-    for v in vars:
-        try:
-            data1[v] = ds1[v].values
-        except KeyError:
-            print('')
-        try:
-            data2[v] = ds2[v].values
-        except KeyError:
-            print('')
-        try:
-            data3[v] = ds3[v].values
-        except KeyError:
-            print('')
-
-    df1 = pd.DataFrame(data1)
-    df2 = pd.DataFrame(data2)
-    df3 = pd.DataFrame(data3)
-
-    dfx = pd.merge(df1, df2, how='outer', on='time')
-    df = pd.merge(dfx, df3, how='outer', on='time')
-    df = df.sort_values(by='time')
-    df.set_index('time', inplace=True)
-    df.dropna(how='all', inplace=True)
+    # each deployment is kept in its own dataframe indexed by time, the shared x-axes line up the times
+    data = alignment.load_deployments([fname1, fname2, fname3], ['depth_interpolated'] + vars, names=[1, 2, 3],
+                                      start=start, end=end)
+    df1 = data[1]
+    df2 = data[2]
+    df3 = data[3]
 
     # plot temperature from ru39 and ru40
     kwargs = dict()
@@ -72,14 +44,16 @@ def main(fname1, fname2, fname3, vars, sdir):
     kwargs['date_fmt'] = '%b-%d'
     kwargs['vlims'] = [10, 27]
     kwargs['xlabel'] = None
+    kwargs['mode'] = mode
+    kwargs['rasterized'] = True
     fig, (ax1, ax2, ax3) = plt.subplots(3, figsize=(14, 14), sharex=True, sharey=True)
-    pf.xsection(fig, ax1, df.index.values, df.depth1, df.temperature_x, **kwargs)
+    pf.xsection(fig, ax1, df1.index.values, df1.depth_interpolated, df1.temperature, **kwargs)
 
     kwargs['title'] = 'ru40'
-    pf.xsection(fig, ax2, df.index.values, df.depth2, df.temperature_y, **kwargs)
+    pf.xsection(fig, ax2, df2.index.values, df2.depth_interpolated, df2.temperature, **kwargs)
 
     kwargs['title'] = 'ru28'
-    pf.xsection(fig, ax3, df.index.values, df.depth3, df.temperature, **kwargs)
+    pf.xsection(fig, ax3, df3.index.values, df3.depth_interpolated, df3.temperature, **kwargs)
 
     #ax1.invert_yaxis()
 
@@ -95,11 +69,13 @@ def main(fname1, fname2, fname3, vars, sdir):
     kwargs['date_fmt'] = '%b-%d'
     kwargs['vlims'] = None
     kwargs['xlabel'] = None
+    kwargs['mode'] = mode
+    kwargs['rasterized'] = True
     fig, (ax1, ax2) = plt.subplots(2, figsize=(14, 12), sharex=True, sharey=True)
-    pf.xsection(fig, ax1, df.index.values, df.depth1, df.chlorophyll_a_x, **kwargs)
+    pf.xsection(fig, ax1, df1.index.values, df1.depth_interpolated, df1.chlorophyll_a, **kwargs)
 
     kwargs['title'] = 'ru40'
-    pf.xsection(fig, ax2, df.index.values, df.depth2, df.chlorophyll_a_y, **kwargs)
+    pf.xsection(fig, ax2, df2.index.values, df2.depth_interpolated, df2.chlorophyll_a, **kwargs)
 
     ax1.invert_yaxis()
 
@@ -123,15 +99,17 @@ def main(fname1, fname2, fname3, vars, sdir):
     kwargs['date_fmt'] = '%b-%d'
     kwargs['vlims'] = [2, 9]
     kwargs['xlabel'] = None
+    kwargs['mode'] = mode
+    kwargs['rasterized'] = True
     #fig, (ax1, ax2) = plt.subplots(2, figsize=(14, 12), sharex=True, sharey=True)
     fig, (ax1, ax2) = plt.subplots(2, figsize=(14, 12))
 
-    do = df.oxygen_concentration_shifted_x * 31.998 / 1000  # convert from umol/L to mg/L
-    pf.xsection(fig, ax1, df.index.values, df.depth2, do, **kwargs)
+    do = df2.oxygen_concentration_shifted * 31.998 / 1000  # convert from umol/L to mg/L
+    pf.xsection(fig, ax1, df2.index.values, df2.depth_interpolated, do, **kwargs)
 
     kwargs['title'] = 'ru28'
-    do = df.oxygen_concentration_shifted_y * 31.998 / 1000  # convert from umol/L to mg/L
-    pf.xsection(fig, ax2, df.index.values, df.depth3, do, **kwargs)
+    do = df3.oxygen_concentration_shifted * 31.998 / 1000  # convert from umol/L to mg/L
+    pf.xsection(fig, ax2, df3.index.values, df3.depth_interpolated, do, **kwargs)
 
     #ax1.invert_yaxis()
 
@@ -146,17 +124,19 @@ def main(fname1, fname2, fname3, vars, sdir):
     kwargs['date_fmt'] = '%b-%d'
     kwargs['vlims'] = None
     kwargs['xlabel'] = None
+    kwargs['mode'] = mode
+    kwargs['rasterized'] = True
     fig, (ax1, ax2) = plt.subplots(2, figsize=(14, 12), sharex=True, sharey=True)
-    pf.xsection(fig, ax1, df.index.values, df.depth1, df.pH_corrected, **kwargs)
+    pf.xsection(fig, ax1, df1.index.values, df1.depth_interpolated, df1.pH_corrected, **kwargs)
 
     kwargs['clabel'] = 'Aragonite Saturation State'
     kwargs['cmap'] = cmo.cm.matter
     kwargs['vlims'] = None
-    pf.xsection(fig, ax2, df.index.values, df.depth1, df.aragonite_saturation_state, **kwargs)
+    pf.xsection(fig, ax2, df1.index.values, df1.depth_interpolated, df1.aragonite_saturation_state, **kwargs)
 
     # highlight where omega < 1
-    dfomega = df[df.aragonite_saturation_state < 1]
-    ax2.scatter(dfomega.index.values, dfomega.depth1, c='cyan', s=10, edgecolor='None', alpha=.5)
+    dfomega = df1[df1.aragonite_saturation_state < 1]
+    ax2.scatter(dfomega.index.values, dfomega.depth_interpolated, c='cyan', s=10, edgecolor='None', alpha=.5)
 
     ax1.invert_yaxis()
 
@@ -172,4 +152,9 @@ if __name__ == '__main__':
     vars = ['temperature', 'oxygen_concentration_shifted', 'oxygen_saturation_shifted', 'pH_corrected',
             'chlorophyll_a', 'aragonite_saturation_state', 'total_alkalinity']
     savedir = '/Users/garzio/Documents/rucool/Saba/RMI/2023_lowDO_event'
-    main(ncfile1, ncfile2, ncfile3, vars, savedir)
+    render_mode = 'scatter'  # 'scatter' to plot every observation, or 'grid' to average onto a time x depth grid
+    start_time = None  # None or only plot data from this time on, e.g. '2023-08-20'
+    end_time = None  # None or only plot data up to this time, e.g. '2023-09-20'
+    # the files can also be Parquet deployment directories (see analyses/convert_parquet.py), which only read the
+    # variables and days needed, e.g. '/Users/garzio/Documents/rucool/Saba/gliderdata/parquet/deployment=ru39-20230817T1520'
+    main(ncfile1, ncfile2, ncfile3, vars, savedir, render_mode, start_time, end_time)